@@ -0,0 +1,123 @@
+"""Adherence stats from intake_daily_rollups vs an aggregate over raw intakes.
+
+Builds a throwaway schema in the DATABASE_URI database, fills it with
+synthetic intakes (the rollups are filled by db.rollups) and times the
+/stats query both ways for random users.
+Run: python -m benchmarks.adherence_benchmark --rows 10000000
+"""
+import argparse
+import asyncio
+import random
+import time
+from datetime import datetime
+
+import asyncpg
+import psycopg2
+
+from db.async_connection_pool import database_uri
+from db.async_database import GET_USER_ADHERENCE
+from db.database import get_cursor
+import db.migrations as migrations
+from db.rollups import backfill_rollups
+from benchmarks.common import create_schema, drop_schemas, percentile
+
+
+SCHEMA = 'bench_adherence'
+
+# same UTC-day windows as the rollup query
+RAW_ADHERENCE = """SELECT medicine_name,
+       count(*) FILTER (WHERE status = 'done' AND taken_at >= ($2::DATE - 6)::TIMESTAMP AT TIME ZONE 'UTC') AS done_7,
+       count(*) FILTER (WHERE status = 'skipped' AND taken_at >= ($2::DATE - 6)::TIMESTAMP AT TIME ZONE 'UTC') AS skipped_7,
+       count(*) FILTER (WHERE status = 'done' AND taken_at >= ($2::DATE - 29)::TIMESTAMP AT TIME ZONE 'UTC') AS done_30,
+       count(*) FILTER (WHERE status = 'skipped' AND taken_at >= ($2::DATE - 29)::TIMESTAMP AT TIME ZONE 'UTC') AS skipped_30,
+       count(*) FILTER (WHERE status = 'done') AS done_365,
+       count(*) FILTER (WHERE status = 'skipped') AS skipped_365
+FROM intakes
+WHERE user_id = $1
+  AND taken_at >= ($2::DATE - 364)::TIMESTAMP AT TIME ZONE 'UTC'
+  AND taken_at < ($2::DATE + 1)::TIMESTAMP AT TIME ZONE 'UTC'
+GROUP BY medicine_name
+ORDER BY medicine_name;"""
+
+FILL = """
+ALTER TABLE intakes DISABLE TRIGGER intakes_roll_up;
+SELECT ensure_intake_partitions(((now() - ((%(rows)s / %(users)s) * (1440 / %(per_day)s) || ' minutes')::INTERVAL)
+                                 AT TIME ZONE 'UTC')::DATE,
+                                (now() AT TIME ZONE 'UTC')::DATE);
+INSERT INTO users (user_tg_id, timezone)
+SELECT 100000 + u, 'UTC' FROM generate_series(1, %(users)s) AS u;
+INSERT INTO intakes (user_id, medicine_name, taken_at, status)
+SELECT 100000 + 1 + i %% %(users)s,
+       'medicine_' || (1 + i %% %(medicines)s),
+       now() - ((i / %(users)s) * (1440 / %(per_day)s) || ' minutes')::INTERVAL,
+       CASE WHEN i %% 7 = 0 THEN 'skipped' ELSE 'done' END
+FROM generate_series(1, %(rows)s) AS i;
+ALTER TABLE intakes ENABLE TRIGGER intakes_roll_up;
+"""
+
+
+def build(sizes: dict):
+    connection = psycopg2.connect(database_uri)
+    try:
+        create_schema(connection, SCHEMA)
+        migrations.migrate(connection)
+        started = time.perf_counter()
+        with get_cursor(connection) as cursor:
+            cursor.execute(FILL, sizes)
+        print(f"filled {sizes['rows']} intakes in {time.perf_counter() - started:.1f}s")
+        started = time.perf_counter()
+        backfill_rollups(connection, batch_users=10000)
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute('VACUUM ANALYZE;')
+        print(f"backfilled rollups in {time.perf_counter() - started:.1f}s")
+    finally:
+        connection.close()
+
+
+async def time_query(connection, query: str, sizes: dict, samples: int):
+    random.seed(42)
+    today = datetime.utcnow().date()
+    timings = []
+    for _ in range(samples):
+        user_id = 100000 + random.randint(1, sizes['users'])
+        started = time.perf_counter()
+        await connection.fetch(query, user_id, today)
+        timings.append((time.perf_counter() - started) * 1000)
+    return percentile(timings, 0.5), percentile(timings, 0.99)
+
+
+async def measure(sizes: dict, samples: int):
+    connection = await asyncpg.connect(database_uri, server_settings={'search_path': SCHEMA})
+    try:
+        user_id = 100000 + 1
+        today = datetime.utcnow().date()
+        assert ([tuple(row) for row in await connection.fetch(RAW_ADHERENCE, user_id, today)]
+                == [tuple(row) for row in await connection.fetch(GET_USER_ADHERENCE, user_id, today)])
+        print(f"\n{'query':<16}{'p50':>10}{'p99':>10}   (ms)")
+        for name, query in (('raw intakes', RAW_ADHERENCE), ('rollups', GET_USER_ADHERENCE)):
+            p50, p99 = await time_query(connection, query, sizes, samples)
+            print(f"{name:<16}{p50:>10.3f}{p99:>10.3f}")
+    finally:
+        await connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10_000_000, help='intake rows')
+    parser.add_argument('--users', type=int, default=2_000)
+    parser.add_argument('--medicines', type=int, default=3, help='medicines per user')
+    parser.add_argument('--per-day', type=int, default=6, help='intakes per user per day')
+    parser.add_argument('--samples', type=int, default=200, help='queries timed per variant')
+    args = parser.parse_args()
+    sizes = {'rows': args.rows, 'users': args.users, 'medicines': args.medicines, 'per_day': args.per_day}
+
+    build(sizes)
+    try:
+        asyncio.run(measure(sizes, args.samples))
+    finally:
+        drop_schemas(SCHEMA)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+"""Burst test of the update pipeline: every user taps through adding a medicine at once.
+
+Each of --users users sends the whole add-medicine flow (the add button,
+a name, the number of doses and --doses dose times) without waiting for
+the bot's replies, and every user's updates arrive in the same burst,
+fed in getUpdates-sized batches as long polling hands them over. The
+burst is run once with updates handled directly, as aiogram does it,
+and once through the bot's UpdatePipeline. Reports how long the burst
+took, update latency, how many users ended up with the medicine they
+typed, the mean wait for a pool connection, and the pipeline's peak
+depth and shed updates.
+
+Run: python -m benchmarks.burst_benchmark --users 2000 --pool-size 10
+"""
+import argparse
+import asyncio
+import time
+from typing import Dict, List
+
+import psycopg2
+from aiogram import Bot, Dispatcher, types
+
+import db.async_connection_pool as async_connection_pool
+from db.async_connection_pool import database_uri, get_connection
+from db.async_database import add_user, list_all_medicines
+from db.cache import user_profiles, medicine_lists
+import db.migrations as migrations
+import bot_logic.utils as utils
+from bot_logic.reminder_bot import dp, reminder_bot
+from bot_logic.update_pipeline import concurrency_for_pool
+from benchmarks.common import create_schema, drop_schemas, percentile
+from benchmarks.fake_bot_api import FakeBotAPI, message_update
+import metrics
+
+
+SCHEMA = 'bench_burst'
+MEDICINE_NAME = 'aspirin'
+# getUpdates returns at most 100 updates per call
+BATCH_SIZE = 100
+MODES = ('direct', 'pipeline')
+
+
+def build():
+    connection = psycopg2.connect(database_uri)
+    try:
+        create_schema(connection, SCHEMA)
+        migrations.migrate(connection)
+    finally:
+        connection.close()
+
+
+def dose_times(doses: int) -> List[str]:
+    return [f'{8 + dose:02d}:00' for dose in range(doses)]
+
+
+def add_medicine_flow(user_id: int, doses: int) -> List[dict]:
+    return ([message_update(user_id, utils.DEFAULT_ADD_BUTTON),
+             message_update(user_id, MEDICINE_NAME),
+             message_update(user_id, str(doses))]
+            + [message_update(user_id, time) for time in dose_times(doses)])
+
+
+def burst(user_ids: range, doses: int) -> List[dict]:
+    """Every user's flow, interleaved the way many users tapping at once reach getUpdates."""
+    flows = [add_medicine_flow(user_id, doses) for user_id in user_ids]
+    return [flow[step] for step in range(len(flows[0])) for flow in flows]
+
+
+async def prepare(user_ids: range):
+    async with get_connection() as connection:
+        for user_id in user_ids:
+            await add_user(connection, user_id, 'Europe/Moscow')
+
+
+async def count_correct(user_ids: range, doses: int) -> int:
+    expected = [(MEDICINE_NAME, ','.join(dose_times(doses)))]
+    correct = 0
+    async with get_connection() as connection:
+        for user_id in user_ids:
+            correct += await list_all_medicines(connection, user_id) == expected
+    return correct
+
+
+def checkout_wait() -> tuple:
+    counts, total = metrics.DB_CHECKOUT.values.get((), ([0], [0.0]))
+    return sum(counts), total[0]
+
+
+async def run_burst(mode: str, user_ids: range, args) -> Dict[str, float]:
+    await prepare(user_ids)
+    if mode == 'pipeline':
+        dp.pipeline.max_pending = args.max_pending
+        dp.pipeline.start(concurrency_for_pool(args.pool_size))
+    updates = burst(user_ids, args.doses)
+    latencies = []
+    peak_depth = 0
+    shed = dp.pipeline.shed
+    checkouts, waited = checkout_wait()
+
+    async def process(update: dict):
+        started = time.perf_counter()
+        # what Dispatcher.process_updates does for every update of a polled batch
+        await dp.updates_handler.notify(types.Update(**update))
+        latencies.append(time.perf_counter() - started)
+
+    async def sample_depth():
+        nonlocal peak_depth
+        while True:
+            peak_depth = max(peak_depth, dp.pipeline.pending + len(dp.pipeline.held))
+            await asyncio.sleep(0.01)
+
+    sampler = asyncio.create_task(sample_depth())
+    started = time.perf_counter()
+    tasks = []
+    for first in range(0, len(updates), BATCH_SIZE):
+        tasks += [asyncio.create_task(process(update)) for update in updates[first:first + BATCH_SIZE]]
+        await asyncio.sleep(args.interval)
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    sampler.cancel()
+    if mode == 'pipeline':
+        await dp.pipeline.stop()
+    await dp.storage.flush()
+    new_checkouts, new_waited = checkout_wait()
+    return {'updates': len(updates),
+            'seconds': elapsed,
+            'p50_ms': percentile(latencies, 0.5) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'errors': sum(isinstance(result, Exception) for result in results),
+            'correct': await count_correct(user_ids, args.doses),
+            'checkout_wait_ms': (new_waited - waited) / max(new_checkouts - checkouts, 1) * 1000,
+            'peak_depth': peak_depth,
+            'shed': dp.pipeline.shed - shed}
+
+
+async def run(args) -> Dict[str, Dict[str, float]]:
+    fake_api = FakeBotAPI()
+    await fake_api.start()
+    reminder_bot.server = fake_api.server
+    Bot.set_current(reminder_bot)
+    Dispatcher.set_current(dp)
+    await async_connection_pool.create_pool(max_size=args.pool_size, server_settings={'search_path': SCHEMA})
+    report = {}
+    try:
+        first_user_id = 100000
+        for mode in MODES:
+            user_ids = range(first_user_id, first_user_id + args.users)
+            report[mode] = await run_burst(mode, user_ids, args)
+            first_user_id += args.users
+    finally:
+        await dp.storage.close()
+        await async_connection_pool.close_pool()
+        await fake_api.stop()
+        await (await reminder_bot.get_session()).close()
+        user_profiles.clear()
+        medicine_lists.clear()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--doses', type=int, default=3, help='dose times each user types')
+    parser.add_argument('--pool-size', type=int, default=10)
+    parser.add_argument('--max-pending', type=int, default=1000, help="the pipeline's max_pending")
+    parser.add_argument('--interval', type=float, default=0.0, help='seconds between getUpdates batches')
+    args = parser.parse_args()
+
+    build()
+    try:
+        report = asyncio.run(run(args))
+    finally:
+        drop_schemas(SCHEMA)
+
+    rows = [('updates', 'updates', '{:.0f}'),
+            ('burst (s)', 'seconds', '{:.2f}'),
+            ('p50 latency (ms)', 'p50_ms', '{:.1f}'),
+            ('p99 latency (ms)', 'p99_ms', '{:.1f}'),
+            ('handler errors', 'errors', '{:.0f}'),
+            ('users with their medicine', 'correct', '{:.0f}'),
+            ('mean pool checkout wait (ms)', 'checkout_wait_ms', '{:.2f}'),
+            ('peak pipeline depth', 'peak_depth', '{:.0f}'),
+            ('updates shed', 'shed', '{:.0f}')]
+    print(f"{'':<32}" + ''.join(f'{mode:>14}' for mode in MODES))
+    for label, key, spec in rows:
+        print(f'{label:<32}' + ''.join(f'{spec.format(report[mode][key]):>14}' for mode in MODES))
+
+
+if __name__ == '__main__':
+    main()
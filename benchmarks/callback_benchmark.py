@@ -0,0 +1,62 @@
+"""Reminder button callback_data: the old text format against callback_codec.
+
+Times building and parsing the payload of a Done button both ways and
+shows, for a few medicine names, how many bytes each takes (Telegram
+rejects buttons over 64) and whether the old split('_') parse gets the
+name back. No database is needed.
+
+Run: python -m benchmarks.callback_benchmark --number 1000000
+"""
+import argparse
+import timeit
+
+import bot_logic.callback_codec as callback_codec
+
+
+TELEGRAM_LIMIT = 64
+USER_ID = 5_123_456_789
+REMINDER_ID = 2_147_000_000
+NAMES = ['aspirin', 'vitamin_d3', 'Омега-3 после завтрака', 'Л-тироксин 50 мкг, за полчаса до еды']
+
+
+def legacy_encode(user_id: int, medicine_name: str) -> str:
+    return f'button_done_{user_id}_{medicine_name}'
+
+
+def legacy_decode(data: str):
+    # how process_reminder_callback_buttons parsed it
+    user_id, medicine_name = data.split('_')[-2:]
+    return 'done' in data, user_id, medicine_name
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    legacy = legacy_encode(USER_ID, NAMES[0])
+    encoded = callback_codec.encode(callback_codec.ACTION_DONE, REMINDER_ID)
+    assert callback_codec.decode(encoded) == (callback_codec.ACTION_DONE, REMINDER_ID)
+    cases = [
+        ('text encode', lambda: legacy_encode(USER_ID, NAMES[0])),
+        ('text decode', lambda: legacy_decode(legacy)),
+        ('codec encode', lambda: callback_codec.encode(callback_codec.ACTION_DONE, REMINDER_ID)),
+        ('codec decode', lambda: callback_codec.decode(encoded)),
+        ('codec decode, not ours', lambda: callback_codec.decode('select_aspirin')),
+    ]
+    print(f"{'':<26}{'ns/op':>8}")
+    for name, call in cases:
+        seconds = min(timeit.repeat(call, number=args.number, repeat=7))
+        print(f"{name:<26}{seconds / args.number * 1e9:>8.0f}")
+
+    print(f"\n{'medicine':<40}{'text bytes':>12}{'parsed back':>13}{'codec bytes':>13}")
+    for medicine_name in NAMES:
+        data = legacy_encode(USER_ID, medicine_name)
+        size = len(data.encode('utf-8'))
+        parsed = legacy_decode(data)[2] == medicine_name
+        too_long = ' (over 64)' if size > TELEGRAM_LIMIT else ''
+        print(f"{medicine_name:<40}{size:>12}{'yes' if parsed else 'no':>13}{len(encoded):>13}{too_long}")
+
+
+if __name__ == '__main__':
+    main()
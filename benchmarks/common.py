@@ -0,0 +1,53 @@
+"""Helpers shared by the benchmark scripts.
+
+Benchmarks that need tables build them in a throwaway schema of their
+own, so they can run against the bot's database without touching its
+data, and drop it when they are done.
+"""
+from collections import Counter
+from typing import Iterable, Sequence
+
+import psycopg2
+
+from db.connection_pool import database_uri
+from db.database import get_cursor
+
+
+def create_schema(connection, schema: str):
+    """Creates the schema afresh and points the connection at it."""
+    with get_cursor(connection) as cursor:
+        cursor.execute(f'DROP SCHEMA IF EXISTS {schema} CASCADE; CREATE SCHEMA {schema}; SET search_path TO {schema};')
+
+
+def use_schema(connection, schema: str):
+    with get_cursor(connection) as cursor:
+        cursor.execute(f'SET search_path TO {schema};')
+
+
+def drop_schemas(*schemas: str):
+    """Drops the schemas on a connection of its own."""
+    connection = psycopg2.connect(database_uri)
+    try:
+        with get_cursor(connection) as cursor:
+            cursor.execute(' '.join(f'DROP SCHEMA IF EXISTS {schema} CASCADE;' for schema in schemas))
+    finally:
+        connection.close()
+
+
+def percentile(values: Iterable[float], q: float) -> float:
+    values: Sequence[float] = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+class RecordingQueue:
+    """Stands in for the SendQueue and counts what would have been sent to each chat."""
+
+    def __init__(self):
+        self.sent = Counter()
+
+    def submit(self, chat_id: int, text: str, priority: int = 0, **kwargs):
+        self.sent[chat_id] += 1
+
+    @property
+    def total(self) -> int:
+        return sum(self.sent.values())
@@ -0,0 +1,148 @@
+"""DST transitions: recomputing every zone's doses, and firing through a year.
+
+Spreads --doses doses over every zone in pytz.common_timezones and times:
+recomputing each dose's UTC minute one at a time from pytz (what fixing the
+old fixed-UTC-minute schedules would have meant), moving every zone to a new
+offset with the dispatcher's per-zone pass, and the real transitions of
+--year stepped through hour by hour, checking every dose against pytz.
+
+With --fire-check, a few doses per zone (including ones inside the hour a
+transition skips or repeats) are then fired minute by minute through the
+whole year, and every dose must fire exactly once on every local day.
+No database is needed.
+
+Run: python -m benchmarks.dst_benchmark --doses 100000
+"""
+import argparse
+import logging
+import random
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+import pytz
+
+from bot_logic.reminder_dispatcher import ReminderDispatcher, Dose, MINUTES_PER_DAY
+from bot_logic.timezone_calendar import TransitionCalendar, Shift, local_to_utc_minute
+
+
+# 01:30 and 02:30 fall inside the skipped or repeated hour in most DST zones
+FIRE_CHECK_MINUTES = (90, 150, 8 * 60, 23 * 60 + 45)
+
+
+def build(doses: int, start: datetime, seed: int, zones=pytz.common_timezones, local_minutes=None):
+    random.seed(seed)
+    dispatcher = ReminderDispatcher(send_queue=None, calendar=TransitionCalendar(start))
+    schedule_id = 0
+    for index in range(doses):
+        zone = zones[index % len(zones)]
+        for local_minute in local_minutes or [random.randrange(MINUTES_PER_DAY)]:
+            schedule_id += 1
+            dispatcher.add(Dose(schedule_id, schedule_id, index, index, f'medicine_{schedule_id}', zone, local_minute))
+    return dispatcher
+
+
+def pytz_offset(zone: str, moment: datetime) -> int:
+    return int(moment.astimezone(pytz.timezone(zone)).utcoffset().total_seconds() // 60)
+
+
+def all_doses(dispatcher: ReminderDispatcher):
+    for local_buckets in dispatcher.zones.values():
+        for bucket in local_buckets.values():
+            yield from bucket.values()
+
+
+def one_at_a_time(dispatcher: ReminderDispatcher, moment: datetime) -> float:
+    started = time.perf_counter()
+    for dose in all_doses(dispatcher):
+        local_to_utc_minute(dose.local_minute, pytz_offset(dose.timezone, moment))
+    return time.perf_counter() - started
+
+
+def misplaced(dispatcher: ReminderDispatcher, moment: datetime) -> int:
+    """Doses not in the UTC minute bucket pytz says their local time falls on."""
+    wrong = 0
+    for zone, local_buckets in dispatcher.zones.items():
+        offset = pytz_offset(zone, moment)
+        for local_minute, bucket in local_buckets.items():
+            if dispatcher.buckets.get(local_to_utc_minute(local_minute, offset), {}).get(zone) is not bucket:
+                wrong += len(bucket)
+    return wrong
+
+
+def every_zone(dispatcher: ReminderDispatcher, moment: datetime) -> float:
+    started = time.perf_counter()
+    for zone in list(dispatcher.zones):
+        offset = dispatcher.calendar.offset(zone)
+        dispatcher.shift_zone(Shift(zone, moment, offset, offset + 60), edges=False)
+    elapsed = time.perf_counter() - started
+    for zone in list(dispatcher.zones):
+        offset = dispatcher.calendar.offset(zone)
+        dispatcher.shift_zone(Shift(zone, moment, offset + 60, offset), edges=False)
+    return elapsed
+
+
+def year_of_transitions(dispatcher: ReminderDispatcher, start: datetime):
+    shifts, moved, elapsed, worst, wrong = 0, 0, 0.0, 0.0, 0
+    moment = start
+    while moment < start + timedelta(days=365):
+        moment += timedelta(hours=1)
+        started = time.perf_counter()
+        for shift in dispatcher.calendar.advance(moment):
+            dispatcher.shift_zone(shift, edges=False)
+            shifts += 1
+            moved += sum(len(bucket) for bucket in dispatcher.zones.get(shift.zone, {}).values())
+        step = time.perf_counter() - started
+        elapsed += step
+        worst = max(worst, step)
+        if step > 0.0001 or moment.day == 1 and moment.hour == 0:
+            wrong += misplaced(dispatcher, moment)
+    return shifts, moved, elapsed, worst, wrong
+
+
+def fire_check(start: datetime, seed: int) -> int:
+    dispatcher = build(len(pytz.common_timezones), start, seed, local_minutes=FIRE_CHECK_MINUTES)
+    fired = Counter()
+    for minute in range(365 * MINUTES_PER_DAY):
+        moment = start + timedelta(minutes=minute)
+        # a second back, so a dose skipped at 23:45 and fired at the transition to 00:00 counts for its own day
+        for dose in dispatcher.collect(moment):
+            local = (moment - timedelta(seconds=1)).astimezone(pytz.timezone(dose.timezone))
+            fired[dose.schedule_id, local.date()] += 1
+    wrong = 0
+    for dose in all_doses(dispatcher):
+        first = start.astimezone(pytz.timezone(dose.timezone)).date() + timedelta(days=1)
+        for day in range(363):
+            date = first + timedelta(days=day)
+            if fired[dose.schedule_id, date] != 1:
+                wrong += 1
+                print(f"  {dose.timezone} {dose.local_minute // 60:02d}:{dose.local_minute % 60:02d} "
+                      f"fired {fired[dose.schedule_id, date]} times on {date}")
+    return wrong
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--doses', type=int, default=100_000)
+    parser.add_argument('--year', type=int, default=2027)
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--fire-check', action='store_true', help='fire minute by minute through the year, slow')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    start = datetime(args.year, 1, 1, tzinfo=timezone.utc)
+    started = time.perf_counter()
+    dispatcher = build(args.doses, start, args.seed)
+    print(f"{len(dispatcher)} doses in {len(dispatcher.zones)} zones, added in {time.perf_counter() - started:.2f}s")
+    print(f"recomputing every dose from pytz, one at a time: {one_at_a_time(dispatcher, start) * 1000:8.1f}ms")
+    print(f"moving every zone, one pass per zone:            {every_zone(dispatcher, start) * 1000:8.1f}ms")
+    shifts, moved, elapsed, worst, wrong = year_of_transitions(dispatcher, start)
+    print(f"{args.year}: {shifts} transitions moved {moved} doses in {elapsed * 1000:.1f}ms, "
+          f"slowest hour {worst * 1000:.1f}ms, {wrong} doses off after a transition")
+    if args.fire_check:
+        wrong = fire_check(start, args.seed)
+        print(f"fired through {args.year}: {wrong} dose-days not fired exactly once")
+
+
+if __name__ == '__main__':
+    main()
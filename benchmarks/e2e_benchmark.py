@@ -0,0 +1,330 @@
+"""End-to-end load test: virtual users drive the bot through a fake Bot API and a local Postgres.
+
+Every virtual user sends /start, shares a location, adds --medicines
+medicines with --doses dose times each and lists them. Then a reminder
+dispatcher loads the schedule the users built and is ticked through a
+whole virtual day; its send queue delivers every reminder to the fake
+Bot API. Last, each user presses Done (or, one time in five, Skip) on
+every reminder they got.
+
+Updates go straight to the dispatcher, so latency is handler latency
+(webhook_benchmark covers the HTTP hop). Statements are attributed to the
+action whose handler ran them; those of the write-behind FSM flush and
+intake buffer are counted as background. Peak memory is the process's
+peak RSS.
+
+Results can be saved as a baseline and every later run is compared
+against it, so regressions in the handlers or the queries show up:
+
+Run: python -m benchmarks.e2e_benchmark --users 1000 --save-baseline
+     python -m benchmarks.e2e_benchmark --users 1000 --check
+"""
+import argparse
+import asyncio
+import contextvars
+import json
+import os
+import random
+import resource
+import sys
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List
+
+import psycopg2
+from aiogram import Bot, Dispatcher, types
+
+import db.async_connection_pool as async_connection_pool
+from db.async_connection_pool import database_uri, get_connection
+from db.cache import user_profiles, medicine_lists
+import db.migrations as migrations
+import bot_logic.utils as utils
+from bot_logic.reminder_bot import dp, reminder_bot, intake_buffer
+from bot_logic.reminder_dispatcher import ReminderDispatcher, MINUTES_PER_DAY
+from bot_logic.send_queue import SendQueue
+from benchmarks.common import create_schema, drop_schemas, percentile
+from benchmarks.fake_bot_api import FakeBotAPI, message_update, location_update, callback_update
+
+
+SCHEMA = 'bench_e2e'
+FIRST_USER_ID = 100000
+BASELINE = os.path.join(os.path.dirname(__file__), 'baselines', 'e2e_benchmark.json')
+# relative change in latency, throughput or memory that counts as a regression
+TOLERANCE = 0.3
+
+MEDICINES = ['aspirin', 'ibuprofen', 'magnesium', 'omega3', 'zinc', 'iron', 'folate', 'melatonin']
+LOCATIONS = [(55.75, 37.62),  # Moscow
+             (55.03, 82.92),  # Novosibirsk
+             (52.52, 13.40),  # Berlin
+             (40.71, -74.01),  # New York
+             (35.68, 139.69)]  # Tokyo
+
+current_action = contextvars.ContextVar('current_action', default=None)
+
+
+async def process_update(update: dict):
+    # a task of its own, like polling and webhook give every update: aiogram keeps the FSM state in a context var
+    await asyncio.create_task(dp.process_update(types.Update(**update)))
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.round_trips = Counter()
+
+    def on_query(self, record):
+        self.round_trips[current_action.get() or 'background'] += 1
+
+    async def process(self, action: str, update: dict):
+        token = current_action.set(action)
+        started = time.perf_counter()
+        try:
+            await process_update(update)
+        finally:
+            self.latencies[action].append(time.perf_counter() - started)
+            current_action.reset(token)
+
+
+def build():
+    connection = psycopg2.connect(database_uri)
+    try:
+        create_schema(connection, SCHEMA)
+        migrations.migrate(connection)
+    finally:
+        connection.close()
+
+
+def onboarding(user_id: int, medicines: int, doses: int) -> List[tuple]:
+    index = user_id - FIRST_USER_ID
+    latitude, longitude = LOCATIONS[index % len(LOCATIONS)]
+    steps = [('start', message_update(user_id, '/start')),
+             ('location', location_update(user_id, latitude, longitude))]
+    for medicine in range(medicines):
+        steps += [('add', message_update(user_id, utils.DEFAULT_ADD_BUTTON)),
+                  ('name', message_update(user_id, MEDICINES[medicine % len(MEDICINES)])),
+                  ('dose_count', message_update(user_id, str(doses)))]
+        for dose in range(doses):
+            # spread over the day so the reminders come in waves rather than at one minute
+            minute = (8 * 60 + dose * (14 * 60 // doses) + medicine * 5 + index % 60) % MINUTES_PER_DAY
+            action = 'dose_time' if dose < doses - 1 else 'save_medicine'
+            steps.append((action, message_update(user_id, f'{minute // 60:02d}:{minute % 60:02d}')))
+    steps.append(('list', message_update(user_id, utils.DEFAULT_LIST_BUTTON)))
+    return steps
+
+
+async def run_users(recorder: Recorder, scripts: Dict[int, List[tuple]], concurrency: int) -> float:
+    users = iter(scripts.items())
+
+    async def worker():
+        for _, steps in users:
+            for action, update in steps:
+                await recorder.process(action, update)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return time.perf_counter() - started
+
+
+async def remind(recorder: Recorder, args) -> dict:
+    if args.telegram_limits:
+        send_queue = SendQueue(reminder_bot)
+    else:
+        # the bot's own capacity, not Telegram's 30 messages a second
+        send_queue = SendQueue(reminder_bot, global_rate=1e9, per_chat_rate=1e9)
+    dispatcher = ReminderDispatcher(send_queue)
+    started = time.perf_counter()
+    await dispatcher.load()
+    loaded = time.perf_counter() - started
+    send_queue.start()
+    day = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    token = current_action.set('reminder')
+    started = time.perf_counter()
+    try:
+        for minute in range(MINUTES_PER_DAY):
+            await dispatcher.tick(day + timedelta(minutes=minute))
+    finally:
+        current_action.reset(token)
+    await send_queue.stop(timeout=600)
+    elapsed = time.perf_counter() - started
+    return {'doses': len(dispatcher), 'load_seconds': loaded, 'sent': send_queue.sent,
+            'failed': send_queue.failed, 'seconds': elapsed}
+
+
+def acknowledgements(messages: List[dict], seed: int) -> Dict[int, List[tuple]]:
+    rng = random.Random(seed)
+    scripts = defaultdict(list)
+    for message in messages:
+        markup = message['reply_markup']
+        if not markup or 'inline_keyboard' not in markup:
+            continue
+        done, skip = markup['inline_keyboard'][0]
+        action, button = ('skip', skip) if rng.random() < 0.2 else ('done', done)
+        user_id = message['chat']['id']
+        scripts[user_id].append((action, callback_update(user_id, button['callback_data'], message['message_id'])))
+    return scripts
+
+
+async def run(args) -> dict:
+    fake_api = FakeBotAPI(record=True)
+    await fake_api.start()
+    reminder_bot.server = fake_api.server
+    Bot.set_current(reminder_bot)
+    Dispatcher.set_current(dp)
+    recorder = Recorder()
+    await async_connection_pool.create_pool(max_size=args.pool_size, server_settings={'search_path': SCHEMA})
+    async_connection_pool.query_listeners.append(recorder.on_query)
+    utils.get_timezone_finder()
+    intake_buffer.start()
+    try:
+        # outside any action: starts the FSM flush loop so its statements count as background
+        warm_up = FIRST_USER_ID - 1
+        for update in (message_update(warm_up, '/start'), location_update(warm_up, *LOCATIONS[0])):
+            await process_update(update)
+
+        user_ids = range(FIRST_USER_ID, FIRST_USER_ID + args.users)
+        scripts = {user_id: onboarding(user_id, args.medicines, args.doses) for user_id in user_ids}
+        onboarding_seconds = await run_users(recorder, scripts, args.concurrency)
+        onboarding_updates = sum(len(steps) for steps in scripts.values())
+
+        reminders = await remind(recorder, args)
+
+        scripts = acknowledgements(fake_api.messages, args.seed)
+        acknowledged = sum(len(steps) for steps in scripts.values())
+        acknowledge_seconds = await run_users(recorder, scripts, args.concurrency)
+        await intake_buffer.flush()
+        await dp.storage.flush()
+        async with get_connection() as connection:
+            recorded = await connection.fetchval('SELECT count(*) FROM intakes')
+    finally:
+        async_connection_pool.query_listeners.remove(recorder.on_query)
+        await intake_buffer.stop()
+        await dp.storage.close()
+        await async_connection_pool.close_pool()
+        await fake_api.stop()
+        await (await reminder_bot.get_session()).close()
+        user_profiles.clear()
+        medicine_lists.clear()
+
+    updates = [latency for latencies in recorder.latencies.values() for latency in latencies]
+    actions = {action: {'updates': len(latencies),
+                        'p50_ms': percentile(latencies, 0.5) * 1000,
+                        'p99_ms': percentile(latencies, 0.99) * 1000,
+                        'round_trips': recorder.round_trips[action] / len(latencies)}
+               for action, latencies in recorder.latencies.items()}
+    return {'actions': actions,
+            'p50_ms': percentile(updates, 0.5) * 1000,
+            'p99_ms': percentile(updates, 0.99) * 1000,
+            'onboarding_updates_per_second': onboarding_updates / onboarding_seconds,
+            'acknowledgements_per_second': acknowledged / acknowledge_seconds,
+            # Done/Skip presses that left no intake behind
+            'intakes_missing': acknowledged - recorded,
+            'reminders': reminders['sent'],
+            'reminders_failed': reminders['failed'],
+            'reminders_per_second': reminders['sent'] / reminders['seconds'],
+            'reminder_round_trips': recorder.round_trips['reminder'] / max(reminders['sent'], 1),
+            'schedule_load_seconds': reminders['load_seconds'],
+            'background_round_trips': recorder.round_trips['background'] / len(updates),
+            'peak_rss_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+def print_results(results: dict):
+    print(f"{'action':<16}{'updates':>9}{'p50 ms':>9}{'p99 ms':>9}{'db trips':>10}")
+    for action, row in results['actions'].items():
+        print(f"{action:<16}{row['updates']:>9}{row['p50_ms']:>9.2f}{row['p99_ms']:>9.2f}{row['round_trips']:>10.2f}")
+    print(f"{'all updates':<16}{'':>9}{results['p50_ms']:>9.2f}{results['p99_ms']:>9.2f}")
+    print()
+    print(f"onboarding             {results['onboarding_updates_per_second']:.0f} updates/s")
+    print(f"acknowledgements       {results['acknowledgements_per_second']:.0f} updates/s, "
+          f"{results['intakes_missing']} without an intake")
+    print(f"reminders sent         {results['reminders']} ({results['reminders_failed']} failed), "
+          f"{results['reminders_per_second']:.0f}/s, {results['reminder_round_trips']:.3f} db trips each")
+    print(f"schedule load          {results['schedule_load_seconds']:.2f}s")
+    print(f"background db trips    {results['background_round_trips']:.2f} per update")
+    print(f"peak RSS               {results['peak_rss_mib']:.0f} MiB")
+
+
+def flatten(results: dict) -> Dict[str, float]:
+    flat = {key: value for key, value in results.items() if key != 'actions'}
+    for action, row in results['actions'].items():
+        flat.update({f'{action}.{key}': value for key, value in row.items() if key != 'updates'})
+    return flat
+
+
+def is_regression(name: str, baseline: float, current: float) -> bool:
+    if name.endswith('round_trips'):
+        # statement counts barely depend on the machine; FSM cache expiry adds a few reads
+        return current > baseline + 0.05
+    if name == 'intakes_missing':
+        return current > baseline
+    if name.endswith('per_second'):
+        return current < baseline * (1 - TOLERANCE)
+    # single actions share one event loop with every other user and the fake API, too noisy to gate on
+    if name in ('p50_ms', 'p99_ms', 'peak_rss_mib'):
+        return current > baseline * (1 + TOLERANCE)
+    return False
+
+
+def rounded(value):
+    if isinstance(value, dict):
+        return {key: rounded(item) for key, item in value.items()}
+    return round(value, 3) if isinstance(value, float) else value
+
+
+def compare(params: dict, results: dict) -> int:
+    with open(BASELINE) as file:
+        baseline = json.load(file)
+    if baseline['params'] != params:
+        print(f"\nbaseline was taken with {baseline['params']}, not comparing")
+        return 0
+    regressions = 0
+    print(f"\n{'vs baseline':<32}{'baseline':>12}{'now':>12}{'change':>9}")
+    before, now = flatten(baseline['results']), flatten(results)
+    for name, value in now.items():
+        if name not in before:
+            continue
+        change = (value - before[name]) / before[name] * 100 if before[name] else 0.0
+        regressed = is_regression(name, before[name], value)
+        regressions += regressed
+        print(f"{name:<32}{before[name]:>12.2f}{value:>12.2f}{change:>8.0f}%{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--medicines', type=int, default=2, help='medicines per user')
+    parser.add_argument('--doses', type=int, default=3, help='dose times per medicine')
+    parser.add_argument('--concurrency', type=int, default=20, help='users sending updates at the same time')
+    parser.add_argument('--pool-size', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--telegram-limits', action='store_true', help="send reminders at Telegram's rate limits")
+    parser.add_argument('--save-baseline', action='store_true', help=f'write the results to {BASELINE}')
+    parser.add_argument('--check', action='store_true', help='exit with 1 if anything regressed against the baseline')
+    args = parser.parse_args()
+    params = {'users': args.users, 'medicines': args.medicines, 'doses': args.doses,
+              'concurrency': args.concurrency, 'pool_size': args.pool_size, 'seed': args.seed,
+              'telegram_limits': args.telegram_limits}
+
+    build()
+    try:
+        results = asyncio.run(run(args))
+    finally:
+        drop_schemas(SCHEMA)
+    print_results(results)
+
+    regressions = 0
+    if os.path.exists(BASELINE) and not args.save_baseline:
+        regressions = compare(params, results)
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(BASELINE), exist_ok=True)
+        with open(BASELINE, 'w') as file:
+            json.dump({'params': params, 'results': rounded(results)}, file, indent=2)
+            file.write('\n')
+        print(f"\nsaved baseline to {BASELINE}")
+    if args.check and regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Local stand-in for the Telegram Bot API that answers every method with a plausible result,
+and builders for the updates Telegram would send the bot."""
+import itertools
+import json
+import time
+from collections import Counter
+from typing import List, Optional
+
+from aiohttp import web
+from aiogram.bot.api import TelegramAPIServer
+
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Vladkins', 'username': 'vladkins_bot'}
+# methods whose result is a Message; everything else gets True
+MESSAGE_METHODS = {'sendmessage', 'senddocument', 'editmessagetext', 'editmessagereplymarkup'}
+
+update_ids = itertools.count(1)
+
+
+def _user(user_id: int) -> dict:
+    return {'id': user_id, 'is_bot': False, 'first_name': 'bench'}
+
+
+def message_update(user_id: int, text: Optional[str] = None, **fields) -> dict:
+    update_id = next(update_ids)
+    message = {'message_id': update_id, 'date': int(time.time()),
+               'chat': {'id': user_id, 'type': 'private'}, 'from': _user(user_id), **fields}
+    if text is not None:
+        message['text'] = text
+    return {'update_id': update_id, 'message': message}
+
+
+def location_update(user_id: int, latitude: float, longitude: float) -> dict:
+    return message_update(user_id, location={'latitude': latitude, 'longitude': longitude})
+
+
+def callback_update(user_id: int, data: str, message_id: Optional[int] = None) -> dict:
+    update_id = next(update_ids)
+    return {'update_id': update_id,
+            'callback_query': {'id': str(update_id), 'from': _user(user_id), 'chat_instance': str(user_id),
+                               'data': data,
+                               'message': {'message_id': message_id or update_id, 'date': int(time.time()),
+                                           'chat': {'id': user_id, 'type': 'private'}}}}
+
+
+class FakeBotAPI:
+    """With record=True every sendMessage result is kept in messages, reply_markup parsed."""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, record: bool = False):
+        self.host = host
+        self.port = port
+        self.record = record
+        self.calls = Counter()
+        self.messages: List[dict] = []
+        self.message_ids = itertools.count(1)
+        self.runner: Optional[web.AppRunner] = None
+
+    @property
+    def server(self) -> TelegramAPIServer:
+        return TelegramAPIServer.from_base(f'http://{self.host}:{self.port}')
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method'].lower()
+        self.calls[method] += 1
+        if method == 'getme':
+            return web.json_response({'ok': True, 'result': BOT_USER})
+        if method in MESSAGE_METHODS:
+            params = await request.post()
+            chat_id = int(params.get('chat_id', 0))
+            message = {'message_id': int(params.get('message_id') or next(self.message_ids)),
+                       'date': int(time.time()),
+                       'chat': {'id': chat_id, 'type': 'private'},
+                       'from': BOT_USER,
+                       'text': params.get('text', '')}
+            if self.record and method == 'sendmessage':
+                self.messages.append({**message, 'reply_markup': json.loads(params.get('reply_markup') or 'null')})
+            return web.json_response({'ok': True, 'result': message})
+        return web.json_response({'ok': True, 'result': True})
@@ -0,0 +1,72 @@
+"""FSM storage throughput: MemoryStorage vs PostgresStorage.
+
+Each simulated conversation replays the /add flow: a handful of
+get_state/set_state/update_data/get_data calls and a final finish().
+
+Run: python -m benchmarks.fsm_storage_benchmark --conversations 5000
+"""
+import argparse
+import asyncio
+import time
+
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+
+import db.async_connection_pool as async_connection_pool
+from db.async_connection_pool import get_connection
+from db.fsm_storage import PostgresStorage
+
+
+FIRST_USER_ID = 900_000_000
+STEPS = ('Setup:MedicineName', 'Setup:MedicineSchedule')
+
+
+async def conversation(storage, user_id: int) -> int:
+    await storage.get_state(chat=user_id, user=user_id)
+    await storage.set_state(chat=user_id, user=user_id, state=STEPS[0])
+    await storage.get_state(chat=user_id, user=user_id)
+    await storage.update_data(chat=user_id, user=user_id, data={'medicine_name': 'aspirin'})
+    await storage.set_state(chat=user_id, user=user_id, state=STEPS[1])
+    await storage.get_state(chat=user_id, user=user_id)
+    await storage.get_data(chat=user_id, user=user_id)
+    await storage.finish(chat=user_id, user=user_id)
+    return 8
+
+
+async def run(storage, conversations: int, concurrency: int) -> float:
+    started = time.perf_counter()
+    operations = 0
+    for offset in range(0, conversations, concurrency):
+        users = range(FIRST_USER_ID + offset, FIRST_USER_ID + min(offset + concurrency, conversations))
+        operations += sum(await asyncio.gather(*(conversation(storage, user_id) for user_id in users)))
+    await storage.close()
+    return operations / (time.perf_counter() - started)
+
+
+async def cleanup():
+    async with get_connection() as connection:
+        await connection.execute("DELETE FROM fsm_states WHERE user_id >= $1", FIRST_USER_ID)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--conversations', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=10, help='conversations in flight (pool size)')
+    args = parser.parse_args()
+
+    await async_connection_pool.create_pool(max_size=args.concurrency)
+    try:
+        storages = [('MemoryStorage', MemoryStorage()),
+                    ('Postgres, cache 5s', PostgresStorage()),
+                    ('Postgres, no cache', PostgresStorage(cache_ttl=0))]
+        print(f"{'storage':<22}{'ops/s':>12}{'db reads':>10}{'rows written':>14}")
+        for name, storage in storages:
+            ops = await run(storage, args.conversations, args.concurrency)
+            stats = storage.stats() if isinstance(storage, PostgresStorage) else {}
+            print(f"{name:<22}{ops:>12.0f}{stats.get('db_reads', 0):>10}{stats.get('rows_flushed', 0):>14}")
+            await cleanup()
+    finally:
+        await async_connection_pool.close_pool()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,74 @@
+"""Intake ingest throughput: one INSERT per press vs the write-behind buffer.
+
+Run: python -m benchmarks.intake_benchmark --presses 20000
+"""
+import argparse
+import asyncio
+import time
+from datetime import datetime
+
+import db.async_connection_pool as async_connection_pool
+from db.async_connection_pool import get_connection
+from db.async_database import add_user, add_intake
+from db.intake_buffer import IntakeBuffer
+
+
+USERS = 1000
+FIRST_USER_ID = 900_000_000
+
+
+async def prepare():
+    async with get_connection() as connection:
+        for user_id in range(FIRST_USER_ID, FIRST_USER_ID + USERS):
+            await add_user(connection, user_id, 'UTC')
+
+
+async def cleanup():
+    async with get_connection() as connection:
+        await connection.execute("DELETE FROM users WHERE user_tg_id >= $1 AND user_tg_id < $2",
+                                 FIRST_USER_ID, FIRST_USER_ID + USERS)
+
+
+async def per_row(presses: int, concurrency: int) -> float:
+    async def press(number: int):
+        async with get_connection() as connection:
+            await add_intake(connection, 'medicine', FIRST_USER_ID + number % USERS, datetime.now().astimezone(), 'done')
+
+    started = time.perf_counter()
+    for offset in range(0, presses, concurrency):
+        await asyncio.gather(*(press(number) for number in range(offset, min(offset + concurrency, presses))))
+    return presses / (time.perf_counter() - started)
+
+
+async def buffered(presses: int, batch: int) -> float:
+    buffer = IntakeBuffer(max_rows=batch, flush_interval=0.05)
+    buffer.start()
+    started = time.perf_counter()
+    for number in range(presses):
+        buffer.add('medicine', FIRST_USER_ID + number % USERS, datetime.now().astimezone(), 'done')
+        if number % batch == 0:
+            await asyncio.sleep(0)
+    await buffer.stop()
+    return presses / (time.perf_counter() - started)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--presses', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=10, help='per-row writers (pool size)')
+    args = parser.parse_args()
+
+    await async_connection_pool.create_pool(max_size=args.concurrency)
+    try:
+        await prepare()
+        print(f"{'mode':<22}{'intakes/s':>12}")
+        print(f"{'per-row INSERT':<22}{await per_row(args.presses, args.concurrency):>12.0f}")
+        for batch in (10, 100, 1000):
+            print(f"{f'buffer, batch {batch}':<22}{await buffered(args.presses, batch):>12.0f}")
+    finally:
+        await cleanup()
+        await async_connection_pool.close_pool()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,191 @@
+"""intakes before (migration 0007) and after monthly partitioning, and archival.
+
+Both schemas get the same --rows intakes spread over the last --months
+months. Times a user's last 30 days and full history, VACUUM after a
+day of new intakes (plain, and aggressive as in an anti-wraparound run,
+which reads every page), then archives all but the last --live-months of
+the partitioned schema to a temporary directory and reads histories
+back across the archives and the live partitions, checking every sampled
+history against the unpartitioned table.
+
+Run: python -m benchmarks.partition_benchmark --rows 5000000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+import psycopg2
+
+from db.connection_pool import database_uri
+from db.database import get_cursor
+import db.intake_archive as intake_archive
+import db.intake_partitions as intake_partitions
+import db.migrations as migrations
+from benchmarks.common import create_schema, use_schema, drop_schemas, percentile
+
+
+SCHEMAS = (('bench_unpartitioned', 7), ('bench_partitioned', None))
+HISTORY = """SELECT medicine_name, taken_at, status FROM {table}
+WHERE user_id = %s AND taken_at >= COALESCE(%s, '-infinity'::TIMESTAMPTZ) ORDER BY taken_at"""
+LIVE_HISTORY = HISTORY.format(table='intakes')
+# what the partitioned schema's archives and live partitions together must match
+EXPECTED_HISTORY = HISTORY.format(table='bench_unpartitioned.intakes')
+
+FILL = """
+ALTER TABLE intakes DISABLE TRIGGER intakes_roll_up;
+INSERT INTO users (user_tg_id, timezone)
+SELECT 100000 + u, 'UTC' FROM generate_series(1, %(users)s) AS u;
+INSERT INTO intakes (user_id, medicine_name, taken_at, status)
+SELECT 100000 + 1 + i %% %(users)s,
+       'medicine_' || (1 + i %% 3),
+       %(now)s - INTERVAL '1 day' - (%(months)s * INTERVAL '30 days') * (i::FLOAT8 / %(rows)s),
+       CASE WHEN i %% 7 = 0 THEN 'skipped' ELSE 'done' END
+FROM generate_series(1, %(rows)s) AS i;
+ALTER TABLE intakes ENABLE TRIGGER intakes_roll_up;
+"""
+PARTITION_FILL_RANGE = """SELECT ensure_intake_partitions(((%(now)s - %(months)s * INTERVAL '30 days' - INTERVAL '1 day')
+                                                    AT TIME ZONE 'UTC')::DATE,
+                                                   (%(now)s AT TIME ZONE 'UTC')::DATE);"""
+# a day's worth of new intakes, as the bot would write them
+ADD_DAY = """INSERT INTO intakes (user_id, medicine_name, taken_at, status)
+SELECT 100000 + 1 + i %% %(users)s, 'medicine_1', %(now)s - INTERVAL '1 day' * (i::FLOAT8 / %(day_rows)s), 'done'
+FROM generate_series(1, %(day_rows)s) AS i;"""
+CURRENT_PARTITION = """SELECT child.relname
+FROM pg_inherits
+JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid
+WHERE pg_inherits.inhparent = 'intakes'::regclass
+  AND child.relname = 'intakes_y' || to_char(now() AT TIME ZONE 'UTC', 'YYYY') || 'm' || to_char(now() AT TIME ZONE 'UTC', 'MM');"""
+TABLE_SIZE = """SELECT sum(pg_total_relation_size(oid)) FROM pg_class
+WHERE relkind IN ('r', 'p') AND relname LIKE 'intakes%%' AND relnamespace = current_schema()::REGNAMESPACE;"""
+
+
+def build(connection, schema: str, target, sizes: dict):
+    create_schema(connection, schema)
+    migrations.migrate(connection, target=target)
+    started = time.perf_counter()
+    with get_cursor(connection) as cursor:
+        if target is None:
+            cursor.execute(PARTITION_FILL_RANGE, sizes)
+        cursor.execute(FILL, sizes)
+    print(f"{schema}: filled {sizes['rows']} intakes in {time.perf_counter() - started:.1f}s")
+    vacuum(connection, 'VACUUM (FREEZE, ANALYZE)')
+
+
+def vacuum(connection, command: str) -> float:
+    connection.autocommit = True
+    try:
+        with connection.cursor() as cursor:
+            started = time.perf_counter()
+            cursor.execute(command)
+            return time.perf_counter() - started
+    finally:
+        connection.autocommit = False
+
+
+def time_histories(connection, users, since):
+    timings = []
+    with get_cursor(connection) as cursor:
+        for user_id in users:
+            started = time.perf_counter()
+            cursor.execute(LIVE_HISTORY, (user_id, since))
+            cursor.fetchall()
+            timings.append((time.perf_counter() - started) * 1000)
+    return percentile(timings, 0.5), percentile(timings, 0.99)
+
+
+def time_vacuum(connection, schema: str, sizes: dict):
+    use_schema(connection, schema)
+    with get_cursor(connection) as cursor:
+        cursor.execute(ADD_DAY, sizes)
+        cursor.execute(CURRENT_PARTITION)
+        row = cursor.fetchone()
+    table = row[0] if row else 'intakes'
+    plain = vacuum(connection, f'VACUUM (ANALYZE) {table}')
+    aggressive = vacuum(connection, f'VACUUM (FREEZE, DISABLE_PAGE_SKIPPING) {table}')
+    return table, plain, aggressive
+
+
+def read_archived_history(archive_dir: str, user_id: int):
+    rows = []
+    for archive in intake_archive.list_archives(archive_dir):
+        rows.extend(intake_archive.read_user_intakes(archive, user_id))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=5_000_000, help='intake rows')
+    parser.add_argument('--users', type=int, default=20_000)
+    parser.add_argument('--months', type=int, default=24, help='months of history')
+    parser.add_argument('--live-months', type=int, default=3, help='months left in the database after archival')
+    parser.add_argument('--samples', type=int, default=200, help='users whose history is read')
+    parser.add_argument('--keep', action='store_true', help='keep the benchmark schemas afterwards')
+    args = parser.parse_args()
+    now = datetime.now(timezone.utc)
+    sizes = {'rows': args.rows, 'users': args.users, 'months': args.months,
+             'day_rows': args.rows // (args.months * 30), 'now': now}
+    random.seed(42)
+    users = [100000 + random.randint(1, args.users) for _ in range(args.samples)]
+
+    connection = psycopg2.connect(database_uri)
+    try:
+        report = {}
+        for schema, target in SCHEMAS:
+            build(connection, schema, target, sizes)
+            recent = time_histories(connection, users, since=now - timedelta(days=30))
+            full = time_histories(connection, users, since=None)
+            with get_cursor(connection) as cursor:
+                cursor.execute(TABLE_SIZE)
+                size = cursor.fetchone()[0]
+            report[schema] = (recent, full, time_vacuum(connection, schema, sizes), size)
+
+        print(f"\n{'':<34}{'unpartitioned':>18}{'partitioned':>18}")
+        (old_recent, old_full, old_vacuum, old_size), (recent, full, new_vacuum, size) = (
+            report[schema] for schema, _ in SCHEMAS)
+        print(f"{'last 30 days p50 / p99 (ms)':<34}{old_recent[0]:>9.2f}{old_recent[1]:>9.2f}{recent[0]:>9.2f}{recent[1]:>9.2f}")
+        print(f"{'full history p50 / p99 (ms)':<34}{old_full[0]:>9.2f}{old_full[1]:>9.2f}{full[0]:>9.2f}{full[1]:>9.2f}")
+        print(f"{'VACUUM after a day (ms)':<34}{old_vacuum[1] * 1000:>18.1f}{new_vacuum[1] * 1000:>18.1f}")
+        print(f"{'aggressive VACUUM (ms)':<34}{old_vacuum[2] * 1000:>18.1f}{new_vacuum[2] * 1000:>18.1f}")
+        print(f"{'vacuumed table':<34}{old_vacuum[0]:>18}{new_vacuum[0]:>18}")
+        print(f"{'intakes on disk (MiB)':<34}{old_size / 2 ** 20:>18.1f}{size / 2 ** 20:>18.1f}")
+
+        with tempfile.TemporaryDirectory() as archive_dir:
+            use_schema(connection, 'bench_partitioned')
+            started = time.perf_counter()
+            archived = intake_partitions.archive_old_partitions(connection, archive_dir, args.live_months)
+            elapsed = time.perf_counter() - started
+            with get_cursor(connection) as cursor:
+                cursor.execute(TABLE_SIZE)
+                live_size = cursor.fetchone()[0]
+            archive_size = sum(os.path.getsize(os.path.join(archive_dir, name)) for name in os.listdir(archive_dir))
+            rows = sum(intake_archive.read_archive_index(archive)['rows']
+                       for archive in intake_archive.list_archives(archive_dir))
+            print(f"\narchived {len(archived)} months, {rows} intakes in {elapsed:.1f}s ({rows / elapsed:,.0f} rows/s): "
+                  f"{archive_size / 2 ** 20:.1f} MiB of files, {live_size / 2 ** 20:.1f} MiB left in the database")
+
+            timings, wrong = [], 0
+            for user_id in users:
+                started = time.perf_counter()
+                history = read_archived_history(archive_dir, user_id)
+                timings.append((time.perf_counter() - started) * 1000)
+                with get_cursor(connection) as cursor:
+                    cursor.execute(LIVE_HISTORY, (user_id, None))
+                    history.extend(cursor.fetchall())
+                    cursor.execute(EXPECTED_HISTORY, (user_id, None))
+                    expected = cursor.fetchall()
+                if history != expected:
+                    wrong += 1
+            p50, p99 = percentile(timings, 0.5), percentile(timings, 0.99)
+            print(f"user's archived months read back: p50 {p50:.2f}ms, p99 {p99:.2f}ms; "
+                  f"{wrong} of {len(users)} histories differ from the unpartitioned table")
+    finally:
+        connection.close()
+        if not args.keep:
+            drop_schemas(*(schema for schema, _ in SCHEMAS))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""Per-query latency of the legacy (migration 0001) and current schema.
+
+Both schemas are built side by side in the database from DATABASE_URI,
+filled with the same synthetic data and queried with the statements the
+bot runs. Run: python -m benchmarks.schema_benchmark --rows 10000000
+"""
+import argparse
+import random
+import time
+
+import psycopg2
+
+from db.connection_pool import database_uri
+from db.database import get_cursor
+import db.database as database
+import db.migrations as migrations
+from benchmarks.common import create_schema, drop_schemas, percentile
+
+
+LEGACY_QUERIES = {
+    'user intakes': "SELECT medicine_name, date, status FROM intakes WHERE user_id = %s::TEXT",
+    'user medicine intakes': "SELECT date, status FROM intakes WHERE user_id = %s::TEXT AND medicine_name = %s",
+    'list medicines': "SELECT medicine_name, schedule FROM medicines where user_id = %s::TEXT;",
+    'acknowledge reminder': """UPDATE pending_reminders SET acknowledged_at = now()
+WHERE medicine_name = %s AND user_id = %s::TEXT AND acknowledged_at IS NULL;""",
+}
+CURRENT_QUERIES = {
+    'user intakes': database.GET_USER_INTAKES,
+    'user medicine intakes': "SELECT taken_at, status FROM intakes WHERE user_id = %s AND medicine_name = %s",
+    'list medicines': database.LIST_ALL_MEDICINE,
+    'acknowledge reminder': database.ACKNOWLEDGE_REMINDER,
+}
+
+FILL_LEGACY = """
+INSERT INTO users (user_tg_id, timezone)
+SELECT (100000 + u)::TEXT, 'Europe/Moscow' FROM generate_series(1, %(users)s) AS u;
+INSERT INTO medicines (medicine_name, user_id, schedule)
+SELECT 'medicine_' || m, (100000 + u)::TEXT, '08:00,20:00'
+FROM generate_series(1, %(users)s) AS u, generate_series(1, %(medicines)s) AS m;
+INSERT INTO pending_reminders (medicine_name, user_id, chat_id, next_nag_at)
+SELECT medicine_name, user_id, user_id::BIGINT, now() FROM medicines;
+INSERT INTO intakes (user_id, medicine_name, date, status)
+SELECT (100000 + 1 + i %% %(users)s)::TEXT,
+       'medicine_' || (1 + i %% %(medicines)s),
+       to_char(now() - (i || ' minutes')::INTERVAL, 'HH24:MI YYYY-MM-DD'),
+       CASE WHEN i %% 7 = 0 THEN 'skipped' ELSE 'done' END
+FROM generate_series(1, %(rows)s) AS i;
+ANALYZE;
+"""
+FILL_CURRENT = """
+INSERT INTO users (user_tg_id, timezone)
+SELECT 100000 + u, 'Europe/Moscow' FROM generate_series(1, %(users)s) AS u;
+INSERT INTO medicines (medicine_name, user_id, schedule)
+SELECT 'medicine_' || m, 100000 + u, '08:00,20:00'
+FROM generate_series(1, %(users)s) AS u, generate_series(1, %(medicines)s) AS m;
+INSERT INTO pending_reminders (medicine_id, medicine_name, user_id, chat_id, next_nag_at)
+SELECT id, medicine_name, user_id, user_id, now() FROM medicines;
+INSERT INTO intakes (user_id, medicine_name, taken_at, status)
+SELECT 100000 + 1 + i %% %(users)s,
+       'medicine_' || (1 + i %% %(medicines)s),
+       now() - (i || ' minutes')::INTERVAL,
+       CASE WHEN i %% 7 = 0 THEN 'skipped' ELSE 'done' END
+FROM generate_series(1, %(rows)s) AS i;
+ANALYZE;
+"""
+
+
+def build_schema(connection, schema: str, target, fill: str, sizes: dict):
+    create_schema(connection, schema)
+    migrations.migrate(connection, target=target)
+    started = time.perf_counter()
+    with get_cursor(connection) as cursor:
+        cursor.execute(fill, sizes)
+    print(f"{schema}: filled {sizes['rows']} intakes in {time.perf_counter() - started:.1f}s")
+
+
+def time_queries(connection, queries: dict, sizes: dict, samples: int):
+    results = {}
+    random.seed(42)
+    with get_cursor(connection) as cursor:
+        for name, query in queries.items():
+            timings = []
+            for _ in range(samples):
+                user_id = 100000 + random.randint(1, sizes['users'])
+                medicine_name = f"medicine_{random.randint(1, sizes['medicines'])}"
+                if name == 'user medicine intakes':
+                    params = (user_id, medicine_name)
+                elif name == 'acknowledge reminder':
+                    params = (medicine_name, user_id)
+                else:
+                    params = (user_id,)
+                started = time.perf_counter()
+                cursor.execute(query, params)
+                if cursor.description is not None:
+                    cursor.fetchall()
+                timings.append((time.perf_counter() - started) * 1000)
+            results[name] = (percentile(timings, 0.5), percentile(timings, 0.99))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10_000_000, help='intake rows')
+    parser.add_argument('--users', type=int, default=100_000)
+    parser.add_argument('--medicines', type=int, default=3, help='medicines per user')
+    parser.add_argument('--samples', type=int, default=200, help='queries timed per statement')
+    parser.add_argument('--keep', action='store_true', help='keep the benchmark schemas afterwards')
+    args = parser.parse_args()
+    sizes = {'rows': args.rows, 'users': args.users, 'medicines': args.medicines}
+
+    connection = psycopg2.connect(database_uri)
+    try:
+        report = {}
+        for schema, target, fill, queries in (('bench_legacy', 1, FILL_LEGACY, LEGACY_QUERIES),
+                                              ('bench_current', None, FILL_CURRENT, CURRENT_QUERIES)):
+            build_schema(connection, schema, target, fill, sizes)
+            report[schema] = time_queries(connection, queries, sizes, args.samples)
+
+        print(f"\n{'query':<24}{'legacy p50':>12}{'p99':>10}{'current p50':>14}{'p99':>10}   (ms)")
+        for name in LEGACY_QUERIES:
+            legacy, current = report['bench_legacy'][name], report['bench_current'][name]
+            print(f"{name:<24}{legacy[0]:>12.3f}{legacy[1]:>10.3f}{current[0]:>14.3f}{current[1]:>10.3f}")
+    finally:
+        connection.close()
+        if not args.keep:
+            drop_schemas('bench_legacy', 'bench_current')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""Sharded reminder ownership: balance, failover and duplicate sends across workers.
+
+Builds a throwaway schema, gives every user one dose in a window of
+--minutes minutes and starts --workers reminder dispatchers with their own
+shard leases in this process. The window is ticked through as fast as
+possible, each tick preceded by a heartbeat. Halfway through, one worker
+stops heartbeating as if it had been killed, and the others take its
+shards over once its leases expire. Every dose must be sent exactly once.
+
+Run: python -m benchmarks.sharding_benchmark --users 20000 --workers 4
+"""
+import argparse
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+
+import asyncpg
+import psycopg2
+
+import db.async_connection_pool as async_connection_pool
+from db.async_connection_pool import database_uri
+from db.database import get_cursor
+import db.migrations as migrations
+from bot_logic.reminder_dispatcher import ReminderDispatcher, get_utc_minute_of_day
+from bot_logic.shard_leases import ShardLeases
+from benchmarks.common import create_schema, drop_schemas, RecordingQueue
+
+
+SCHEMA = 'bench_sharding'
+FIRST_USER_ID = 100000
+
+FILL = """
+INSERT INTO users (user_tg_id, timezone)
+SELECT %(first)s + u, 'UTC' FROM generate_series(0, %(users)s - 1) AS u;
+INSERT INTO medicines (medicine_name, user_id, schedule)
+SELECT 'medicine', %(first)s + u, '08:00' FROM generate_series(0, %(users)s - 1) AS u;
+INSERT INTO schedules (medicine_id, medicine_name, user_id, chat_id, timezone, local_minute)
+SELECT id, medicine_name, user_id, user_id, 'UTC', (%(first_minute)s + (user_id - %(first)s) %% %(minutes)s) %% 1440 FROM medicines;
+"""
+
+
+def build(sizes: dict):
+    connection = psycopg2.connect(database_uri)
+    try:
+        create_schema(connection, SCHEMA)
+        migrations.migrate(connection)
+        with get_cursor(connection) as cursor:
+            cursor.execute(FILL, sizes)
+    finally:
+        connection.close()
+
+
+async def heartbeat_until_balanced(workers, shard_count: int) -> int:
+    rounds = 0
+    while True:
+        rounds += 1
+        for worker in workers:
+            await worker.rebalance()
+        owned = [len(worker.shards.owned) for worker in workers]
+        if sum(owned) == shard_count and max(owned) - min(owned) <= 1:
+            return rounds
+
+
+async def run(args, start: datetime):
+    async_connection_pool.pool = await asyncpg.create_pool(database_uri, min_size=1, max_size=args.workers * 2,
+                                                           server_settings={'search_path': SCHEMA})
+    queue = RecordingQueue()
+    workers = [ReminderDispatcher(queue, ShardLeases(shard_count=args.shards, lease_ttl=timedelta(seconds=args.ttl)))
+               for _ in range(args.workers)]
+    try:
+        started = time.perf_counter()
+        rounds = await heartbeat_until_balanced(workers, args.shards)
+        print(f"balanced {args.shards} shards over {args.workers} workers "
+              f"in {rounds} heartbeat rounds, {time.perf_counter() - started:.2f}s")
+
+        half = args.minutes // 2
+        started = time.perf_counter()
+        for minute in range(half):
+            for worker in workers:
+                await worker.rebalance()
+                await worker.tick(start + timedelta(minutes=minute))
+        tick_time = time.perf_counter() - started
+
+        killed, survivors = workers[0], workers[1:]
+        killed_at = time.perf_counter()
+        while True:
+            await asyncio.sleep(args.ttl / 3)
+            for worker in survivors:
+                await worker.rebalance()
+            if sum(len(worker.shards.owned) for worker in survivors) == args.shards:
+                break
+        failover = time.perf_counter() - killed_at
+        print(f"survivors took over the killed worker's shards in {failover:.2f}s (lease ttl {args.ttl}s)")
+
+        started = time.perf_counter()
+        for minute in range(half, args.minutes):
+            for worker in workers:
+                # the killed worker still ticks: its expired leases must keep it quiet
+                if worker is not killed:
+                    await worker.rebalance()
+                await worker.tick(start + timedelta(minutes=minute))
+        tick_time += time.perf_counter() - started
+    finally:
+        for worker in workers[1:]:
+            await worker.stop()
+        await workers[0].listener.close()
+        await async_connection_pool.close_pool()
+
+    duplicates = sum(1 for count in queue.sent.values() if count > 1)
+    missed = args.users - len(queue.sent)
+    print(f"doses sent {queue.total} of {args.users}: {duplicates} duplicated, {missed} missed")
+    print(f"{args.minutes * args.workers} ticks took {tick_time:.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=20_000)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--shards', type=int, default=16)
+    parser.add_argument('--minutes', type=int, default=20, help='width of the dose window')
+    parser.add_argument('--ttl', type=float, default=3, help='lease ttl, seconds')
+    args = parser.parse_args()
+    start = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+    sizes = {'users': args.users, 'first': FIRST_USER_ID, 'minutes': args.minutes,
+             'first_minute': get_utc_minute_of_day(start)}
+
+    build(sizes)
+    try:
+        asyncio.run(run(args, start))
+    finally:
+        drop_schemas(SCHEMA)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""Startup rehydration of the reminder schedule and catch-up after downtime.
+
+Builds a throwaway schema with --schedules doses and times three ways of
+getting them back into memory: one APScheduler cron job per dose (how
+reminders were scheduled before the minute dispatcher, on a sample of
+--apscheduler-jobs doses), the dispatcher's streaming load, and a
+sharded load through shard leases. Then it pretends
+the bot was down for --downtime minutes and counts what the first tick
+sends under each catch-up policy.
+
+Run: python -m benchmarks.startup_benchmark --schedules 100000
+"""
+import argparse
+import asyncio
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+import asyncpg
+import psycopg2
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+import db.async_connection_pool as async_connection_pool
+from db.async_connection_pool import database_uri, get_connection
+from db.async_database import list_all_schedules
+from db.database import get_cursor
+import db.migrations as migrations
+from bot_logic.reminder_dispatcher import ReminderDispatcher, CATCH_UP_POLICIES
+from bot_logic.shard_leases import ShardLeases
+from benchmarks.common import create_schema, drop_schemas, RecordingQueue
+
+
+SCHEMA = 'bench_startup'
+FIRST_USER_ID = 100000
+
+# three doses a day per medicine, two medicines per user
+FILL = """
+INSERT INTO users (user_tg_id, timezone)
+SELECT %(first)s + u, 'UTC' FROM generate_series(0, %(users)s - 1) AS u;
+INSERT INTO medicines (medicine_name, user_id, schedule)
+SELECT 'medicine_' || m, %(first)s + u, '' FROM generate_series(0, %(users)s - 1) AS u, generate_series(1, 2) AS m;
+INSERT INTO schedules (medicine_id, medicine_name, user_id, chat_id, timezone, local_minute)
+SELECT id, medicine_name, user_id, user_id, 'UTC', (id * 7 + dose * 480) %% 1440
+FROM medicines, generate_series(0, 2) AS dose;
+"""
+
+
+def build(schedules: int):
+    connection = psycopg2.connect(database_uri)
+    try:
+        create_schema(connection, SCHEMA)
+        migrations.migrate(connection)
+        with get_cursor(connection) as cursor:
+            cursor.execute(FILL, {'first': FIRST_USER_ID, 'users': max(schedules // 6, 1)})
+    finally:
+        connection.close()
+
+
+async def measure(name: str, load, memory: bool = True):
+    started = time.perf_counter()
+    loaded = await load()
+    elapsed = time.perf_counter() - started
+    peak = ''
+    if memory:
+        # a second run under tracemalloc, which would skew the timing
+        tracemalloc.start()
+        await load()
+        peak = f"{tracemalloc.get_traced_memory()[1] / 2 ** 20:.1f}"
+        tracemalloc.stop()
+    print(f"{name:<28}{loaded:>10}{elapsed:>10.2f}{peak:>12}")
+
+
+async def apscheduler_jobs(limit: int):
+    scheduler = AsyncIOScheduler(timezone='UTC')
+    async with get_connection() as connection:
+        rows = await list_all_schedules(connection)
+    rows = rows[:limit]
+    for row in rows:
+        scheduler.add_job(print, trigger='cron', hour=row['local_minute'] // 60, minute=row['local_minute'] % 60,
+                          timezone=row['timezone'], id=str(row['id']))
+    scheduler.start()
+    scheduler.shutdown(wait=False)
+    return len(rows)
+
+
+async def streaming_load():
+    dispatcher = ReminderDispatcher(RecordingQueue())
+    await dispatcher.load()
+    return len(dispatcher)
+
+
+async def sharded_load():
+    dispatcher = ReminderDispatcher(RecordingQueue(), ShardLeases(shard_count=16, lease_ttl=timedelta(seconds=30)))
+    await dispatcher.load()
+    loaded = len(dispatcher)
+    await dispatcher.stop()
+    return loaded
+
+
+async def catch_up(policy: str, downtime: timedelta, window: timedelta) -> int:
+    now = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+    async with get_connection() as connection:
+        await connection.execute("UPDATE scheduler_shards SET owner = NULL, lease_until = '-infinity', fired_until = $1",
+                                 now - downtime)
+    queue = RecordingQueue()
+    dispatcher = ReminderDispatcher(queue, ShardLeases(shard_count=16, lease_ttl=timedelta(seconds=30)),
+                                    catch_up=policy, catch_up_window=window)
+    await dispatcher.load()
+    await dispatcher.tick(now)
+    await dispatcher.stop()
+    return queue.total
+
+
+async def run(args):
+    async_connection_pool.pool = await asyncpg.create_pool(database_uri, server_settings={'search_path': SCHEMA})
+    try:
+        print(f"{'load':<28}{'doses':>10}{'seconds':>10}{'peak MiB':>12}")
+        if args.apscheduler_jobs:
+            # adding jobs gets slower the more there are, so this is kept to a sample
+            await measure('APScheduler job per dose', lambda: apscheduler_jobs(args.apscheduler_jobs), memory=False)
+        await measure('dispatcher, streaming', streaming_load)
+        await measure('dispatcher, 16 shards', sharded_load)
+        downtime = timedelta(minutes=args.downtime)
+        window = timedelta(minutes=args.window)
+        print(f"\nfirst tick after {args.downtime} minutes of downtime (window {args.window} minutes)")
+        for policy in CATCH_UP_POLICIES:
+            print(f"{policy:<28}{await catch_up(policy, downtime, window):>10} sent")
+    finally:
+        await async_connection_pool.close_pool()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--schedules', type=int, default=100_000)
+    parser.add_argument('--downtime', type=int, default=90, help='minutes')
+    parser.add_argument('--apscheduler-jobs', type=int, default=10_000, help='cron jobs to add for comparison, 0 to skip')
+    parser.add_argument('--window', type=int, default=60, help='catch-up window, minutes')
+    args = parser.parse_args()
+
+    build(args.schedules)
+    try:
+        asyncio.run(run(args))
+    finally:
+        drop_schemas(SCHEMA)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Blocking connection pool under a burst of threads and across a database restart.
+
+--threads threads each run --queries short queries through psycopg2's
+SimpleConnectionPool (what db.connection_pool used to be) and through
+db.connection_pool.ConnectionPool, both capped at --max-size connections.
+Then every backend of each pool is terminated, as a Postgres restart
+would, and the same burst runs again.
+
+Run: python -m benchmarks.sync_pool_benchmark --threads 50 --max-size 10
+"""
+import argparse
+import threading
+import time
+from collections import Counter
+
+import psycopg2
+from psycopg2.pool import SimpleConnectionPool
+
+from db.connection_pool import ConnectionPool, database_uri
+
+
+QUERY = 'SELECT pg_sleep(0.01)'
+TERMINATE_BACKENDS = """SELECT count(pg_terminate_backend(pid)) FROM pg_stat_activity
+WHERE datname = current_database() AND pid <> pg_backend_pid() AND backend_type = 'client backend'
+AND application_name = %s"""
+
+
+def burst(pool, threads: int, queries: int) -> Counter:
+    outcomes = Counter()
+    lock = threading.Lock()
+
+    def work():
+        for _ in range(queries):
+            connection = None
+            try:
+                connection = pool.getconn()
+                with connection.cursor() as cursor:
+                    cursor.execute(QUERY)
+                connection.rollback()
+                outcome = 'ok'
+            except psycopg2.pool.PoolError:
+                outcome = 'pool exhausted'
+            except psycopg2.Error:
+                outcome = 'dead connection'
+            finally:
+                if connection is not None:
+                    pool.putconn(connection)
+            with lock:
+                outcomes[outcome] += 1
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return outcomes
+
+
+def terminate(application_name: str) -> int:
+    connection = psycopg2.connect(database_uri)
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(TERMINATE_BACKENDS, (application_name,))
+            return cursor.fetchone()[0]
+    finally:
+        connection.close()
+
+
+def run(name: str, pool, application_name: str, args):
+    for phase in ('burst', 'after restart'):
+        if phase == 'after restart':
+            terminated = terminate(application_name)
+            phase = f'after restart ({terminated} killed)'
+        started = time.perf_counter()
+        outcomes = burst(pool, args.threads, args.queries)
+        elapsed = time.perf_counter() - started
+        print(f"{name:<22}{phase:<26}{elapsed:>7.2f}s  " + ', '.join(f'{k} {v}' for k, v in sorted(outcomes.items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=50)
+    parser.add_argument('--queries', type=int, default=20, help='per thread')
+    parser.add_argument('--max-size', type=int, default=10)
+    args = parser.parse_args()
+
+    # minconn = maxconn, or it closes every connection above one on return
+    simple = SimpleConnectionPool(args.max_size, args.max_size, dsn=database_uri, application_name='bench_simple_pool')
+    run('SimpleConnectionPool', simple, 'bench_simple_pool', args)
+    simple.closeall()
+
+    # check_after=0 pings every checkout, so dead connections never reach a caller
+    separator = '&' if '?' in database_uri else '?'
+    pool = ConnectionPool(f'{database_uri}{separator}application_name=bench_pool', max_size=args.max_size,
+                          check_after=0)
+    run('ConnectionPool', pool, 'bench_pool', args)
+    stats = pool.stats()
+    pool.closeall()
+    print(f"\nConnectionPool: {stats['checkouts']} checkouts, {stats['waits']} waited "
+          f"(mean {stats['wait_seconds_total'] / max(stats['waits'], 1) * 1000:.1f} ms, "
+          f"max {stats['wait_seconds_max'] * 1000:.1f} ms), {stats['discarded']} dead connections replaced, "
+          f"{stats['timeouts']} timeouts")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""Webhook load test: POSTs synthetic updates to the webhook app and times the handlers.
+
+Every virtual user walks /start, adds a medicine with one dose time, lists
+its medicines and presses Done, one update at a time. The webhook answers
+only after the handlers finish, so request latency is handler latency.
+Outgoing Bot API calls go to a local fake server. Client, bot and fake
+server share one event loop, so the numbers are a lower bound.
+
+Run: python -m benchmarks.webhook_benchmark --users 500 --concurrency 10
+"""
+import argparse
+import asyncio
+import time
+from typing import List
+
+import aiohttp
+from aiohttp import web
+
+import db.async_connection_pool as async_connection_pool
+from db.async_connection_pool import get_connection
+from db.async_database import add_user
+from db.cache import user_profiles, medicine_lists
+import bot_logic.utils as utils
+from bot_logic.reminder_bot import dp, reminder_bot, intake_buffer
+from bot_logic.webhook import make_webhook_app, SECRET_TOKEN_HEADER, WEBHOOK_PATH
+from benchmarks.common import percentile
+from benchmarks.fake_bot_api import FakeBotAPI, message_update, callback_update
+
+
+FIRST_USER_ID = 900_000_000
+SECRET = 'benchmark-secret'
+MEDICINE_NAME = 'aspirin'
+
+
+def conversation(user_id: int) -> List[dict]:
+    return [message_update(user_id, '/start'),
+            message_update(user_id, utils.DEFAULT_ADD_BUTTON),
+            message_update(user_id, MEDICINE_NAME),
+            message_update(user_id, '1'),
+            message_update(user_id, '08:00'),
+            message_update(user_id, utils.DEFAULT_LIST_BUTTON),
+            callback_update(user_id, f'button_done_{user_id}_{MEDICINE_NAME}')]
+
+
+async def prepare(users: int):
+    async with get_connection() as connection:
+        for user_id in range(FIRST_USER_ID, FIRST_USER_ID + users):
+            await add_user(connection, user_id, 'Europe/Moscow')
+
+
+async def cleanup(users: int):
+    await intake_buffer.stop()
+    await dp.storage.close()
+    async with get_connection() as connection:
+        await connection.execute("DELETE FROM users WHERE user_tg_id >= $1 AND user_tg_id < $2",
+                                 FIRST_USER_ID, FIRST_USER_ID + users)
+        await connection.execute("DELETE FROM fsm_states WHERE user_id >= $1", FIRST_USER_ID)
+    user_profiles.clear()
+    medicine_lists.clear()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=10, help='users sending updates at the same time')
+    parser.add_argument('--pool-size', type=int, default=10)
+    args = parser.parse_args()
+
+    fake_api = FakeBotAPI()
+    await fake_api.start()
+    reminder_bot.server = fake_api.server
+    await async_connection_pool.create_pool(max_size=args.pool_size)
+    runner = web.AppRunner(make_webhook_app(dp, SECRET), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    url = f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}{WEBHOOK_PATH}'
+    latencies = []
+    try:
+        await prepare(args.users)
+        intake_buffer.start()
+        async with aiohttp.ClientSession(headers={SECRET_TOKEN_HEADER: SECRET}) as session:
+            async with session.post(url, json=message_update(FIRST_USER_ID, '/start'),
+                                    headers={SECRET_TOKEN_HEADER: 'wrong'}) as response:
+                assert response.status == 401, f"bad secret was accepted with {response.status}"
+
+            async def run_user(user_id: int):
+                for update in conversation(user_id):
+                    started = time.perf_counter()
+                    async with session.post(url, json=update) as response:
+                        await response.read()
+                        assert response.status == 200, await response.text()
+                    latencies.append(time.perf_counter() - started)
+
+            users = iter(range(FIRST_USER_ID, FIRST_USER_ID + args.users))
+
+            async def worker():
+                for user_id in users:
+                    await run_user(user_id)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+            elapsed = time.perf_counter() - started
+    finally:
+        await cleanup(args.users)
+        await runner.cleanup()
+        await async_connection_pool.close_pool()
+        await fake_api.stop()
+        await (await reminder_bot.get_session()).close()
+
+    print(f"updates      {len(latencies)}")
+    print(f"updates/s    {len(latencies) / elapsed:.0f}")
+    print(f"p50          {percentile(latencies, 0.5) * 1000:.2f} ms")
+    print(f"p99          {percentile(latencies, 0.99) * 1000:.2f} ms")
+    print(f"api calls    {sum(fake_api.calls.values())}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,74 @@
+"""callback_data of the Done/Skip buttons under a reminder.
+
+Telegram hands callback_data back verbatim and caps it at 64 bytes. A
+button carries a format version, an action code and the id of the
+pending_reminders row it answers, packed big-endian and base64url encoded
+without padding: 14 ASCII characters whatever the medicine is called.
+
+Reminders sent before this format have button_<action>_<user_id>_<medicine>
+buttons, which decode_legacy() still reads.
+"""
+import binascii
+import struct
+from typing import NamedTuple, Optional
+
+
+VERSION = 1
+ACTION_DONE = 1
+ACTION_SKIP = 2
+# intakes.status recorded for each action
+ACTION_STATUSES = {ACTION_DONE: 'done', ACTION_SKIP: 'skipped'}
+
+# version, action, pending_reminders.id
+LAYOUT = struct.Struct('>BBQ')
+ENCODED_LENGTH = (LAYOUT.size * 8 + 5) // 6
+PADDING = b'=' * (-ENCODED_LENGTH % 4)
+# binascii speaks the standard alphabet; translating is cheaper than base64.urlsafe_*
+TO_URLSAFE = bytes.maketrans(b'+/', b'-_')
+FROM_URLSAFE = bytes.maketrans(b'-_', b'+/')
+# the version byte and the high bits of the action fix the first two characters
+PREFIX = binascii.b2a_base64(LAYOUT.pack(VERSION, ACTION_DONE, 0))[:2].decode('ascii')
+
+LEGACY_PREFIX = 'button_'
+LEGACY_ACTIONS = {'done': ACTION_DONE, 'skip': ACTION_SKIP}
+
+
+class ReminderCallback(NamedTuple):
+    action: int
+    reminder_id: int
+
+
+class LegacyReminderCallback(NamedTuple):
+    action: int
+    user_id: int
+    medicine_name: str
+
+
+def encode(action: int, reminder_id: int) -> str:
+    encoded = binascii.b2a_base64(LAYOUT.pack(VERSION, action, reminder_id), newline=False)
+    return encoded[:ENCODED_LENGTH].translate(TO_URLSAFE).decode('ascii')
+
+
+def decode(data: str) -> Optional[ReminderCallback]:
+    """The button's action and reminder id, None for any other callback data."""
+    if len(data) != ENCODED_LENGTH or not data.startswith(PREFIX):
+        return None
+    try:
+        version, action, reminder_id = LAYOUT.unpack(
+            binascii.a2b_base64(data.encode('ascii').translate(FROM_URLSAFE) + PADDING))
+    except (binascii.Error, UnicodeEncodeError, struct.error):
+        return None
+    if version != VERSION or action not in ACTION_STATUSES:
+        return None
+    return ReminderCallback(action, reminder_id)
+
+
+def decode_legacy(data: str) -> Optional[LegacyReminderCallback]:
+    # the medicine name comes last and may itself contain '_'
+    parts = data.split('_', 3)
+    if len(parts) != 4 or not data.startswith(LEGACY_PREFIX) or not parts[2].isdigit():
+        return None
+    action = LEGACY_ACTIONS.get(parts[1])
+    if action is None:
+        return None
+    return LegacyReminderCallback(action, int(parts[2]), parts[3])
@@ -1,11 +1,12 @@
 import os
+import asyncio
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 import re
+from typing import Optional
 
-from aiogram import Bot, Dispatcher, types
+from aiogram import Bot, types
 from aiogram.dispatcher.filters.state import StatesGroup, State
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
 from dotenv import load_dotenv
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
@@ -13,21 +14,29 @@ from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from bot_logic.utils import (get_default_keyboard,
                              get_select_medicines_keyboard,
                              get_location_button,
-                             get_timezone,
-                             get_utc_hours_minutes_date)
+                             get_timezone)
 import bot_logic.utils as utils
-from db.database import (add_user,
-                         check_user_exists,
-                         add_medicine,
-                         add_medicine_job,
-                         add_intake,
-                         list_all_medicines,
-                         delete_medicine,
-                         get_user_timezone,
-                         get_medicine_jobs,
-                         get_interval_job,
-                         delete_interval_job)
-from db.connection_pool import get_connection
+import bot_logic.callback_codec as callback_codec
+from db.async_database import (add_user,
+                               cached_check_user_exists,
+                               add_medicine_with_schedules,
+                               cached_list_all_medicines,
+                               delete_medicine,
+                               cached_get_user_timezone,
+                               acknowledge_reminder,
+                               acknowledge_reminder_by_id)
+from db.async_connection_pool import get_connection
+from db.cache import user_profiles, medicine_lists
+from db.intake_buffer import IntakeBuffer
+from db.fsm_storage import PostgresStorage
+import db.intake_partitions as intake_partitions
+from bot_logic.reminder_dispatcher import ReminderDispatcher
+from bot_logic.timezone_calendar import normalize_timezone
+from bot_logic.send_queue import SendQueue
+from bot_logic.shard_leases import ShardLeases
+from bot_logic.update_pipeline import OrderedDispatcher
+import metrics
+from metrics.middleware import HandlerMetricsMiddleware
 
 
 logging.basicConfig(level=logging.INFO)
@@ -37,12 +46,81 @@ load_dotenv()
 TOKEN = os.environ['TOKEN']
 
 reminder_bot = Bot(token=TOKEN)
-dp = Dispatcher(reminder_bot, storage=MemoryStorage())
+dp = OrderedDispatcher(reminder_bot, storage=PostgresStorage())
+dp.middleware.setup(HandlerMetricsMiddleware())
 scheduler = AsyncIOScheduler(timezone=os.environ['SYSTEM_TIMEZONE'])
-if scheduler.running:
-    scheduler.shutdown()
-else:
-    scheduler.start()
+send_queue = SendQueue(reminder_bot)
+shard_leases = ShardLeases()
+reminder_dispatcher = ReminderDispatcher(send_queue,
+                                         shards=shard_leases,
+                                         catch_up=os.getenv('REMINDER_CATCH_UP') or 'latest',
+                                         catch_up_window=timedelta(
+                                             minutes=int(os.getenv('REMINDER_CATCH_UP_WINDOW') or 60)))
+intake_buffer = IntakeBuffer()
+# exports hold a pool connection for as long as they stream
+history_exports = asyncio.Semaphore(4)
+
+metrics.register_stats('send_queue', 'Reminder send queue', send_queue.stats)
+metrics.register_stats('update_pipeline', 'Incoming update queues', dp.pipeline.stats)
+metrics.register_stats('intake_buffer', 'Buffered intake writes', intake_buffer.stats)
+metrics.register_stats('fsm_storage', 'Conversation state cache', dp.storage.stats)
+metrics.register_stats('user_profiles_cache', 'User profile cache', user_profiles.stats)
+metrics.register_stats('medicine_lists_cache', 'Medicine list cache', medicine_lists.stats)
+metrics.register_stats('shard_leases', 'Reminder shards held by this worker', shard_leases.stats)
+
+
+async def maintain_intake_partitions():
+    # blocking psycopg2 and file writes, kept off the event loop
+    await asyncio.to_thread(intake_partitions.run_maintenance)
+
+
+async def start_reminders():
+    send_queue.start()
+    intake_buffer.start()
+    await reminder_dispatcher.load()
+    await reminder_dispatcher.listen()
+    scheduler.add_job(reminder_dispatcher.rebalance,
+                      trigger='interval',
+                      seconds=shard_leases.heartbeat_interval,
+                      id='shard_heartbeat',
+                      replace_existing=True,
+                      coalesce=True)
+    scheduler.add_job(reminder_dispatcher.tick,
+                      trigger='cron',
+                      minute='*',
+                      id='reminder_tick',
+                      replace_existing=True,
+                      coalesce=True,
+                      misfire_grace_time=60)
+    scheduler.add_job(reminder_dispatcher.sweep,
+                      trigger='interval',
+                      seconds=60,
+                      id='reminder_sweep',
+                      replace_existing=True,
+                      coalesce=True)
+    scheduler.add_job(reminder_dispatcher.purge,
+                      trigger='interval',
+                      hours=1,
+                      id='reminder_purge',
+                      replace_existing=True,
+                      coalesce=True)
+    scheduler.add_job(maintain_intake_partitions,
+                      trigger='interval',
+                      hours=24,
+                      id='intake_partitions',
+                      replace_existing=True,
+                      coalesce=True,
+                      next_run_time=datetime.now(scheduler.timezone))
+    if not scheduler.running:
+        scheduler.start()
+
+
+async def stop_reminders():
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+    await reminder_dispatcher.stop()
+    await send_queue.stop()
+    await intake_buffer.stop()
 
 
 class Setup(StatesGroup):
@@ -61,10 +139,9 @@ class Delete(StatesGroup):
 
 @dp.message_handler(commands=['start'])
 async def start(message: types.Message):
-    with get_connection() as connection:
-        if check_user_exists(connection, message.from_user.id):
-            await message.answer(utils.USER_ALREADY_EXISTS, reply_markup=get_default_keyboard())
-            return
+    if await cached_check_user_exists(message.from_user.id):
+        await message.answer(utils.USER_ALREADY_EXISTS, reply_markup=get_default_keyboard())
+        return
     await message.answer(utils.WELCOME_MESSAGE, reply_markup=get_location_button())
     await Setup.Location.set()
 
@@ -76,13 +153,13 @@ async def create_user_execute(message: types.Message, state: FSMContext):
         await Setup.Location.set()
         return
     user_id = message.from_user.id
-    timezone = get_timezone(longitude=message.location.longitude, latitude=message.location.latitude)
-    with get_connection() as connection:
-        add_user(connection, user_id, timezone)
-        await message.answer(utils.TIMEZONE_SUCCESS.format(timezone),
-                             reply_markup=get_default_keyboard(),
-                             parse_mode=types.ParseMode.MARKDOWN)
-        await state.finish()
+    timezone = await get_timezone(longitude=message.location.longitude, latitude=message.location.latitude)
+    async with get_connection() as connection:
+        await add_user(connection, user_id, timezone)
+    await message.answer(utils.TIMEZONE_SUCCESS.format(timezone),
+                         reply_markup=get_default_keyboard(),
+                         parse_mode=types.ParseMode.MARKDOWN)
+    await state.finish()
 
 
 @dp.message_handler(lambda message: message.text == utils.DEFAULT_ADD_BUTTON)
@@ -121,7 +198,7 @@ async def add_medicine_daily_intake_prompt(message: types.Message, state: FSMCon
 
 @dp.message_handler(state=Add.AddMedicineTime)
 async def add_medicine_time_prompt_and_execute(message: types.Message, state: FSMContext):
-    if not bool(re.match(r'^\d\d:\d\d$', message.text)):
+    if not bool(re.match(r'^([01]\d|2[0-3]):[0-5]\d$', message.text)):
         await message.reply(utils.USER_INPUT_SCHEDULE_TIME_CHECK)
         await Add.AddMedicineTime.set()
         return
@@ -132,64 +209,57 @@ async def add_medicine_time_prompt_and_execute(message: types.Message, state: FS
             await message.answer(utils.MEDICINE_SCHEDULED_TIME_PROMPT)
         else:
             user_id = message.from_user.id
-            with get_connection() as connection:
-                insertion_check = add_medicine(connection,
-                                               medicine_data['name'],
-                                               user_id,
-                                               ','.join(medicine_data['scheduled_time']))
-                if insertion_check != '':
-                    timezone = get_user_timezone(connection, user_id)
-                    chat_id = message.chat.id
-                    for time in medicine_data['scheduled_time']:
-                        hours, minutes, date = get_utc_hours_minutes_date(time, timezone)
-                        job = scheduler.add_job(utils.set_reminder_cron,
-                                                trigger='cron',
-                                                hour=hours,
-                                                minute=minutes,
-                                                start_date=date,
-                                                kwargs={'bot': reminder_bot,
-                                                        'chat_id': chat_id,
-                                                        'user_id': user_id,
-                                                        'medicine_name': medicine_data['name']})
-                        logger.info(f"Scheduled {job.id} job for {job.next_run_time}!")
-                        add_medicine_job(connection, medicine_data['name'], user_id, job.id)
-                    await message.answer(
-                        utils.MEDICINE_TOTAL_INFO.format(medicine_data['name'], medicine_data['scheduled_time']),
-                        reply_markup=get_default_keyboard(),
-                        parse_mode=types.ParseMode.MARKDOWN)
-                else:
-                    await message.answer(utils.MEDICINE_INSERTION_FAIL.format(medicine_data['name']),
-                                         reply_markup=get_default_keyboard())
+            chat_id = message.chat.id
+            async with get_connection() as connection:
+                timezone = normalize_timezone(await cached_get_user_timezone(user_id, connection))
+                rows = await add_medicine_with_schedules(connection,
+                                                         medicine_data['name'],
+                                                         user_id,
+                                                         chat_id,
+                                                         ','.join(medicine_data['scheduled_time']),
+                                                         timezone,
+                                                         [int(time[:2]) * 60 + int(time[3:])
+                                                          for time in medicine_data['scheduled_time']])
+            if rows:
+                reminder_dispatcher.add_rows(rows)
+                for row in rows:
+                    logger.info(f"Scheduled dose {row['id']} for {row['local_minute'] // 60:02d}:"
+                                f"{row['local_minute'] % 60:02d} {timezone}!")
+                await message.answer(
+                    utils.MEDICINE_TOTAL_INFO.format(medicine_data['name'], medicine_data['scheduled_time']),
+                    reply_markup=get_default_keyboard(),
+                    parse_mode=types.ParseMode.MARKDOWN)
+            else:
+                await message.answer(utils.MEDICINE_INSERTION_FAIL.format(medicine_data['name']),
+                                     reply_markup=get_default_keyboard())
 
             await state.finish()
 
 
 @dp.message_handler(lambda message: message.text == utils.DEFAULT_LIST_BUTTON)
 async def list_user_medicine_execute(message: types.Message):
-    with get_connection() as connection:
-        medicines = list_all_medicines(connection, message.from_user.id)
-        if not medicines:
-            await message.answer(utils.MEDICINE_NAMES_EMPTY, reply_markup=get_default_keyboard())
-        else:
-            medicines_scheduled = """"""
-            for medicine in medicines:
-                medicines_scheduled += utils.MEDICINE_NAME_WITH_SCHEDULE.format(medicine[0], medicine[1])
-            await message.answer(medicines_scheduled,
-                                 reply_markup=get_default_keyboard(),
-                                 parse_mode=types.ParseMode.MARKDOWN)
+    medicines = await cached_list_all_medicines(message.from_user.id)
+    if not medicines:
+        await message.answer(utils.MEDICINE_NAMES_EMPTY, reply_markup=get_default_keyboard())
+    else:
+        medicines_scheduled = """"""
+        for medicine in medicines:
+            medicines_scheduled += utils.MEDICINE_NAME_WITH_SCHEDULE.format(medicine[0], medicine[1])
+        await message.answer(medicines_scheduled,
+                             reply_markup=get_default_keyboard(),
+                             parse_mode=types.ParseMode.MARKDOWN)
 
 
 @dp.message_handler(lambda message: message.text == utils.DEFAULT_DELETE_BUTTON)
 async def delete_user_medicine_prompt(message: types.Message):
-    with get_connection() as connection:
-        medicines = list_all_medicines(connection, message.from_user.id)
-        medicine_names = [medicine[0] for medicine in medicines]
-        if not medicine_names:
-            await message.answer(utils.MEDICINE_NAMES_EMPTY)
-        else:
-            await message.answer(text=utils.MEDICINE_NAME_DELETE_PROMPT,
-                                 reply_markup=get_select_medicines_keyboard(medicine_names + ['Отменить']))
-            await Delete.DeleteMedicine.set()
+    medicines = await cached_list_all_medicines(message.from_user.id)
+    medicine_names = [medicine[0] for medicine in medicines]
+    if not medicine_names:
+        await message.answer(utils.MEDICINE_NAMES_EMPTY)
+    else:
+        await message.answer(text=utils.MEDICINE_NAME_DELETE_PROMPT,
+                             reply_markup=get_select_medicines_keyboard(medicine_names + ['Отменить']))
+        await Delete.DeleteMedicine.set()
 
 
 @dp.message_handler(state=Delete.DeleteMedicine)
@@ -199,41 +269,57 @@ async def delete_user_medicine_execute(message: types.Message, state: FSMContext
         await state.finish()
         return
     medicine_name = message.text
-    user_id = str(message.from_user.id)
-    with get_connection() as connection:
-        job_ids = get_medicine_jobs(connection, medicine_name, user_id)
-        for job_id in job_ids:
-            scheduler.remove_job(job_id)
-        delete_medicine(connection, medicine_name, user_id)
-        await message.answer(utils.MEDICINE_DELETE_SUCCESS.format(medicine_name), reply_markup=get_default_keyboard())
-        await state.finish()
+    user_id = message.from_user.id
+    async with get_connection() as connection:
+        await delete_medicine(connection, medicine_name, user_id)
+    reminder_dispatcher.remove(user_id, medicine_name)
+    await message.answer(utils.MEDICINE_DELETE_SUCCESS.format(medicine_name), reply_markup=get_default_keyboard())
+    await state.finish()
 
 
+@dp.message_handler(commands=['history'])
 @dp.message_handler(lambda message: message.text == utils.DEFAULT_SEE_INTAKES_BUTTON)
 async def share_intakes_history(message: types.Message):
-    print(utils.get_intake_history_csv(message.from_user.id))
-    await message.answer('В разработке')
+    user_id = message.from_user.id
+    try:
+        since, until = utils.parse_history_range(message.get_args(), await cached_get_user_timezone(user_id))
+    except ValueError:
+        await message.answer(utils.USER_INPUT_HISTORY_RANGE_CHECK, reply_markup=get_default_keyboard())
+        return
+    await intake_buffer.flush()
+    async with history_exports:
+        csv_file, rows = await utils.get_intake_history_csv(user_id, since, until)
+    with csv_file:
+        if not rows:
+            await message.answer(utils.INTAKE_HISTORY_EMPTY, reply_markup=get_default_keyboard())
+            return
+        await message.answer_document(types.InputFile(csv_file, filename=utils.INTAKE_HISTORY_FILE_NAME),
+                                      caption=utils.INTAKE_HISTORY_CAPTION.format(rows),
+                                      reply_markup=get_default_keyboard())
 
 
-@dp.callback_query_handler(lambda query: query.data.startswith('button'))
-async def process_reminder_callback_buttons(query: types.CallbackQuery):
-    button_pressed = query.data
-    if 'done' in button_pressed:
-        status = 'done'
-        response = utils.CALLBACK_RESPONSE_DONE
-        text_update = 'записано.'
-    else:
-        status = 'skipped'
-        response = utils.CALLBACK_RESPONSE_SKIPPED
-        text_update = 'пропущено.'
-    with get_connection() as connection:
-        user_id, medicine_name = button_pressed.split('_')[-2:]
-        date = datetime.now().strftime("%H:%M %Y-%m-%d")
-        add_intake(connection, medicine_name, user_id, date, status=status)
-        job_id = get_interval_job(connection, medicine_name, user_id)
-        scheduler.remove_job(str(job_id[0]))
-        delete_interval_job(connection, medicine_name, user_id)
-        await query.answer(response)
+@dp.message_handler(commands=['stats'])
+async def share_adherence_stats(message: types.Message):
+    await intake_buffer.flush()
+    await message.answer(await utils.get_adherence_report(message.from_user.id),
+                         reply_markup=get_default_keyboard(),
+                         parse_mode=types.ParseMode.MARKDOWN)
+
+
+REMINDER_CALLBACK_REPLIES = {'done': (utils.CALLBACK_RESPONSE_DONE, 'записано.'),
+                             'skipped': (utils.CALLBACK_RESPONSE_SKIPPED, 'пропущено.')}
+
+
+async def answer_reminder_callback(query: types.CallbackQuery, medicine_name: Optional[str], status: str):
+    if medicine_name is None:
+        await query.answer(utils.CALLBACK_RESPONSE_ALREADY_ANSWERED)
+        await reminder_bot.edit_message_reply_markup(chat_id=query.message.chat.id,
+                                                     message_id=query.message.message_id,
+                                                     reply_markup=None)
+        return
+    intake_buffer.add(medicine_name, query.from_user.id, datetime.now().astimezone(), status=status)
+    response, text_update = REMINDER_CALLBACK_REPLIES[status]
+    await query.answer(response)
     await reminder_bot.edit_message_reply_markup(chat_id=query.message.chat.id,
                                                  message_id=query.message.message_id,
                                                  reply_markup=None)
@@ -242,3 +328,22 @@ async def process_reminder_callback_buttons(query: types.CallbackQuery):
         message_id=query.message.message_id,
         text=utils.REMINDER_TEXT_UPDATE.format(medicine_name, text_update),
     )
+
+
+@dp.callback_query_handler(lambda query: callback_codec.decode(query.data) is not None)
+async def process_reminder_callback_buttons(query: types.CallbackQuery):
+    callback = callback_codec.decode(query.data)
+    async with get_connection() as connection:
+        medicine_name = await acknowledge_reminder_by_id(connection, callback.reminder_id, query.from_user.id)
+    await answer_reminder_callback(query, medicine_name, callback_codec.ACTION_STATUSES[callback.action])
+
+
+@dp.callback_query_handler(lambda query: query.data.startswith(callback_codec.LEGACY_PREFIX))
+async def process_legacy_reminder_callback_buttons(query: types.CallbackQuery):
+    callback = callback_codec.decode_legacy(query.data)
+    if callback is None or callback.user_id != query.from_user.id:
+        await query.answer()
+        return
+    async with get_connection() as connection:
+        medicine_name = await acknowledge_reminder(connection, callback.medicine_name, callback.user_id)
+    await answer_reminder_callback(query, medicine_name, callback_codec.ACTION_STATUSES[callback.action])
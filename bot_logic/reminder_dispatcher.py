@@ -0,0 +1,510 @@
+import asyncio
+import functools
+import logging
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+import metrics
+import bot_logic.utils as utils
+from bot_logic.send_queue import SendQueue, PRIORITY_FIRST, PRIORITY_NAG
+from bot_logic.shard_leases import ShardLeases
+from bot_logic.timezone_calendar import TransitionCalendar, Shift, format_offset
+from db.async_connection_pool import get_connection, unit_of_work, connect
+from db.async_database import (iterate_schedules,
+                               list_user_schedules,
+                               add_pending_reminders,
+                               mark_shards_fired,
+                               claim_overdue_reminders,
+                               purge_acknowledged_reminders)
+from db.cache import user_profiles, medicine_lists
+
+
+logger = logging.getLogger(__name__)
+
+MINUTES_PER_DAY = 24 * 60
+NAG_INTERVAL = timedelta(seconds=900)
+ACKNOWLEDGED_RETENTION = timedelta(days=1)
+SCHEDULES_CHANGED_CHANNEL = 'schedules_changed'
+# What to do with doses missed while nobody was firing them (downtime, failover):
+# send every one of them, or only the latest dose of each medicine.
+CATCH_UP_ALL = 'all'
+CATCH_UP_LATEST = 'latest'
+CATCH_UP_POLICIES = (CATCH_UP_ALL, CATCH_UP_LATEST)
+LOAD_CHUNK_SIZE = 5000
+
+
+class Dose(NamedTuple):
+    schedule_id: int
+    medicine_id: int
+    user_id: int
+    chat_id: int
+    medicine_name: str
+    timezone: str
+    local_minute: int
+
+
+class Reminder(NamedTuple):
+    reminder_id: int
+    user_id: int
+    chat_id: int
+    medicine_name: str
+
+
+def get_reminders(rows) -> List[Reminder]:
+    return [Reminder(row['id'], row['user_id'], row['chat_id'], row['medicine_name']) for row in rows]
+
+
+def get_utc_minute_of_day(moment: datetime) -> int:
+    moment = moment.astimezone(timezone.utc)
+    return moment.hour * 60 + moment.minute
+
+
+class ReminderDispatcher:
+    """Keeps every dose in a bucket keyed by UTC minute-of-day.
+
+    Doses are stored by IANA zone and local minute-of-day, and every local
+    bucket is linked into the UTC minute it falls on under the zone's
+    current offset (from a TransitionCalendar). When a zone's offset
+    changes, its local buckets are relinked in one pass, at most one per
+    minute of the day however many doses they hold. Doses whose local time
+    a spring-forward transition skips are fired right away, and those a
+    fall-back transition brings round a second time are skipped once.
+
+    A single scheduler job calls tick() once a minute; the due doses are a
+    dict lookup and are handed to the send queue together, so the cost of a tick depends
+    on how many doses are due rather than on how many are scheduled.
+    Every fired dose becomes a pending_reminders row, and sweep() re-sends
+    the unacknowledged ones whose next_nag_at has passed.
+
+    With shard leases, only the doses of users in shards this worker holds
+    are loaded and fired. Each shard remembers the minute it was last fired
+    through, here and in scheduler_shards, so a shard taken over from
+    another worker resumes where that worker stopped. Other workers learn
+    about added or deleted medicines, and new users, from schedules_changed
+    notifications, which also drop those users' cached profiles and
+    medicine lists.
+    """
+
+    def __init__(self, send_queue: SendQueue, shards: Optional[ShardLeases] = None,
+                 catch_up: str = CATCH_UP_LATEST, catch_up_window: timedelta = timedelta(hours=1),
+                 calendar: Optional[TransitionCalendar] = None):
+        if catch_up not in CATCH_UP_POLICIES:
+            raise ValueError(f"Unknown catch-up policy {catch_up!r}, expected one of {CATCH_UP_POLICIES}")
+        if not timedelta(0) <= catch_up_window < timedelta(days=1):
+            raise ValueError(f"Catch-up window must be shorter than a day, got {catch_up_window}")
+        self.send_queue = send_queue
+        self.shards = shards
+        self.catch_up = catch_up
+        self.catch_up_window = catch_up_window
+        self.calendar = calendar or TransitionCalendar()
+        # zone -> local minute -> schedule id -> dose
+        self.zones: Dict[str, Dict[int, Dict[int, Dose]]] = defaultdict(dict)
+        # UTC minute -> zone -> that zone's local bucket falling on this minute
+        self.buckets: Dict[int, Dict[str, Dict[int, Dose]]] = defaultdict(dict)
+        self.by_user: Dict[int, Dict[str, List[Dose]]] = defaultdict(lambda: defaultdict(list))
+        self.size = 0
+        # schedule ids a fall-back transition brought round again after they fired
+        self.repeated: Set[int] = set()
+        # schedule id -> dose a transition skipped over, left to fire after a tick failed to write it
+        self.skipped: Dict[int, Dose] = {}
+        self.last_minute: Optional[int] = None
+        # shard -> minute it was last fired through; only shards whose doses are loaded
+        self.shard_minutes: Dict[int, Optional[int]] = {}
+        self.loading: Set[int] = set()
+        self.listener = None
+        self.reloads: Set[asyncio.Task] = set()
+        # users whose reload after a notification failed, retried by the next rebalance()
+        self.stale_users: Set[int] = set()
+
+    def __len__(self):
+        return self.size
+
+    def add(self, dose: Dose):
+        if self.shards is not None:
+            shard = self.shards.shard_of(dose.user_id)
+            if shard not in self.shard_minutes and shard not in self.loading:
+                return
+        local_buckets = self.zones[dose.timezone]
+        bucket = local_buckets.get(dose.local_minute)
+        if bucket is None:
+            bucket = local_buckets[dose.local_minute] = {}
+            utc_minute = self.calendar.utc_minute(dose.timezone, dose.local_minute)
+            self.buckets[utc_minute][dose.timezone] = bucket
+        if dose.schedule_id not in bucket:
+            self.size += 1
+        bucket[dose.schedule_id] = dose
+        self.by_user[dose.user_id][dose.medicine_name].append(dose)
+
+    def _discard(self, dose: Dose):
+        local_buckets = self.zones.get(dose.timezone)
+        bucket = local_buckets and local_buckets.get(dose.local_minute)
+        if not bucket or bucket.pop(dose.schedule_id, None) is None:
+            return
+        self.size -= 1
+        self.repeated.discard(dose.schedule_id)
+        self.skipped.pop(dose.schedule_id, None)
+        if bucket:
+            return
+        del local_buckets[dose.local_minute]
+        utc_minute = self.calendar.utc_minute(dose.timezone, dose.local_minute)
+        zones = self.buckets[utc_minute]
+        del zones[dose.timezone]
+        if not zones:
+            del self.buckets[utc_minute]
+        if not local_buckets:
+            del self.zones[dose.timezone]
+
+    def remove(self, user_id: int, medicine_name: str):
+        medicines = self.by_user.get(int(user_id))
+        if medicines is None:
+            return
+        for dose in medicines.pop(medicine_name, []):
+            self._discard(dose)
+        if not medicines:
+            del self.by_user[int(user_id)]
+
+    def remove_user(self, user_id: int):
+        for medicine_name in list(self.by_user.get(int(user_id), ())):
+            self.remove(user_id, medicine_name)
+
+    def clear(self):
+        self.zones.clear()
+        self.buckets.clear()
+        self.by_user.clear()
+        self.size = 0
+        self.repeated.clear()
+        self.skipped.clear()
+        self.shard_minutes.clear()
+
+    def add_rows(self, rows):
+        for row in rows:
+            # one string per zone rather than one per row
+            self.add(Dose(row['id'], row['medicine_id'], row['user_id'], row['chat_id'],
+                          row['medicine_name'], sys.intern(row['timezone']), row['local_minute']))
+
+    def shift_zone(self, shift: Shift, edges: bool = True) -> List[Dose]:
+        """Relinks the zone's local buckets to their UTC minutes under the new offset.
+
+        Returns the doses whose local time the shift skipped over, to be
+        fired now. edges=False only relinks, for a clock set back.
+        """
+        local_buckets = self.zones.get(shift.zone)
+        if not local_buckets:
+            return []
+        buckets, zone = self.buckets, shift.zone
+        # all out, then all in: one bucket's new minute may be another's old one
+        for local_minute in local_buckets:
+            minute = (local_minute - shift.old_offset) % MINUTES_PER_DAY
+            zones = buckets[minute]
+            del zones[zone]
+            if not zones:
+                del buckets[minute]
+        for local_minute, bucket in local_buckets.items():
+            buckets[(local_minute - shift.new_offset) % MINUTES_PER_DAY][zone] = bucket
+        delta = shift.new_offset - shift.old_offset
+        if not edges or not delta:
+            return []
+        # the local wall clock reading at the transition, under the old offset
+        local_at = (get_utc_minute_of_day(shift.at) + shift.old_offset) % MINUTES_PER_DAY
+        skipped = []
+        for step in range(min(abs(delta), MINUTES_PER_DAY)):
+            if delta > 0:
+                # spring forward: these local times were still to come and never will today
+                bucket = local_buckets.get((local_at + step) % MINUTES_PER_DAY)
+                if bucket:
+                    skipped.extend(bucket.values())
+            else:
+                # fall back: fired in the last -delta minutes, and these local times come round again
+                bucket = local_buckets.get((local_at - 1 - step) % MINUTES_PER_DAY)
+                if bucket:
+                    self.repeated.update(bucket)
+        return skipped
+
+    def _apply_shifts(self, now: datetime) -> List[Dose]:
+        edges = now >= self.calendar.now
+        skipped = []
+        for shift in self.calendar.advance(now):
+            started = time.perf_counter()
+            doses = self.shift_zone(shift, edges)
+            skipped.extend(doses)
+            if shift.zone in self.zones:
+                logger.info(f"{shift.zone} moved from {format_offset(shift.old_offset)} to "
+                            f"{format_offset(shift.new_offset)}: {len(self.zones[shift.zone])} dose times "
+                            f"rescheduled in {(time.perf_counter() - started) * 1000:.1f}ms, "
+                            f"{len(doses)} doses skipped over.")
+        if self.shards is not None:
+            skipped = [dose for dose in skipped if self.shards.shard_of(dose.user_id) in self.shard_minutes]
+        return skipped
+
+    async def _stream_rows(self, shards: Optional[List[int]] = None) -> int:
+        loaded = 0
+        async with get_connection() as connection:
+            async for rows in iterate_schedules(connection, self.shards and self.shards.shard_count, shards,
+                                                chunk_size=LOAD_CHUNK_SIZE):
+                self.add_rows(rows)
+                loaded += len(rows)
+                # let handlers and the heartbeat run between chunks of a large load
+                await asyncio.sleep(0)
+        return loaded
+
+    async def load(self):
+        """Startup load: every dose, or with shard leases those of the shards we manage to claim."""
+        started = time.perf_counter()
+        self.clear()
+        if self.shards is not None:
+            lost, gained = await self.shards.heartbeat()
+            await self.load_shards(gained)
+        else:
+            loaded = await self._stream_rows()
+            logger.info(f"Loaded {loaded} doses into the reminder dispatcher!")
+        logger.info(f"Reminder schedule rehydrated in {time.perf_counter() - started:.2f}s.")
+
+    def _resume_minute(self, fired_until: Optional[datetime], now: datetime) -> Optional[int]:
+        # the minute a shard counts as fired through: where its last owner
+        # stopped, but no further back than the catch-up window
+        if fired_until is None:
+            return None
+        return get_utc_minute_of_day(max(fired_until, now - self.catch_up_window - timedelta(minutes=1)))
+
+    async def load_shards(self, shards: Dict[int, Optional[datetime]], now: Optional[datetime] = None):
+        """Starts firing the given shards from where their previous owner stopped."""
+        if not shards:
+            return
+        now = now or datetime.now(timezone.utc)
+        self.drop_shards(shards)
+        # ticks leave loading shards alone until all their doses are in
+        self.loading |= set(shards)
+        try:
+            loaded = await self._stream_rows(list(shards))
+        except BaseException:
+            self.drop_shards(shards)
+            raise
+        finally:
+            self.loading -= set(shards)
+        for shard, fired_until in shards.items():
+            self.shard_minutes[shard] = self._resume_minute(fired_until, now)
+        logger.info(f"Loaded {loaded} doses of {len(shards)} shards into the reminder dispatcher!")
+
+    def drop_shards(self, shards: Iterable[int]):
+        shards = set(shards)
+        for user_id in [user_id for user_id in self.by_user if self.shards.shard_of(user_id) in shards]:
+            self.remove_user(user_id)
+        for shard in shards:
+            self.shard_minutes.pop(shard, None)
+
+    async def rebalance(self):
+        """Heartbeat job: renews shard leases and loads or drops shards that changed hands."""
+        try:
+            lost, gained = await self.shards.heartbeat()
+        except Exception as error:
+            logger.error(f"Shard heartbeat failed: {error!r}")
+            return
+        if lost:
+            self.drop_shards(lost)
+        await self.load_shards(gained)
+        if self.listener is None or self.listener.is_closed():
+            await self.listen()
+        stale, self.stale_users = self.stale_users, set()
+        for user_id in stale:
+            self._schedule_reload(user_id)
+
+    async def reload_user(self, user_id: int):
+        if self.shards is not None and not self.shards.owns(user_id):
+            return
+        async with get_connection() as connection:
+            rows = await list_user_schedules(connection, user_id)
+        self.remove_user(user_id)
+        self.add_rows(rows)
+
+    def _schedule_reload(self, user_id: int):
+        task = asyncio.create_task(self.reload_user(user_id))
+        self.reloads.add(task)
+        task.add_done_callback(functools.partial(self._reload_done, user_id))
+
+    def _reload_done(self, user_id: int, task: asyncio.Task):
+        self.reloads.discard(task)
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is not None:
+            logger.error(f"Reloading the doses of user {user_id} failed, retrying on the next heartbeat: {error!r}")
+            self.stale_users.add(user_id)
+
+    async def listen(self):
+        """Follows schedules_changed notifications on a dedicated connection."""
+        def on_notification(connection, pid, channel, payload):
+            user_id = int(payload)
+            # the change may have come from another process, whose writes did not touch our caches
+            user_profiles.invalidate(user_id)
+            medicine_lists.invalidate(user_id)
+            self._schedule_reload(user_id)
+
+        if self.listener is not None and not self.listener.is_closed():
+            return
+        if self.listener is not None:
+            # notifications may have been missed while the connection was down
+            logger.warning("Schedule listener connection was lost, reloading held shards.")
+            held = {shard: None for shard in self.shard_minutes}
+            minutes = dict(self.shard_minutes)
+            self.drop_shards(list(held))
+            await self.load_shards(held)
+            self.shard_minutes.update(minutes)
+        self.listener = await connect()
+        await self.listener.add_listener(SCHEDULES_CHANGED_CHANNEL, on_notification)
+
+    async def stop(self):
+        if self.listener is not None:
+            await self.listener.close()
+            self.listener = None
+        for task in self.reloads:
+            task.cancel()
+        await asyncio.gather(*self.reloads, return_exceptions=True)
+        if self.shards is not None:
+            await self.shards.release_all()
+            self.clear()
+
+    def get_due(self, utc_minute: int) -> List[Dose]:
+        return [dose for bucket in self.buckets.get(utc_minute, {}).values() for dose in bucket.values()]
+
+    def _pending_minutes(self, last_minute: Optional[int], current_minute: int) -> List[int]:
+        # A late tick (event loop stall, coalesced misfire) must still fire
+        # every minute it skipped over, but never more than a day back.
+        if last_minute is None:
+            return [current_minute]
+        gap = (current_minute - last_minute) % MINUTES_PER_DAY
+        return [(last_minute + step) % MINUTES_PER_DAY for step in range(1, gap + 1)]
+
+    def _due_between(self, last_minute: Optional[int], current_minute: int,
+                     shards: Optional[Set[int]] = None) -> List[Dose]:
+        minutes = self._pending_minutes(last_minute, current_minute)
+        due = {}
+        for minute in minutes:
+            for dose in self.get_due(minute):
+                if shards is not None and self.shards.shard_of(dose.user_id) not in shards:
+                    continue
+                if dose.schedule_id in self.repeated:
+                    self.repeated.discard(dose.schedule_id)
+                    continue
+                due[dose.schedule_id] = dose
+        if len(minutes) > 1:
+            missed = len(due)
+            if self.catch_up == CATCH_UP_LATEST:
+                # minutes are in order, so the last dose of each medicine wins
+                due = {(dose.user_id, dose.medicine_name): dose for dose in due.values()}
+            logger.info(f"Catching up {len(minutes) - 1} missed minutes: "
+                        f"{missed} doses due, sending {len(due)} ({self.catch_up}).")
+        return list(due.values())
+
+    def _collect_due(self, current_minute: int) -> List[Dose]:
+        if self.shards is None:
+            return self._due_between(self.last_minute, current_minute)
+        # shards usually share the same last minute; those taken over recently may lag behind
+        groups: Dict[Optional[int], Set[int]] = defaultdict(set)
+        for shard, last_minute in self.shard_minutes.items():
+            if shard in self.shards.owned:
+                groups[last_minute].add(shard)
+        due = []
+        for last_minute, shards in groups.items():
+            every_shard = len(groups) == 1 and len(shards) == len(self.shard_minutes) and not self.loading
+            due.extend(self._due_between(last_minute, current_minute, None if every_shard else shards))
+            for shard in shards:
+                self.shard_minutes[shard] = current_minute
+        return due
+
+    def _take_due(self, now: datetime) -> Tuple[List[Dose], List[Dose]]:
+        current_minute = get_utc_minute_of_day(now)
+        skipped = self._apply_shifts(now)
+        if self.skipped:
+            skipped.extend(self.skipped.values())
+            self.skipped = {}
+        due = self._collect_due(current_minute)
+        self.last_minute = current_minute
+        return due, skipped
+
+    def collect(self, now: datetime) -> List[Dose]:
+        """The doses due at now, including those a transition on the way skipped over."""
+        due, skipped = self._take_due(now)
+        if skipped:
+            due = list({dose.schedule_id: dose for dose in due + skipped}.values())
+        return due
+
+    def _is_scheduled(self, dose: Dose) -> bool:
+        return dose.schedule_id in self.zones.get(dose.timezone, {}).get(dose.local_minute, {})
+
+    def _restore(self, current_minute: int, last_minute: Optional[int], shard_minutes: Dict[int, Optional[int]],
+                 repeated: Set[int], skipped: List[Dose]):
+        """Puts the tick cursor back after a tick whose pending reminders were not written."""
+        # a cursor that had not started yet goes back one minute, so the failed minute is collected again
+        def resume(minute: Optional[int]) -> int:
+            return (current_minute - 1) % MINUTES_PER_DAY if minute is None else minute
+
+        self.last_minute = resume(last_minute)
+        # shards dropped while the write was in flight stay dropped
+        for shard, minute in shard_minutes.items():
+            if shard in self.shard_minutes:
+                self.shard_minutes[shard] = resume(minute)
+        self.repeated |= repeated
+        self.skipped.update((dose.schedule_id, dose) for dose in skipped if self._is_scheduled(dose))
+
+    async def tick(self, now: Optional[datetime] = None):
+        if now is None:
+            now = datetime.now(timezone.utc)
+            metrics.TICK_LAG.observe((now - now.replace(second=0, microsecond=0)).total_seconds())
+        current_minute = get_utc_minute_of_day(now)
+        if self.shards is not None and not self.shards.is_valid():
+            logger.warning(f"Tick {current_minute}: shard leases are not confirmed, not firing.")
+            return
+        last_minute, shard_minutes, repeated = self.last_minute, dict(self.shard_minutes), set(self.repeated)
+        due, skipped = self._take_due(now)
+        # the repeated doses this tick skipped, handed back if the write fails
+        repeated -= self.repeated
+        if skipped:
+            due = list({dose.schedule_id: dose for dose in due + skipped}.values())
+        # only the shards this tick collected: one still loading resumes from its last owner's fired_until
+        fired = [] if self.shards is None else sorted(
+            shard for shard in self.shard_minutes if shard in self.shards.owned and shard not in self.loading)
+        if not due and not fired:
+            return
+        rows = []
+        try:
+            async with unit_of_work() as connection:
+                if due:
+                    rows = await add_pending_reminders(connection, due, now + NAG_INTERVAL)
+                if fired:
+                    await mark_shards_fired(connection, self.shards.worker_id, fired, now)
+        except BaseException:
+            # nothing was written: the next tick collects these minutes again
+            logger.warning(f"Tick {current_minute}: pending reminders were not written, retrying next tick.")
+            self._restore(current_minute, last_minute, shard_minutes, repeated, skipped)
+            raise
+        self.send_all(get_reminders(rows), PRIORITY_FIRST)
+        metrics.REMINDERS_FIRED.inc(len(due), kind='first')
+        if due:
+            logger.info(f"Tick {current_minute}: queued {len(due)} doses.")
+
+    async def sweep(self, now: Optional[datetime] = None):
+        now = now or datetime.now(timezone.utc)
+        async with get_connection() as connection:
+            rows = await claim_overdue_reminders(connection, now, now + NAG_INTERVAL)
+        if not rows:
+            return
+        overdue = get_reminders(rows)
+        self.send_all(overdue, PRIORITY_NAG)
+        metrics.REMINDERS_FIRED.inc(len(overdue), kind='nag')
+        logger.info(f"Sweep: queued {len(overdue)} unacknowledged reminders.")
+
+    async def purge(self, now: Optional[datetime] = None):
+        now = now or datetime.now(timezone.utc)
+        async with get_connection() as connection:
+            await purge_acknowledged_reminders(connection, now - ACKNOWLEDGED_RETENTION)
+
+    def send_all(self, reminders, priority: int):
+        for reminder in reminders:
+            utils.send_reminder(self.send_queue,
+                                chat_id=reminder.chat_id,
+                                medicine_name=reminder.medicine_name,
+                                reminder_id=reminder.reminder_id,
+                                priority=priority)
@@ -0,0 +1,273 @@
+import asyncio
+import itertools
+import logging
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Set
+
+from aiogram import Bot
+from aiogram.utils.exceptions import RetryAfter, NetworkError, TelegramAPIError
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# lower value is sent first
+PRIORITY_FIRST = 0
+PRIORITY_NAG = 1
+
+GLOBAL_RATE = 30
+PER_CHAT_RATE = 1
+CONCURRENCY = 8
+MAX_RETRIES = 3
+# seconds before the first retry after a network error, doubled on every further one
+RETRY_BACKOFF = 1.0
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self) -> float:
+        """Takes a token and returns 0, or returns how long to wait for one."""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+    async def acquire(self):
+        while True:
+            wait = self.take()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+
+class OutgoingMessage:
+    __slots__ = ('chat_id', 'text', 'kwargs', 'priority', 'attempt', 'enqueued_at', 'released')
+
+    def __init__(self, chat_id: int, text: str, priority: int, kwargs: dict):
+        self.chat_id = chat_id
+        self.text = text
+        self.kwargs = kwargs
+        self.priority = priority
+        self.attempt = 0
+        self.enqueued_at = time.monotonic()
+        # set when the message comes back from its chat's waiting list, which it must not rejoin at the back
+        self.released = False
+
+
+class SendQueue:
+    """Funnels every outgoing reminder through global and per-chat rate limits.
+
+    A fixed pool of workers drains a priority queue, so first reminders go
+    out before nag re-sends, and a RetryAfter from Telegram pauses every
+    worker for the requested time before the message is retried.
+
+    Only the global limit makes a worker wait. A message to a chat that
+    is out of tokens is set aside on that chat's waiting list and put back
+    on the queue once the chat can take it, so a burst to one chat does
+    not hold up the others. Messages that failed on a network error are
+    set aside the same way, for a backoff that doubles with every attempt.
+    Set-aside messages keep their place in queue.join().
+    """
+
+    def __init__(self, bot: Bot,
+                 global_rate: float = GLOBAL_RATE,
+                 per_chat_rate: float = PER_CHAT_RATE,
+                 concurrency: int = CONCURRENCY,
+                 max_retries: int = MAX_RETRIES,
+                 retry_backoff: float = RETRY_BACKOFF,
+                 max_chat_buckets: int = 10000):
+        self.bot = bot
+        self.global_bucket = TokenBucket(global_rate)
+        self.per_chat_rate = per_chat_rate
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        self.max_chat_buckets = max_chat_buckets
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.queue: Optional[asyncio.PriorityQueue] = None
+        self.workers: List[asyncio.Task] = []
+        self.counter = itertools.count()
+        self.paused_until = 0.0
+        # messages set aside per chat, in the order they were taken off the queue
+        self.waiting: Dict[int, Deque[OutgoingMessage]] = {}
+        self.timers: Set[asyncio.TimerHandle] = set()
+        self.held = 0
+        self.latencies = deque(maxlen=1000)
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    def start(self):
+        if self.workers:
+            return
+        self.queue = asyncio.PriorityQueue()
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self, timeout: float = 10):
+        if self.queue is not None:
+            try:
+                await asyncio.wait_for(self.queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Dropping {self.depth} unsent messages on shutdown.")
+        for timer in self.timers:
+            timer.cancel()
+        self.timers.clear()
+        self.waiting.clear()
+        self.held = 0
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def submit(self, chat_id: int, text: str, priority: int = PRIORITY_FIRST, **kwargs):
+        self._put(OutgoingMessage(chat_id, text, priority, kwargs))
+
+    def _put(self, message: OutgoingMessage):
+        self.queue.put_nowait((message.priority, next(self.counter), message))
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= self.max_chat_buckets:
+                self.chat_buckets = {chat: bucket for chat, bucket in self.chat_buckets.items()
+                                     if not bucket.is_full()}
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.per_chat_rate)
+        return bucket
+
+    async def _worker(self):
+        while True:
+            _, _, message = await self.queue.get()
+            held = False
+            try:
+                held = await self._send(message)
+            except Exception as error:
+                # a worker that died here would leave the queue one consumer short for good
+                self.failed += 1
+                metrics.MESSAGES.inc(outcome='failed')
+                logger.exception(f"Dropping message to {message.chat_id}: {error!r}")
+            finally:
+                if not held:
+                    self.queue.task_done()
+
+    def _hold(self, message: OutgoingMessage, delay: float):
+        """Sets the message aside for delay seconds, then puts it back on the queue."""
+        self.held += 1
+        self._call_later(delay, self._requeue, message)
+
+    def _call_later(self, delay: float, callback, *args):
+        def run():
+            self.timers.discard(timer)
+            callback(*args)
+        timer = asyncio.get_running_loop().call_later(delay, run)
+        self.timers.add(timer)
+
+    def _requeue(self, message: OutgoingMessage):
+        self.held -= 1
+        self._put(message)
+        # the task_done() the worker left out when the message was set aside
+        self.queue.task_done()
+
+    def _wait_for_chat(self, message: OutgoingMessage, delay: float):
+        """Adds the message to its chat's waiting list, due back on the queue in delay seconds."""
+        waiting = self.waiting.get(message.chat_id)
+        if waiting is None:
+            waiting = self.waiting[message.chat_id] = deque()
+            self._call_later(delay, self._release, message.chat_id)
+        if message.released:
+            waiting.appendleft(message)
+        else:
+            waiting.append(message)
+        self.held += 1
+
+    def _release(self, chat_id: int):
+        """Puts the first message waiting for the chat back on the queue."""
+        waiting = self.waiting[chat_id]
+        message = waiting.popleft()
+        message.released = True
+        self._requeue(message)
+        if waiting:
+            self._call_later(1 / self.per_chat_rate, self._release, chat_id)
+        else:
+            del self.waiting[chat_id]
+
+    async def _send(self, message: OutgoingMessage) -> bool:
+        """Sends the message, or sets it aside and returns True."""
+        if message.chat_id in self.waiting and not message.released:
+            # keeps the chat's messages in order behind the ones already waiting
+            self._wait_for_chat(message, 0)
+            return True
+        wait = self._chat_bucket(message.chat_id).take()
+        if wait:
+            self._wait_for_chat(message, wait)
+            return True
+        message.released = False
+        pause = self.paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+        await self.global_bucket.acquire()
+        message.attempt += 1
+        try:
+            await self.bot.send_message(message.chat_id, message.text, **message.kwargs)
+        except RetryAfter as error:
+            metrics.MESSAGES.inc(outcome='rate_limited')
+            self.paused_until = max(self.paused_until, time.monotonic() + error.timeout)
+            return self._retry(message, error)
+        except (NetworkError, asyncio.TimeoutError) as error:
+            # aiohttp's request timeouts reach us as asyncio.TimeoutError, not as a NetworkError
+            metrics.MESSAGES.inc(outcome='network_error')
+            return self._retry(message, error, self.retry_backoff * 2 ** (message.attempt - 1))
+        except TelegramAPIError as error:
+            self.failed += 1
+            metrics.MESSAGES.inc(outcome='failed')
+            logger.error(f"Dropping message to {message.chat_id}: {error!r}")
+        else:
+            self.sent += 1
+            latency = time.monotonic() - message.enqueued_at
+            self.latencies.append(latency)
+            metrics.MESSAGES.inc(outcome='sent')
+            metrics.SEND_LATENCY.observe(latency)
+        return False
+
+    def _retry(self, message: OutgoingMessage, error: Exception, delay: float = 0) -> bool:
+        """Puts the message back on the queue, after delay seconds if given. Returns True if it was set aside."""
+        if message.attempt > self.max_retries:
+            self.failed += 1
+            metrics.MESSAGES.inc(outcome='failed')
+            logger.error(f"Giving up on message to {message.chat_id} after {message.attempt} attempts: {error!r}")
+            return False
+        self.retried += 1
+        if delay:
+            self._hold(message, delay)
+            return True
+        self._put(message)
+        return False
+
+    @property
+    def depth(self) -> int:
+        return self.queue.qsize() + self.held if self.queue is not None else 0
+
+    def stats(self) -> dict:
+        latencies = sorted(self.latencies)
+        return {'depth': self.depth,
+                'sent': self.sent,
+                'failed': self.failed,
+                'retried': self.retried,
+                'latency_p50': latencies[len(latencies) // 2] if latencies else 0.0,
+                'latency_p99': latencies[int(len(latencies) * 0.99)] if latencies else 0.0}
@@ -0,0 +1,108 @@
+import logging
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+
+from db.async_connection_pool import unit_of_work
+from db.async_database import (heartbeat_scheduler_worker,
+                               unregister_scheduler_worker,
+                               renew_shard_leases,
+                               claim_shard_leases,
+                               release_shard_leases)
+
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# every worker sharing a database must use the same shard count
+SCHEDULER_SHARDS = int(os.getenv('SCHEDULER_SHARDS') or 16)
+SCHEDULER_LEASE_TTL = timedelta(seconds=int(os.getenv('SCHEDULER_LEASE_TTL') or 30))
+# A stable id (container or service instance name) lets a restarted worker
+# adopt its predecessor's leases at once instead of waiting for them to expire.
+SCHEDULER_WORKER_ID = os.getenv('SCHEDULER_WORKER_ID')
+
+
+class ShardLeases:
+    """The reminder shards this worker process holds in scheduler_shards.
+
+    heartbeat() runs every lease_ttl / 3. It renews our leases, gives back
+    the shards above our fair share (shard_count / live workers) and
+    claims free or expired ones up to it, so shards spread out as workers
+    join and are picked up by the survivors once a worker dies.
+    is_valid() turns false after two missed heartbeats, a full heartbeat
+    before the leases can expire in Postgres, so a stalled worker stops
+    firing before another one takes its shards over.
+    """
+
+    def __init__(self, shard_count: int = SCHEDULER_SHARDS, lease_ttl: timedelta = SCHEDULER_LEASE_TTL,
+                 worker_id: Optional[str] = None):
+        self.shard_count = shard_count
+        self.lease_ttl = lease_ttl
+        self.worker_id = (worker_id or SCHEDULER_WORKER_ID
+                          or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}")
+        self.owned: Set[int] = set()
+        self.valid_until = 0.0
+        self.heartbeats = 0
+        self.handoffs = 0
+
+    @property
+    def heartbeat_interval(self) -> float:
+        return self.lease_ttl.total_seconds() / 3
+
+    def shard_of(self, user_id: int) -> int:
+        return int(user_id) % self.shard_count
+
+    def owns(self, user_id: int) -> bool:
+        return self.shard_of(user_id) in self.owned
+
+    def is_valid(self) -> bool:
+        return time.monotonic() < self.valid_until
+
+    async def heartbeat(self) -> Tuple[Set[int], Dict[int, Optional[datetime]]]:
+        """Returns the shards lost and the shards gained with the fired_until of their last owner."""
+        started = time.monotonic()
+        async with unit_of_work() as connection:
+            workers = await heartbeat_scheduler_worker(connection, self.worker_id,
+                                                       self.shard_count, self.lease_ttl)
+            renewed = await renew_shard_leases(connection, self.worker_id, self.lease_ttl, self.shard_count)
+            held = {row['shard'] for row in renewed}
+            # leases left by a previous process with our worker id are taken over as they are
+            gained = {row['shard']: row['fired_until'] for row in renewed if row['shard'] not in self.owned}
+            fair_share = -(-self.shard_count // max(workers, 1))
+            surplus = set(sorted(held)[fair_share:])
+            lost = (self.owned - held) | surplus
+            # stop firing the shards we are about to give back before anyone can claim them
+            self.owned -= lost
+            if surplus:
+                await release_shard_leases(connection, self.worker_id, sorted(surplus))
+                held -= surplus
+                gained = {shard: fired_until for shard, fired_until in gained.items() if shard in held}
+            if len(held) < fair_share:
+                rows = await claim_shard_leases(connection, self.worker_id, self.lease_ttl,
+                                                self.shard_count, fair_share - len(held))
+                gained.update((row['shard'], row['fired_until']) for row in rows)
+        self.owned = held | set(gained)
+        self.valid_until = started + self.lease_ttl.total_seconds() - self.heartbeat_interval
+        self.heartbeats += 1
+        if lost or gained:
+            self.handoffs += len(lost) + len(gained)
+            logger.info(f"Worker {self.worker_id} now holds {len(self.owned)}/{self.shard_count} shards "
+                        f"(+{len(gained)}, -{len(lost)}, {workers} live workers).")
+        return lost, gained
+
+    async def release_all(self):
+        shards, self.owned = sorted(self.owned), set()
+        self.valid_until = 0.0
+        async with unit_of_work() as connection:
+            if shards:
+                await release_shard_leases(connection, self.worker_id, shards)
+            await unregister_scheduler_worker(connection, self.worker_id)
+
+    def stats(self) -> dict:
+        return {'worker_id': self.worker_id, 'owned': len(self.owned), 'shards': self.shard_count,
+                'valid': self.is_valid(), 'heartbeats': self.heartbeats, 'handoffs': self.handoffs}
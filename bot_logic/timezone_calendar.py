@@ -0,0 +1,131 @@
+"""UTC offsets of the timezones doses are kept in, and when they change.
+
+Every zone's offset changes are read once from pytz's compiled tz database
+tables (the same data localize() bisects on every call). The calendar
+follows only the zones that are in use: it keeps each one's current
+offset and a heap of their next transitions, so advancing the clock
+pops the shifts that are due instead of asking every zone again.
+"""
+import heapq
+from bisect import bisect_right
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import pytz
+
+
+DEFAULT_TIMEZONE = 'UTC'
+MINUTES_PER_DAY = 24 * 60
+
+
+class Shift(NamedTuple):
+    zone: str
+    at: datetime
+    # minutes east of UTC before and after the transition
+    old_offset: int
+    new_offset: int
+
+
+class ZoneTable(NamedTuple):
+    # POSIX timestamps of the transitions, and the offset in effect from each;
+    # offsets[0] applies before the first transition
+    times: List[float]
+    offsets: List[int]
+
+    def index(self, stamp: float) -> int:
+        return bisect_right(self.times, stamp)
+
+
+def normalize_timezone(name: Optional[str]) -> str:
+    """name if the tz database knows it, else UTC (get_timezone() answers 'Not Found' off the map)."""
+    return name if name in pytz.all_timezones_set else DEFAULT_TIMEZONE
+
+
+def _minutes(delta) -> int:
+    return int(delta.total_seconds() // 60)
+
+
+@lru_cache(maxsize=None)
+def zone_table(name: str) -> ZoneTable:
+    zone = pytz.timezone(name)
+    # the first entry is datetime.min, standing for "always" in zones with transitions
+    transitions = getattr(zone, '_utc_transition_times', None) or [datetime.min]
+    infos = getattr(zone, '_transition_info', None) or [(zone.utcoffset(datetime(2000, 1, 1)),)]
+    times, offsets = [], [_minutes(infos[0][0])]
+    for moment, info in zip(transitions[1:], infos[1:]):
+        offset = _minutes(info[0])
+        # abbreviation-only changes (CET -> CEST -> CET with the same offset in some years) move nothing
+        if offset != offsets[-1]:
+            times.append(moment.replace(tzinfo=timezone.utc).timestamp())
+            offsets.append(offset)
+    return ZoneTable(times, offsets)
+
+
+def local_to_utc_minute(local_minute: int, offset: int) -> int:
+    return (local_minute - offset) % MINUTES_PER_DAY
+
+
+def format_offset(offset: int) -> str:
+    sign = '-' if offset < 0 else '+'
+    return f"UTC{sign}{abs(offset) // 60:02d}:{abs(offset) % 60:02d}"
+
+
+class TransitionCalendar:
+    """Current offsets of the tracked zones as of self.now, advanced by advance()."""
+
+    def __init__(self, now: Optional[datetime] = None):
+        self.now = now or datetime.now(timezone.utc)
+        self.offsets: Dict[str, int] = {}
+        # (timestamp of the next transition, zone)
+        self.upcoming: List[Tuple[float, str]] = []
+
+    def __contains__(self, zone: str) -> bool:
+        return zone in self.offsets
+
+    def offset(self, zone: str) -> int:
+        """The zone's offset in minutes, tracking it from now on if it was not already."""
+        offset = self.offsets.get(zone)
+        if offset is None:
+            offset = self._track(zone, self.now.timestamp())
+        return offset
+
+    def utc_minute(self, zone: str, local_minute: int) -> int:
+        return local_to_utc_minute(local_minute, self.offset(zone))
+
+    def _track(self, zone: str, stamp: float) -> int:
+        table = zone_table(zone)
+        index = table.index(stamp)
+        offset = self.offsets[zone] = table.offsets[index]
+        if index < len(table.times):
+            heapq.heappush(self.upcoming, (table.times[index], zone))
+        return offset
+
+    def advance(self, now: datetime) -> List[Shift]:
+        """Moves the clock to now; the offset changes of tracked zones on the way, in order."""
+        if now < self.now:
+            return self._rewind(now)
+        self.now = now
+        stamp = now.timestamp()
+        shifts = []
+        while self.upcoming and self.upcoming[0][0] <= stamp:
+            at, zone = heapq.heappop(self.upcoming)
+            table = zone_table(zone)
+            index = table.index(at)
+            old_offset, new_offset = self.offsets[zone], table.offsets[index]
+            self.offsets[zone] = new_offset
+            shifts.append(Shift(zone, datetime.fromtimestamp(at, timezone.utc), old_offset, new_offset))
+            if index < len(table.times):
+                heapq.heappush(self.upcoming, (table.times[index], zone))
+        return shifts
+
+    def _rewind(self, now: datetime) -> List[Shift]:
+        # a virtual clock set back: look every zone up again, reporting those that differ
+        offsets, self.offsets, self.upcoming = self.offsets, {}, []
+        self.now = now
+        shifts = []
+        for zone, old_offset in offsets.items():
+            new_offset = self._track(zone, now.timestamp())
+            if new_offset != old_offset:
+                shifts.append(Shift(zone, now, old_offset, new_offset))
+        return shifts
@@ -0,0 +1,236 @@
+import asyncio
+import contextvars
+import logging
+import os
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional
+
+from aiogram import Dispatcher, types
+from dotenv import load_dotenv
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# updates handled at once; empty ties it to the async db pool size (see concurrency_for_pool)
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY') or 0)
+# a user's updates queued past this are dropped
+UPDATE_MAX_USER_DEPTH = int(os.getenv('UPDATE_MAX_USER_DEPTH') or 20)
+# updates queued in total before new ones are held back
+UPDATE_MAX_PENDING = int(os.getenv('UPDATE_MAX_PENDING') or 1000)
+# seconds an update is held back waiting for room before it is dropped
+UPDATE_MAX_DELAY = float(os.getenv('UPDATE_MAX_DELAY') or 10)
+
+# pool connections left to the reminder dispatcher, the intake buffer and FSM storage flushes
+RESERVED_CONNECTIONS = 2
+
+
+def concurrency_for_pool(pool_size: int) -> int:
+    return max(pool_size - RESERVED_CONNECTIONS, 1)
+
+
+def get_update_user_id(update: types.Update) -> Optional[int]:
+    for event in (update.message, update.edited_message, update.callback_query, update.inline_query,
+                  update.chosen_inline_result, update.shipping_query, update.pre_checkout_query,
+                  update.my_chat_member, update.chat_member, update.chat_join_request):
+        if event is not None:
+            user = getattr(event, 'from_user', None)
+            return user.id if user is not None else None
+    return None
+
+
+class QueuedUpdate:
+    __slots__ = ('update', 'user_id', 'context', 'future', 'enqueued_at', 'expiry')
+
+    def __init__(self, update: types.Update, user_id: int, future: asyncio.Future):
+        self.update = update
+        self.user_id = user_id
+        # the handler runs in the submitter's context, as if it had not been queued
+        self.context = contextvars.copy_context()
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        self.expiry: Optional[asyncio.TimerHandle] = None
+
+
+class UpdatePipeline:
+    """Hands updates to the handlers one user at a time, with a bounded number in flight.
+
+    Each user has a queue of their own and at most one update being
+    handled, so a quick second tap never races the first over the FSM
+    state. Users with queued updates take turns on a fixed pool of
+    workers, which bounds the db connections handlers can ask for at once.
+    A user's updates past max_user_depth are dropped. Past max_pending in
+    total, new updates are held back in arrival order until there is room,
+    and dropped if that takes longer than max_delay. Until start() updates
+    are handled directly, unordered.
+    """
+
+    def __init__(self, process: Callable[[types.Update], Awaitable],
+                 concurrency: int = UPDATE_CONCURRENCY or concurrency_for_pool(10),
+                 max_user_depth: int = UPDATE_MAX_USER_DEPTH,
+                 max_pending: int = UPDATE_MAX_PENDING,
+                 max_delay: float = UPDATE_MAX_DELAY):
+        self.process = process
+        self.concurrency = concurrency
+        self.max_user_depth = max_user_depth
+        self.max_pending = max_pending
+        self.max_delay = max_delay
+        self.queues: Dict[int, Deque[QueuedUpdate]] = {}
+        # users with queued updates and no update in flight, in turn order
+        self.ready: Optional[asyncio.Queue] = None
+        self.held: Deque[QueuedUpdate] = deque()
+        self.workers: List[asyncio.Task] = []
+        self.pending = 0
+        self.in_flight = 0
+        self.waits = deque(maxlen=1000)
+        self.processed = 0
+        self.delayed = 0
+        self.shed = 0
+
+    def start(self, concurrency: Optional[int] = None):
+        if self.workers:
+            return
+        if concurrency:
+            self.concurrency = concurrency
+        self.ready = asyncio.Queue()
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self, timeout: float = 10):
+        if self.ready is not None:
+            try:
+                await asyncio.wait_for(self._drain(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Dropping {self.pending + len(self.held)} queued updates on shutdown.")
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        for queued in self.held:
+            queued.expiry.cancel()
+            queued.future.cancel()
+        for queue in self.queues.values():
+            for queued in queue:
+                queued.future.cancel()
+        self.held.clear()
+        self.queues = {}
+        self.pending = 0
+        self.ready = None
+
+    async def _drain(self):
+        while self.pending or self.in_flight or self.held:
+            await asyncio.sleep(0.05)
+
+    async def submit(self, update: types.Update):
+        """Queues the update behind the user's earlier ones and returns the handler result.
+
+        Returns None for an update that was dropped.
+        """
+        if not self.workers:
+            return await self.process(update)
+        user_id = get_update_user_id(update)
+        if user_id is None:
+            # service updates without a user keep to themselves
+            user_id = -update.update_id
+        queue = self.queues.get(user_id)
+        if queue is not None and len(queue) >= self.max_user_depth:
+            return self._drop(update, 'shed_user')
+        queued = QueuedUpdate(update, user_id, asyncio.get_running_loop().create_future())
+        # while anything is held back new updates line up behind it, or a user's updates would overtake each other
+        if self.pending >= self.max_pending or self.held:
+            self._hold(queued)
+        else:
+            self._enqueue(queued)
+        return await queued.future
+
+    def _enqueue(self, queued: QueuedUpdate):
+        queue = self.queues.get(queued.user_id)
+        if queue is None:
+            queue = self.queues[queued.user_id] = deque()
+            # the user has nothing queued or in flight: it takes a turn now
+            self.ready.put_nowait(queued.user_id)
+        queue.append(queued)
+        self.pending += 1
+
+    def _hold(self, queued: QueuedUpdate):
+        self.delayed += 1
+        metrics.UPDATES.inc(outcome='delayed')
+        queued.expiry = asyncio.get_running_loop().call_later(self.max_delay, self._expire, queued)
+        self.held.append(queued)
+
+    def _expire(self, queued: QueuedUpdate):
+        # every update is held for the same max_delay, so the one expiring is the oldest
+        self.held.remove(queued)
+        self._drop(queued.update, 'shed_overload')
+        if not queued.future.done():
+            queued.future.set_result(None)
+
+    def _admit_held(self):
+        while self.held and self.pending < self.max_pending:
+            queued = self.held.popleft()
+            queued.expiry.cancel()
+            self._enqueue(queued)
+
+    def _drop(self, update: types.Update, outcome: str):
+        self.shed += 1
+        metrics.UPDATES.inc(outcome=outcome)
+        logger.debug(f"Dropping update {update.update_id} ({outcome}).")
+        return None
+
+    async def _worker(self):
+        while True:
+            user_id = await self.ready.get()
+            queue = self.queues[user_id]
+            queued = queue.popleft()
+            self.pending -= 1
+            self.in_flight += 1
+            self._admit_held()
+            wait = time.monotonic() - queued.enqueued_at
+            self.waits.append(wait)
+            metrics.UPDATE_WAIT.observe(wait)
+            try:
+                result = await queued.context.run(asyncio.create_task, self.process(queued.update))
+            except asyncio.CancelledError:
+                queued.future.cancel()
+                raise
+            except Exception as error:
+                if not queued.future.done():
+                    queued.future.set_exception(error)
+            else:
+                if not queued.future.done():
+                    queued.future.set_result(result)
+            finally:
+                self.in_flight -= 1
+                self.processed += 1
+                metrics.UPDATES.inc(outcome='processed')
+                if queue:
+                    # to the back of the line, so one busy user cannot hold a worker
+                    self.ready.put_nowait(user_id)
+                else:
+                    del self.queues[user_id]
+
+    def stats(self) -> dict:
+        waits = sorted(self.waits)
+        return {'depth': self.pending,
+                'held': len(self.held),
+                'users': len(self.queues),
+                'in_flight': self.in_flight,
+                'concurrency': self.concurrency,
+                'processed': self.processed,
+                'delayed': self.delayed,
+                'shed': self.shed,
+                'wait_p50': waits[len(waits) // 2] if waits else 0.0,
+                'wait_p99': waits[int(len(waits) * 0.99)] if waits else 0.0}
+
+
+class OrderedDispatcher(Dispatcher):
+    """A Dispatcher whose updates, from polling and the webhook alike, go through an UpdatePipeline."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pipeline = UpdatePipeline(super().process_update)
+
+    async def process_update(self, update: types.Update):
+        return await self.pipeline.submit(update)
@@ -1,16 +1,26 @@
-from typing import List
+import os
+import io
+import csv
+import asyncio
+import threading
+from tempfile import SpooledTemporaryFile
+from collections import OrderedDict
+from functools import lru_cache
+from typing import List, Optional, Tuple
 from datetime import datetime, timedelta
 
 from aiogram.types import (InlineKeyboardMarkup,
                            InlineKeyboardButton,
                            ReplyKeyboardMarkup,
                            KeyboardButton)
-from aiogram import Bot
 from timezonefinder import TimezoneFinder
 import pytz
 
-from db.connection_pool import get_connection
-from db.database import add_interval_job, get_user_intakes
+from bot_logic.send_queue import SendQueue, PRIORITY_FIRST
+import bot_logic.callback_codec as callback_codec
+from db.async_connection_pool import get_connection
+from db.async_database import iterate_user_intakes, cached_get_user_timezone, get_user_adherence
+from db.intake_archive import INTAKE_ARCHIVE_DIR, INTAKE_HISTORY_ARCHIVES, list_archives, read_user_intakes
 
 
 # buttons
@@ -47,6 +57,7 @@ MEDICINE_NAMES_EMPTY = "Пока ещё ничего не добавлено."
 MEDICINE_NAME_WITH_SCHEDULE = "*{}* со следующим расписанием: *{}*\n"
 CALLBACK_RESPONSE_DONE = "Записано успешно!"
 CALLBACK_RESPONSE_SKIPPED = "Пропущенно успешно!"
+CALLBACK_RESPONSE_ALREADY_ANSWERED = "Этот приём уже отмечен."
 REMINDER_TEXT = "Время принимать {}! {}"
 REMINDER_TEXT_UPDATE = "{} {}!"
 USER_INPUT_STATELESS = 'Пожалуйста, используй предложенные команды: \
@@ -55,11 +66,20 @@ USER_INPUT_LOCATION_CHECK = "Пожалуйста, отправь мне сво
 USER_INPUT_MEDICINE_NAME_CHECK = "{} не похоже на название лекарства...\n Отправь ещё раз полное название!"
 USER_INPUT_DAILY_INTAKES_CHECK = "Пожалуста, введи число от 1 до 10."
 USER_INPUT_SCHEDULE_TIME_CHECK = "Пожалуйста, введи время в формате 00:00."
-
-
-def get_remind_keyboard(user_id: str, medicine_name: str) -> InlineKeyboardMarkup:
-    done = InlineKeyboardButton("Done!", callback_data=f'button_done_{user_id}_{medicine_name}')
-    skip = InlineKeyboardButton("Skip!", callback_data=f'button_skip_{user_id}_{medicine_name}')
+USER_INPUT_HISTORY_RANGE_CHECK = "Пожалуйста, укажи даты в формате ГГГГ-ММ-ДД, например: /history 2024-01-01 2024-01-31"
+INTAKE_HISTORY_EMPTY = "Пока ещё нет ни одной записи о приёме."
+INTAKE_HISTORY_CAPTION = "Твоя история приёма лекарств, записей: {}."
+INTAKE_HISTORY_FILE_NAME = "history.csv"
+INTAKE_HISTORY_HEADER = ("Дата", "Время", "Лекарство", "Статус")
+INTAKE_HISTORY_STATUSES = {'done': 'принято', 'skipped': 'пропущено'}
+ADHERENCE_EMPTY = "Пока нечего считать: отметь хотя бы один приём кнопками Done/Skip."
+ADHERENCE_HEADER = "Принято по кнопкам Done/Skip за 7 / 30 / 365 дней:\n"
+ADHERENCE_LINE = "*{}*: {} / {} / {}\n"
+
+
+def get_remind_keyboard(reminder_id: int) -> InlineKeyboardMarkup:
+    done = InlineKeyboardButton("Done!", callback_data=callback_codec.encode(callback_codec.ACTION_DONE, reminder_id))
+    skip = InlineKeyboardButton("Skip!", callback_data=callback_codec.encode(callback_codec.ACTION_SKIP, reminder_id))
     remind_keyboard = InlineKeyboardMarkup().add(done, skip)
     return remind_keyboard
 
@@ -79,14 +99,52 @@ def get_location_button():
     return keyboard
 
 
-def get_timezone(longitude, latitude) -> str:
-    tz_finder = TimezoneFinder()
-    timezone = tz_finder.timezone_at(lng=longitude, lat=latitude)
+# The finder loads its polygon data once per process; the cache key is the
+# coordinates rounded to ~1 km so that users from the same city share an
+# entry, while the lookup that fills it uses the exact location.
+TIMEZONE_CACHE_SIZE = 4096
+TIMEZONE_COORDINATE_PRECISION = 2
+
+_tz_finder = None
+_tz_finder_lock = threading.Lock()
+_timezone_cache: 'OrderedDict[Tuple[float, float], str]' = OrderedDict()
+
+
+def get_timezone_finder() -> TimezoneFinder:
+    global _tz_finder
+    if _tz_finder is None:
+        with _tz_finder_lock:
+            if _tz_finder is None:
+                in_memory = os.environ.get('TIMEZONE_FINDER_IN_MEMORY', '').lower() in ('1', 'true', 'yes')
+                _tz_finder = TimezoneFinder(in_memory=in_memory)
+    return _tz_finder
+
+
+def warm_timezone_finder():
+    threading.Thread(target=get_timezone_finder, name='timezone-finder-warmup', daemon=True).start()
+
+
+def _lookup_timezone(longitude: float, latitude: float) -> str:
+    timezone = get_timezone_finder().timezone_at(lng=longitude, lat=latitude)
     if not timezone:
         return "Not Found"
     return timezone
 
 
+async def get_timezone(longitude, latitude) -> str:
+    key = (round(longitude, TIMEZONE_COORDINATE_PRECISION), round(latitude, TIMEZONE_COORDINATE_PRECISION))
+    timezone = _timezone_cache.get(key)
+    if timezone is not None:
+        _timezone_cache.move_to_end(key)
+        return timezone
+    loop = asyncio.get_running_loop()
+    timezone = await loop.run_in_executor(None, _lookup_timezone, longitude, latitude)
+    _timezone_cache[key] = timezone
+    if len(_timezone_cache) > TIMEZONE_CACHE_SIZE:
+        _timezone_cache.popitem(last=False)
+    return timezone
+
+
 # other keyboards
 def get_select_medicines_keyboard(medicines: List[str]):
     select_medicines_keyboard = ReplyKeyboardMarkup(resize_keyboard=True, row_width=1)
@@ -95,39 +153,92 @@ def get_select_medicines_keyboard(medicines: List[str]):
     return select_medicines_keyboard
 
 
-def convert_timezone_to_utc_offset(timezone_name):
-    target_timezone = pytz.timezone(timezone_name)
-    utc_time = datetime.now()
-    offset_difference = target_timezone.utcoffset(utc_time)
-    utc_offset = timedelta(seconds=offset_difference.total_seconds())
-    return utc_offset
+@lru_cache(maxsize=1024)
+def get_pytz_timezone(timezone_name: str):
+    return pytz.timezone(timezone_name)
 
 
-def get_utc_hours_minutes_date(time: str, timezone: str):
-    input_time = datetime.strptime(time, '%H:%M')
-    utc_time = input_time - convert_timezone_to_utc_offset(timezone)
-    return utc_time.hour, utc_time.minute, utc_time.now()
+def get_pytz_timezone_or_utc(timezone_name: Optional[str]):
+    try:
+        return get_pytz_timezone(timezone_name)
+    except pytz.UnknownTimeZoneError:
+        return pytz.utc
 
 
-def set_reminder_cron(bot: Bot, chat_id: int, medicine_name: str, user_id: str):
-    from bot_logic.reminder_bot import scheduler
-    job = scheduler.add_job(send_reminder,
-                            trigger='interval',
-                            seconds=900,
-                            next_run_time=datetime.now(),
-                            kwargs={'bot': bot,
-                                    'chat_id': chat_id,
-                                    'user_id': user_id,
-                                    'medicine_name': medicine_name})
-    with get_connection() as connection:
-        add_interval_job(connection, medicine_name, user_id, job.id)
-
-
-async def send_reminder(bot: Bot, chat_id: int, medicine_name: str, user_id: str):
+def send_reminder(send_queue: SendQueue, chat_id: int, medicine_name: str, reminder_id: int,
+                  priority: int = PRIORITY_FIRST):
     text = REMINDER_TEXT.format(medicine_name, savouring_face)
-    await bot.send_message(chat_id, text, reply_markup=get_remind_keyboard(user_id, medicine_name))
-
-
-def get_intake_history_csv(user_id: str):
-    with get_connection() as connection:
-        return get_user_intakes(connection, user_id)
+    send_queue.submit(chat_id, text, priority=priority, reply_markup=get_remind_keyboard(reminder_id))
+
+
+def parse_history_range(args: Optional[str], timezone: Optional[str]) -> Tuple[Optional[datetime], Optional[datetime]]:
+    """Parses "[from] [to]" (YYYY-MM-DD, both inclusive, user's local days)."""
+    dates = (args or '').split()
+    if len(dates) > 2:
+        raise ValueError(args)
+    local_timezone = get_pytz_timezone_or_utc(timezone)
+    bounds = [local_timezone.localize(datetime.strptime(date, '%Y-%m-%d')) for date in dates]
+    since = bounds[0] if bounds else None
+    until = bounds[1] + timedelta(days=1) if len(bounds) == 2 else None
+    return since, until
+
+
+async def get_intake_history_csv(user_id: int, since: Optional[datetime] = None, until: Optional[datetime] = None,
+                                 chunk_size: int = 1000, max_memory_size: int = 1024 * 1024,
+                                 archive_dir: Optional[str] = INTAKE_ARCHIVE_DIR if INTAKE_HISTORY_ARCHIVES else None):
+    """Streams the user's intakes into a CSV file.
+
+    Archived months come first, read from archive_dir one month at a time,
+    then the live ones from a server-side cursor chunk by chunk. The file
+    spills to disk past max_memory_size, so a long history is never fully
+    held in memory. Returns the file rewound to the start and the number of rows.
+    """
+    csv_file = SpooledTemporaryFile(max_size=max_memory_size, mode='w+b')
+    text = io.TextIOWrapper(csv_file, encoding='utf-8-sig', newline='')
+    writer = csv.writer(text)
+    writer.writerow(INTAKE_HISTORY_HEADER)
+    rows_written = 0
+    # usually cached: no pool connection is held while the archives are read
+    timezone = get_pytz_timezone_or_utc(await cached_get_user_timezone(user_id))
+
+    def write_rows(rows):
+        for medicine_name, taken_at, status in rows:
+            taken_at = taken_at.astimezone(timezone)
+            writer.writerow((taken_at.strftime('%Y-%m-%d'), taken_at.strftime('%H:%M'),
+                             medicine_name, INTAKE_HISTORY_STATUSES.get(status, status)))
+
+    if archive_dir:
+        for archive in await asyncio.to_thread(list_archives, archive_dir):
+            if archive.covers(since, until):
+                rows = await asyncio.to_thread(read_user_intakes, archive, user_id, since, until)
+                write_rows(rows)
+                rows_written += len(rows)
+    async with get_connection() as connection:
+        async for rows in iterate_user_intakes(connection, user_id, since, until, chunk_size):
+            write_rows(rows)
+            rows_written += len(rows)
+    text.flush()
+    text.detach()
+    csv_file.seek(0)
+    return csv_file, rows_written
+
+
+def format_adherence(done: int, skipped: int) -> str:
+    total = done + skipped
+    if not total:
+        return '—'
+    return f"{round(100 * done / total)}% ({done}/{total})"
+
+
+async def get_adherence_report(user_id: int) -> str:
+    async with get_connection() as connection:
+        rows = await get_user_adherence(connection, user_id, datetime.utcnow().date())
+    if not rows:
+        return ADHERENCE_EMPTY
+    report = ADHERENCE_HEADER
+    for row in rows:
+        report += ADHERENCE_LINE.format(row['medicine_name'],
+                                        format_adherence(row['done_7'], row['skipped_7']),
+                                        format_adherence(row['done_30'], row['skipped_30']),
+                                        format_adherence(row['done_365'], row['skipped_365']))
+    return report
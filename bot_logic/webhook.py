@@ -0,0 +1,68 @@
+import hmac
+import logging
+import os
+from typing import Callable
+
+from aiohttp import web
+from aiogram import Dispatcher
+from aiogram.dispatcher.webhook import WebhookRequestHandler, BOT_DISPATCHER_KEY
+from aiogram.utils.executor import Executor
+from dotenv import load_dotenv
+
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# public https base the Bot API posts to, e.g. https://bot.example.com
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH') or '/webhook'
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+# how many updates Telegram delivers in parallel; keep it near the db pool size
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS') or 10)
+WEBAPP_HOST = os.getenv('WEBAPP_HOST') or '0.0.0.0'
+WEBAPP_PORT = int(os.getenv('WEBAPP_PORT') or 8080)
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+WEBHOOK_SECRET_KEY = 'WEBHOOK_SECRET'
+
+
+class SecretTokenRequestHandler(WebhookRequestHandler):
+    """Rejects updates that do not carry the secret token given to setWebhook."""
+
+    async def post(self):
+        received = self.request.headers.get(SECRET_TOKEN_HEADER, '')
+        if not hmac.compare_digest(received.encode(), self.request.app[WEBHOOK_SECRET_KEY].encode()):
+            logger.warning(f"Rejecting webhook request from {self.request.remote}: bad secret token")
+            raise web.HTTPUnauthorized()
+        return await super().post()
+
+
+def make_webhook_app(dispatcher: Dispatcher, secret: str, path: str = WEBHOOK_PATH) -> web.Application:
+    app = web.Application()
+    app[WEBHOOK_SECRET_KEY] = secret
+    app[BOT_DISPATCHER_KEY] = dispatcher
+    app.router.add_route('*', path, SecretTokenRequestHandler, name='webhook_handler')
+    return app
+
+
+def start_webhook(dispatcher: Dispatcher, on_startup: Callable, on_shutdown: Callable):
+    """Serves updates over a webhook instead of long polling.
+
+    The webhook is (re)registered once the bot is ready, and it is left in
+    place on shutdown so Telegram keeps updates queued across restarts.
+    """
+    if not WEBHOOK_URL or not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_URL and WEBHOOK_SECRET must be set to run in webhook mode")
+    url = WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH
+
+    async def register_webhook(dispatcher: Dispatcher):
+        await dispatcher.bot.set_webhook(url,
+                                         secret_token=WEBHOOK_SECRET,
+                                         max_connections=WEBHOOK_MAX_CONNECTIONS)
+        logger.info(f"Webhook set to {url}")
+
+    executor = Executor(dispatcher, skip_updates=False)
+    executor.on_startup([on_startup, register_webhook])
+    executor.on_shutdown(on_shutdown)
+    executor.set_webhook(web_app=make_webhook_app(dispatcher, WEBHOOK_SECRET))
+    executor.run_app(host=WEBAPP_HOST, port=WEBAPP_PORT)
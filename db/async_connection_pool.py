@@ -0,0 +1,94 @@
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, List, Optional
+
+import asyncpg
+from dotenv import load_dotenv
+
+import metrics
+
+
+load_dotenv()
+database_uri = os.environ['DATABASE_URI']
+
+pool = None
+
+# extra callbacks for every statement's asyncpg LoggedQuery record, e.g. benchmarks counting round trips
+query_listeners: List[Callable] = []
+
+# SQL text -> name of its constant in db.async_database, for the query metric label
+query_names: Optional[Dict[str, str]] = None
+
+
+def _query_name(query: str) -> str:
+    global query_names
+    if query_names is None:
+        import db.async_database as async_database
+        query_names = {value: name.lower() for name, value in vars(async_database).items()
+                       if name.isupper() and isinstance(value, str)}
+    name = query_names.get(query)
+    if name is not None:
+        return name
+    if query.startswith(('BEGIN', 'COMMIT', 'ROLLBACK', 'SAVEPOINT', 'RELEASE SAVEPOINT')):
+        return 'transaction'
+    if query.startswith('SELECT pg_advisory_unlock_all()'):
+        # asyncpg resets every connection it gets back from release()
+        return 'pool_reset'
+    return 'other'
+
+
+def _log_query(record):
+    name = _query_name(record.query)
+    metrics.DB_QUERY.observe(record.elapsed, query=name)
+    if record.exception is not None:
+        metrics.DB_QUERY_ERRORS.inc(query=name)
+    for listener in query_listeners:
+        listener(record)
+
+
+async def _instrument(connection):
+    connection.add_query_logger(_log_query)
+
+
+async def create_pool(min_size: int = 1, max_size: int = 10, server_settings: Optional[dict] = None):
+    global pool
+    if pool is None:
+        pool = await asyncpg.create_pool(dsn=database_uri, min_size=min_size, max_size=max_size,
+                                         server_settings=server_settings, init=_instrument)
+        metrics.register_stats('db_pool', 'asyncpg pool', pool_stats)
+    return pool
+
+
+async def close_pool():
+    global pool
+    if pool is not None:
+        await pool.close()
+        pool = None
+
+
+@asynccontextmanager
+async def get_connection():
+    started = time.perf_counter()
+    async with pool.acquire() as connection:
+        metrics.DB_CHECKOUT.observe(time.perf_counter() - started)
+        yield connection
+
+
+@asynccontextmanager
+async def unit_of_work():
+    """A pooled connection with everything done on it in one transaction."""
+    async with get_connection() as connection:
+        async with connection.transaction():
+            yield connection
+
+
+async def connect():
+    """A connection of its own, outside the pool, e.g. for LISTEN."""
+    return await asyncpg.connect(dsn=database_uri)
+
+
+def pool_stats() -> dict:
+    if pool is None:
+        return {}
+    return {'size': pool.get_size(), 'idle': pool.get_idle_size(), 'max_size': pool.get_max_size()}
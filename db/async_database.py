@@ -0,0 +1,314 @@
+from typing import List, Optional, Tuple
+from datetime import date, datetime, timedelta
+
+from contextlib import asynccontextmanager
+
+from db.async_connection_pool import get_connection
+from db.cache import TTLCache, user_profiles, medicine_lists
+
+# asyncpg uses numbered placeholders and does not coerce str to BIGINT,
+# so telegram ids are passed as int(user_id) everywhere below.
+# the notification makes other processes drop their cached "not registered"
+ADD_USER = """WITH added AS (
+    INSERT INTO users (user_tg_id, timezone) VALUES($1, $2) ON CONFLICT (user_tg_id) DO NOTHING RETURNING user_tg_id
+)
+SELECT pg_notify('schedules_changed', user_tg_id::TEXT) FROM added;"""
+# one statement, so the medicine, its doses and the change notification commit
+# together; pg_notify delivers a repeated payload once per transaction
+ADD_MEDICINE_WITH_SCHEDULES = """WITH medicine AS (
+    INSERT INTO medicines (medicine_name, user_id, schedule)
+    VALUES($1, $2, $3)
+    ON CONFLICT (medicine_name, user_id) DO NOTHING
+    RETURNING id, medicine_name, user_id
+), scheduled AS (
+    INSERT INTO schedules (medicine_id, medicine_name, user_id, chat_id, timezone, local_minute)
+    SELECT medicine.id, medicine.medicine_name, medicine.user_id, $4, $5, local_minute
+    FROM medicine, unnest($6::SMALLINT[]) AS local_minute
+    RETURNING id, medicine_id, user_id, chat_id, medicine_name, timezone, local_minute
+)
+SELECT id, medicine_id, user_id, chat_id, medicine_name, timezone, local_minute,
+       pg_notify('schedules_changed', user_id::TEXT)
+FROM scheduled;"""
+ADD_PENDING_REMINDERS = """INSERT INTO pending_reminders (medicine_id, user_id, chat_id, medicine_name, next_nag_at)
+SELECT medicine_id, user_id, chat_id, medicine_name, $5
+FROM unnest($1::INTEGER[], $2::BIGINT[], $3::BIGINT[], $4::TEXT[]) AS due(medicine_id, user_id, chat_id, medicine_name)
+RETURNING id, user_id, chat_id, medicine_name;"""
+ADD_INTAKE = """INSERT INTO intakes (medicine_name, user_id, taken_at, status) VALUES($1, $2, $3, $4);"""
+INTAKE_COLUMNS = ['medicine_name', 'user_id', 'taken_at', 'status']
+
+GET_TIMEZONE = """SELECT users.timezone FROM users WHERE user_tg_id = $1"""
+GET_USER_INTAKES = """SELECT medicine_name, taken_at, status FROM intakes
+WHERE user_id = $1 AND taken_at >= COALESCE($2, '-infinity'::TIMESTAMPTZ) AND taken_at < COALESCE($3, 'infinity'::TIMESTAMPTZ)
+ORDER BY taken_at"""
+
+LIST_ALL_SCHEDULES = """SELECT id, medicine_id, user_id, chat_id, medicine_name, timezone, local_minute
+FROM schedules;"""
+LIST_SHARD_SCHEDULES = """SELECT id, medicine_id, user_id, chat_id, medicine_name, timezone, local_minute
+FROM schedules
+WHERE user_id % $1 = ANY($2::INTEGER[]);"""
+LIST_USER_SCHEDULES = """SELECT id, medicine_id, user_id, chat_id, medicine_name, timezone, local_minute
+FROM schedules
+WHERE user_id = $1;"""
+LIST_ALL_MEDICINE = """SELECT medicine_name, schedule FROM medicines where user_id = $1;"""
+
+# schedules and pending_reminders rows go with it (ON DELETE CASCADE)
+DELETE_MEDICINE = """WITH deleted AS (
+    DELETE FROM medicines WHERE medicine_name = $1 AND user_id = $2 RETURNING user_id
+)
+SELECT pg_notify('schedules_changed', user_id::TEXT) FROM deleted;"""
+PURGE_ACKNOWLEDGED_REMINDERS = """DELETE FROM pending_reminders WHERE acknowledged_at < $1"""
+
+# user_id keeps a forged callback from answering someone else's reminder
+ACKNOWLEDGE_REMINDER_BY_ID = """UPDATE pending_reminders SET acknowledged_at = now()
+WHERE id = $1 AND user_id = $2 AND acknowledged_at IS NULL
+RETURNING medicine_name;"""
+# buttons sent before reminders carried their id
+ACKNOWLEDGE_REMINDER = """UPDATE pending_reminders SET acknowledged_at = now()
+WHERE medicine_name = $1 AND user_id = $2 AND acknowledged_at IS NULL
+RETURNING medicine_name;"""
+# Claiming and pushing next_nag_at forward in one statement keeps two
+# overlapping sweeps from nagging the same reminder twice.
+CLAIM_OVERDUE_REMINDERS = """UPDATE pending_reminders SET next_nag_at = $2
+WHERE acknowledged_at IS NULL AND next_nag_at <= $1
+RETURNING id, user_id, chat_id, medicine_name;"""
+
+# At most 365 rollup rows per medicine, however many intakes the user has.
+GET_USER_ADHERENCE = """SELECT medicine_name,
+       COALESCE(sum(done_count) FILTER (WHERE day > $2::DATE - 7), 0) AS done_7,
+       COALESCE(sum(skipped_count) FILTER (WHERE day > $2::DATE - 7), 0) AS skipped_7,
+       COALESCE(sum(done_count) FILTER (WHERE day > $2::DATE - 30), 0) AS done_30,
+       COALESCE(sum(skipped_count) FILTER (WHERE day > $2::DATE - 30), 0) AS skipped_30,
+       sum(done_count) AS done_365,
+       sum(skipped_count) AS skipped_365
+FROM intake_daily_rollups
+WHERE user_id = $1 AND day > $2::DATE - 365 AND day <= $2::DATE
+GROUP BY medicine_name
+ORDER BY medicine_name;"""
+
+GET_FSM_STATE = """SELECT state, data::TEXT, bucket::TEXT FROM fsm_states
+WHERE chat_id = $1 AND user_id = $2 AND updated_at > now() - $3::INTERVAL;"""
+SAVE_FSM_STATES = """INSERT INTO fsm_states (chat_id, user_id, state, data, bucket, updated_at)
+SELECT chat_id, user_id, state, data::JSONB, bucket::JSONB, now()
+FROM unnest($1::BIGINT[], $2::BIGINT[], $3::TEXT[], $4::TEXT[], $5::TEXT[]) AS fsm(chat_id, user_id, state, data, bucket)
+ON CONFLICT (chat_id, user_id) DO UPDATE
+SET state = EXCLUDED.state, data = EXCLUDED.data, bucket = EXCLUDED.bucket, updated_at = EXCLUDED.updated_at;"""
+DELETE_FSM_STATES = """DELETE FROM fsm_states
+WHERE (chat_id, user_id) IN (SELECT * FROM unnest($1::BIGINT[], $2::BIGINT[]));"""
+PURGE_FSM_STATES = """DELETE FROM fsm_states WHERE updated_at < now() - $1::INTERVAL;"""
+
+REGISTER_SCHEDULER_WORKER = """INSERT INTO scheduler_workers (worker_id) VALUES($1)
+ON CONFLICT (worker_id) DO UPDATE SET seen_at = now();"""
+EXPIRE_SCHEDULER_WORKERS = """DELETE FROM scheduler_workers WHERE seen_at < now() - $1::INTERVAL;"""
+UNREGISTER_SCHEDULER_WORKER = """DELETE FROM scheduler_workers WHERE worker_id = $1;"""
+COUNT_SCHEDULER_WORKERS = """SELECT count(*) FROM scheduler_workers;"""
+ADD_SCHEDULER_SHARDS = """INSERT INTO scheduler_shards (shard) SELECT generate_series(0, $1 - 1)
+ON CONFLICT (shard) DO NOTHING;"""
+RENEW_SHARD_LEASES = """UPDATE scheduler_shards SET lease_until = now() + $2::INTERVAL
+WHERE owner = $1 AND shard < $3
+RETURNING shard, fired_until;"""
+# SKIP LOCKED lets workers that heartbeat at the same moment split the free
+# shards between them instead of queueing on the same rows.
+CLAIM_SHARD_LEASES = """UPDATE scheduler_shards SET owner = $1, lease_until = now() + $2::INTERVAL
+WHERE shard IN (SELECT shard FROM scheduler_shards
+                WHERE lease_until <= now() AND shard < $3
+                ORDER BY shard
+                LIMIT $4
+                FOR UPDATE SKIP LOCKED)
+RETURNING shard, fired_until;"""
+RELEASE_SHARD_LEASES = """UPDATE scheduler_shards SET owner = NULL, lease_until = '-infinity'
+WHERE owner = $1 AND shard = ANY($2::INTEGER[]);"""
+MARK_SHARDS_FIRED = """UPDATE scheduler_shards SET fired_until = $3
+WHERE owner = $1 AND shard = ANY($2::INTEGER[]);"""
+
+CHECK_USER = "SELECT EXISTS (SELECT 1 FROM users WHERE user_tg_id = $1);"
+
+
+@asynccontextmanager
+async def get_transaction(connection):
+    async with connection.transaction():
+        yield connection
+
+
+async def add_user(connection, user_id: int, timezone: str = 'NA'):
+    await connection.execute(ADD_USER, int(user_id), timezone)
+    user_profiles.invalidate(int(user_id))
+
+
+async def check_user_exists(connection, user_id: int) -> bool:
+    return await connection.fetchval(CHECK_USER, int(user_id))
+
+
+async def add_medicine_with_schedules(connection, medicine_name: str, user_id: int, chat_id: int,
+                                     schedule: str, timezone: str, local_minutes: List[int]):
+    """The new doses as schedule rows, none if the user already has this medicine."""
+    rows = await connection.fetch(ADD_MEDICINE_WITH_SCHEDULES, medicine_name, int(user_id), schedule,
+                                  chat_id, timezone, local_minutes)
+    medicine_lists.invalidate(int(user_id))
+    return rows
+
+
+async def add_pending_reminders(connection, doses, next_nag_at: datetime):
+    """Rows (id, user_id, chat_id, medicine_name) of the new reminders."""
+    return await connection.fetch(ADD_PENDING_REMINDERS,
+                                  [dose.medicine_id for dose in doses],
+                                  [int(dose.user_id) for dose in doses],
+                                  [dose.chat_id for dose in doses],
+                                  [dose.medicine_name for dose in doses],
+                                  next_nag_at)
+
+
+async def add_intake(connection, medicine_name: str, user_id: int, taken_at: datetime, status: str):
+    await connection.execute(ADD_INTAKE, medicine_name, int(user_id), taken_at, status)
+
+
+async def add_intakes(connection, intakes: List[Tuple[str, int, datetime, str]]):
+    await connection.copy_records_to_table('intakes', records=intakes, columns=INTAKE_COLUMNS)
+
+
+async def list_all_medicines(connection, user_id: int) -> List[Tuple[str, str]]:
+    rows = await connection.fetch(LIST_ALL_MEDICINE, int(user_id))
+    return [(medicine[0], medicine[1]) for medicine in rows]
+
+
+async def delete_medicine(connection, medicine_name: str, user_id: int):
+    """Also tells every worker's reminder dispatcher to reload this user's doses."""
+    await connection.execute(DELETE_MEDICINE, medicine_name, int(user_id))
+    medicine_lists.invalidate(int(user_id))
+
+
+async def get_user_timezone(connection, user_id: int) -> Optional[str]:
+    return await connection.fetchval(GET_TIMEZONE, int(user_id))
+
+
+async def list_all_schedules(connection):
+    return await connection.fetch(LIST_ALL_SCHEDULES)
+
+
+async def iterate_schedules(connection, shard_count: Optional[int] = None, shards: Optional[List[int]] = None,
+                            chunk_size: int = 5000):
+    """Yields every schedule, or those of the given shards, in chunks from a server-side cursor."""
+    async with get_transaction(connection):
+        if shards is None:
+            cursor = await connection.cursor(LIST_ALL_SCHEDULES)
+        else:
+            cursor = await connection.cursor(LIST_SHARD_SCHEDULES, shard_count, shards)
+        while True:
+            rows = await cursor.fetch(chunk_size)
+            if not rows:
+                return
+            yield rows
+
+
+async def list_user_schedules(connection, user_id: int):
+    return await connection.fetch(LIST_USER_SCHEDULES, int(user_id))
+
+
+async def acknowledge_reminder_by_id(connection, reminder_id: int, user_id: int) -> Optional[str]:
+    """The reminder's medicine name, None if it is not this user's or was already answered."""
+    return await connection.fetchval(ACKNOWLEDGE_REMINDER_BY_ID, reminder_id, int(user_id))
+
+
+async def acknowledge_reminder(connection, medicine_name: str, user_id: int) -> Optional[str]:
+    """The medicine name, None if the user has no unanswered reminder for it."""
+    return await connection.fetchval(ACKNOWLEDGE_REMINDER, medicine_name, int(user_id))
+
+
+async def claim_overdue_reminders(connection, now: datetime, next_nag_at: datetime):
+    return await connection.fetch(CLAIM_OVERDUE_REMINDERS, now, next_nag_at)
+
+
+async def purge_acknowledged_reminders(connection, older_than: datetime):
+    await connection.execute(PURGE_ACKNOWLEDGED_REMINDERS, older_than)
+
+
+async def iterate_user_intakes(connection, user_id: int, since: Optional[datetime] = None,
+                               until: Optional[datetime] = None, chunk_size: int = 1000):
+    """Yields the user's intakes in chunks from a server-side cursor."""
+    async with get_transaction(connection):
+        cursor = await connection.cursor(GET_USER_INTAKES, int(user_id), since, until)
+        while True:
+            rows = await cursor.fetch(chunk_size)
+            if not rows:
+                return
+            yield rows
+
+
+async def get_user_adherence(connection, user_id: int, today: date):
+    return await connection.fetch(GET_USER_ADHERENCE, int(user_id), today)
+
+
+async def get_fsm_state(connection, chat_id: int, user_id: int, ttl: timedelta):
+    return await connection.fetchrow(GET_FSM_STATE, chat_id, user_id, ttl)
+
+
+async def save_fsm_states(connection, records: List[Tuple[int, int, Optional[str], str, str]]):
+    """Upserts (chat_id, user_id, state, data json, bucket json) records in one statement."""
+    chat_ids, user_ids, states, data, buckets = (list(column) for column in zip(*records))
+    await connection.execute(SAVE_FSM_STATES, chat_ids, user_ids, states, data, buckets)
+
+
+async def delete_fsm_states(connection, keys: List[Tuple[int, int]]):
+    chat_ids, user_ids = (list(column) for column in zip(*keys))
+    await connection.execute(DELETE_FSM_STATES, chat_ids, user_ids)
+
+
+async def purge_fsm_states(connection, ttl: timedelta):
+    await connection.execute(PURGE_FSM_STATES, ttl)
+
+
+async def heartbeat_scheduler_worker(connection, worker_id: str, shard_count: int, ttl: timedelta) -> int:
+    """Marks the worker alive, forgets dead ones and returns how many are alive."""
+    await connection.execute(REGISTER_SCHEDULER_WORKER, worker_id)
+    await connection.execute(EXPIRE_SCHEDULER_WORKERS, ttl)
+    await connection.execute(ADD_SCHEDULER_SHARDS, shard_count)
+    return await connection.fetchval(COUNT_SCHEDULER_WORKERS)
+
+
+async def unregister_scheduler_worker(connection, worker_id: str):
+    await connection.execute(UNREGISTER_SCHEDULER_WORKER, worker_id)
+
+
+async def renew_shard_leases(connection, worker_id: str, ttl: timedelta, shard_count: int):
+    return await connection.fetch(RENEW_SHARD_LEASES, worker_id, ttl, shard_count)
+
+
+async def claim_shard_leases(connection, worker_id: str, ttl: timedelta, shard_count: int, limit: int):
+    return await connection.fetch(CLAIM_SHARD_LEASES, worker_id, ttl, shard_count, limit)
+
+
+async def release_shard_leases(connection, worker_id: str, shards: List[int]):
+    await connection.execute(RELEASE_SHARD_LEASES, worker_id, shards)
+
+
+async def mark_shards_fired(connection, worker_id: str, shards: List[int], fired_until: datetime):
+    await connection.execute(MARK_SHARDS_FIRED, worker_id, shards, fired_until)
+
+
+# Read-through variants for the button handlers: a cache hit does not even
+# check a connection out of the pool. Pass a connection when the caller
+# already holds one.
+async def _read_through(cache: TTLCache, key: int, read, connection=None):
+    hit, value = cache.get(key)
+    if hit:
+        return value
+    # a write committed while we wait for the read invalidates the key; what we read may predate it
+    generation = cache.generation()
+    if connection is not None:
+        value = await read(connection, key)
+    else:
+        async with get_connection() as connection:
+            value = await read(connection, key)
+    cache.set(key, value, generation)
+    return value
+
+
+async def cached_get_user_timezone(user_id: int, connection=None) -> Optional[str]:
+    return await _read_through(user_profiles, int(user_id), get_user_timezone, connection)
+
+
+async def cached_check_user_exists(user_id: int, connection=None) -> bool:
+    return await cached_get_user_timezone(user_id, connection) is not None
+
+
+async def cached_list_all_medicines(user_id: int, connection=None) -> List[Tuple[str, str]]:
+    return await _read_through(medicine_lists, int(user_id), list_all_medicines, connection)
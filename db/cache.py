@@ -0,0 +1,74 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+
+class TTLCache:
+    """LRU cache whose entries also expire after ttl seconds.
+
+    A reader that takes generation() before going to the database and
+    passes it to set() does not cache what it read if the key was
+    invalidated in the meantime.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries: 'OrderedDict[Hashable, Tuple[float, Any]]' = OrderedDict()
+        self.invalidations = 0
+        # key -> number of the invalidation that last hit it; keys invalidated
+        # before the dict was last emptied count as invalidated at floor
+        self.invalidated: Dict[Hashable, int] = {}
+        self.floor = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        entry = self.entries.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True, value
+            del self.entries[key]
+        self.misses += 1
+        return False, None
+
+    def generation(self) -> int:
+        return self.invalidations
+
+    def set(self, key: Hashable, value: Any, generation: Optional[int] = None):
+        if generation is not None and self.invalidated.get(key, self.floor) > generation:
+            return
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        self.entries.pop(key, None)
+        self.invalidations += 1
+        if len(self.invalidated) >= self.maxsize:
+            self.invalidated.clear()
+            self.floor = self.invalidations
+        self.invalidated[key] = self.invalidations
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self) -> dict:
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+# user_id -> timezone, or None for users that have not finished /start
+user_profiles = TTLCache(maxsize=10000, ttl=600)
+# user_id -> [(medicine_name, schedule), ...]
+medicine_lists = TTLCache(maxsize=10000, ttl=600)
+
+
+def cache_stats() -> dict:
+    return {'user_profiles': user_profiles.stats(), 'medicine_lists': medicine_lists.stats()}
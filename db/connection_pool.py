@@ -1,18 +1,259 @@
+import logging
 import os
+import threading
+import time
+from collections import deque
 from contextlib import contextmanager
-from psycopg2.pool import SimpleConnectionPool
+from typing import Deque, Dict, Optional, Tuple
+
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.pool import PoolError
 from dotenv import load_dotenv
 
+import metrics
+
+
+logger = logging.getLogger(__name__)
 
 load_dotenv()
 database_uri = os.environ['DATABASE_URI']
 
-pool = SimpleConnectionPool(minconn=1, maxconn=10, dsn=database_uri)
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE') or 1)
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE') or 10)
+# seconds a checkout may wait for a free connection, or for Postgres to come back
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT') or 30)
+# connections are replaced after this many seconds
+DB_POOL_MAX_AGE = float(os.getenv('DB_POOL_MAX_AGE') or 3600)
+# idle connections above the minimum size are closed after this many seconds
+DB_POOL_MAX_IDLE = float(os.getenv('DB_POOL_MAX_IDLE') or 600)
+# a connection idle for longer than this is pinged before it is handed out
+DB_POOL_CHECK_AFTER = float(os.getenv('DB_POOL_CHECK_AFTER') or 30)
+
+RECONNECT_DELAY = 0.1
+MAX_RECONNECT_DELAY = 5.0
+
+DISCONNECT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+
+class PoolTimeout(PoolError):
+    pass
+
+
+class Waiter:
+    __slots__ = ('event', 'connection', 'may_connect')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.connection = None
+        # handed a free slot instead of a connection: open a new one
+        self.may_connect = False
+
+
+class ConnectionPool:
+    """A thread-safe psycopg2 pool that makes callers wait instead of failing.
+
+    Waiters are served in arrival order: a returned connection goes straight
+    to the longest waiting caller. Connections that have been idle for a
+    while are pinged before they are handed out, dead ones are replaced,
+    reconnecting with exponential backoff until the checkout times out, and
+    every connection is retired once it reaches max_age.
+    """
+
+    def __init__(self, dsn: str = database_uri,
+                 min_size: int = DB_POOL_MIN_SIZE,
+                 max_size: int = DB_POOL_MAX_SIZE,
+                 timeout: float = DB_POOL_TIMEOUT,
+                 max_age: float = DB_POOL_MAX_AGE,
+                 max_idle: float = DB_POOL_MAX_IDLE,
+                 check_after: float = DB_POOL_CHECK_AFTER):
+        if not 0 <= min_size <= max_size or max_size < 1:
+            raise ValueError(f"Bad pool size {min_size}..{max_size}")
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_age = max_age
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self.lock = threading.Lock()
+        # (connection, returned_at); the most recently returned is reused first
+        self.idle: Deque[Tuple[extensions.connection, float]] = deque()
+        self.created: Dict[extensions.connection, float] = {}
+        self.waiters: Deque[Waiter] = deque()
+        self.size = 0
+        self.closed = False
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+        self.reconnects = 0
+        self.discarded = 0
+
+    def getconn(self, timeout: Optional[float] = None) -> extensions.connection:
+        started = time.monotonic()
+        deadline = started + (self.timeout if timeout is None else timeout)
+        connection, returned_at, waiter = None, 0.0, None
+        with self.lock:
+            if self.closed:
+                raise PoolError("Connection pool is closed")
+            self._shrink(started)
+            if not self.waiters and self.idle:
+                connection, returned_at = self.idle.pop()
+            elif not self.waiters and self.size < self.max_size:
+                self.size += 1
+            else:
+                waiter = Waiter()
+                self.waiters.append(waiter)
+        if waiter is not None:
+            self._wait(waiter, started, deadline)
+            connection, returned_at = waiter.connection, time.monotonic()
+        if connection is not None:
+            connection = self._check(connection, returned_at, deadline)
+        else:
+            connection = self._open_slot(deadline)
+        with self.lock:
+            self.checkouts += 1
+        return connection
+
+    def _wait(self, waiter: Waiter, started: float, deadline: float):
+        arrived = waiter.event.wait(max(deadline - time.monotonic(), 0))
+        waited = time.monotonic() - started
+        with self.lock:
+            if not arrived and not waiter.event.is_set():
+                self.waiters.remove(waiter)
+                self.timeouts += 1
+                raise PoolTimeout(f"No connection free after {waited:.1f}s "
+                                  f"({self.size} open, {len(self.waiters)} waiting)")
+            self.waits += 1
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+    def _check(self, connection, returned_at: float, deadline: float) -> extensions.connection:
+        """Hands connection out if it is alive and young enough, else a new one in its slot."""
+        now = time.monotonic()
+        healthy = not connection.closed and not self._expired(connection, now)
+        if healthy and now - returned_at > self.check_after:
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+                connection.rollback()
+            except DISCONNECT_ERRORS:
+                healthy = False
+        if healthy:
+            return connection
+        self._close(connection)
+        return self._open_slot(deadline)
+
+    def _expired(self, connection, now: float) -> bool:
+        created = self.created.get(connection)
+        return created is None or now - created >= self.max_age
+
+    def _open_slot(self, deadline: float) -> extensions.connection:
+        """Connects for a slot already counted in size, retrying with backoff until the deadline."""
+        delay = RECONNECT_DELAY
+        while True:
+            try:
+                connection = psycopg2.connect(self.dsn)
+            except psycopg2.OperationalError as error:
+                if time.monotonic() + delay > deadline:
+                    self._release_slot()
+                    with self.lock:
+                        self.timeouts += 1
+                    raise PoolTimeout(f"Could not connect to the database: {error}") from error
+                with self.lock:
+                    self.reconnects += 1
+                logger.warning(f"Connecting to the database failed, retrying in {delay:.1f}s: {error}")
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+                continue
+            except BaseException:
+                self._release_slot()
+                raise
+            with self.lock:
+                self.created[connection] = time.monotonic()
+            return connection
+
+    def putconn(self, connection: extensions.connection, discard: bool = False):
+        if not discard and not connection.closed:
+            try:
+                if connection.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+            except DISCONNECT_ERRORS:
+                discard = True
+        if discard or connection.closed or self._expired(connection, time.monotonic()):
+            self._close(connection)
+            self._release_slot()
+            return
+        with self.lock:
+            if self.closed:
+                self.size -= 1
+            elif self.waiters:
+                waiter = self.waiters.popleft()
+                waiter.connection = connection
+                waiter.event.set()
+                return
+            else:
+                self.idle.append((connection, time.monotonic()))
+                return
+        self._close(connection)
+
+    def _release_slot(self):
+        with self.lock:
+            if self.waiters and not self.closed:
+                waiter = self.waiters.popleft()
+                waiter.may_connect = True
+                waiter.event.set()
+            else:
+                self.size -= 1
+
+    def _close(self, connection):
+        with self.lock:
+            self.created.pop(connection, None)
+            self.discarded += 1
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+    def _shrink(self, now: float):
+        # under self.lock; idle is ordered by return time, oldest first
+        while len(self.idle) > self.min_size and now - self.idle[0][1] > self.max_idle:
+            connection, _ = self.idle.popleft()
+            self.size -= 1
+            self.created.pop(connection, None)
+            connection.close()
+
+    def closeall(self):
+        with self.lock:
+            self.closed = True
+            idle, self.idle = self.idle, deque()
+            self.size -= len(idle)
+        for connection, _ in idle:
+            self._close(connection)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'size': self.size, 'idle': len(self.idle), 'in_use': self.size - len(self.idle),
+                    'waiting': len(self.waiters), 'max_size': self.max_size, 'checkouts': self.checkouts,
+                    'waits': self.waits, 'wait_seconds_total': self.wait_seconds,
+                    'wait_seconds_max': self.max_wait_seconds, 'timeouts': self.timeouts,
+                    'reconnects': self.reconnects, 'discarded': self.discarded}
+
+
+pool = ConnectionPool()
+metrics.register_stats('sync_db_pool', 'psycopg2 pool for migrations and maintenance', pool.stats)
+
 
 @contextmanager
-def get_connection():
-    connection = pool.getconn()
+def get_connection(timeout: Optional[float] = None):
+    connection = pool.getconn(timeout)
+    discard = False
     try:
         yield connection
+    except DISCONNECT_ERRORS:
+        discard = True
+        raise
     finally:
-        pool.putconn(connection)
\ No newline at end of file
+        pool.putconn(connection, discard=discard)
@@ -1,61 +1,33 @@
-from typing import List, Tuple
+from typing import List, Optional, Tuple
+from datetime import datetime
 
 from contextlib import contextmanager
 
-CREATE_USERS_TABLE = """CREATE TABLE IF NOT EXISTS users
-(id SERIAL PRIMARY KEY,
-user_tg_id TEXT UNIQUE,
-timezone TEXT);"""
-CREATE_MEDICINES_TABLE = """CREATE TABLE IF NOT EXISTS medicines 
-(id SERIAL PRIMARY KEY,
-medicine_name TEXT,
-user_id TEXT,
-schedule TEXT,
-FOREIGN KEY(user_id) REFERENCES users(user_tg_id),
-UNIQUE(medicine_name, user_id));"""
-CREATE_JOBS_TABLE = """CREATE TABLE IF NOT EXISTS jobs
-(
-id SERIAL PRIMARY KEY,
-medicine_name TEXT,
-user_id TEXT,
-job_id TEXT
-);"""
-CREATE_INTERVAL_JOBS_TABLE = """
-CREATE TABLE IF NOT EXISTS interval_jobs
-(
-id SERIAL PRIMARY KEY,
-medicine_name TEXT,
-user_id TEXT,
-job_id TEXT
-);"""
-CREATE_INTAKES_TABLE = """CREATE TABLE IF NOT EXISTS intakes
-(
-id SERIAL PRIMARY KEY,
-user_id TEXT,
-medicine_name TEXT,
-date TEXT,
-status TEXT
-);"""
-
+# The schema itself lives in db/migrations.
 ADD_USER = "INSERT INTO users (user_tg_id, timezone) VALUES(%s, %s) ON CONFLICT (user_tg_id) DO NOTHING;"
 ADD_MEDICINE = """INSERT INTO medicines (medicine_name, user_id, schedule)
 VALUES(%s, %s, %s)
 ON CONFLICT (medicine_name, user_id) DO NOTHING
-RETURNING medicine_name;"""
-ADD_JOB = """INSERT INTO jobs (medicine_name, user_id, job_id) VALUES(%s, %s, %s);"""
-ADD_INTERVAL_JOB = """INSERT INTO interval_jobs (medicine_name, user_id, job_id) VALUES(%s, %s, %s);"""
-ADD_INTAKE = """INSERT INTO intakes (user_id, medicine_name, date, status) VALUES(%s, %s, %s, %s);"""
+RETURNING id;"""
+ADD_SCHEDULE = """INSERT INTO schedules (medicine_id, medicine_name, user_id, chat_id, timezone, local_minute)
+VALUES(%s, %s, %s, %s, %s, %s)
+RETURNING id;"""
+ADD_PENDING_REMINDER = """INSERT INTO pending_reminders (medicine_id, medicine_name, user_id, chat_id, next_nag_at)
+VALUES(%s, %s, %s, %s, %s);"""
+ADD_INTAKE = """INSERT INTO intakes (medicine_name, user_id, taken_at, status) VALUES(%s, %s, %s, %s);"""
+
+GET_TIMEZONE = """SELECT users.timezone FROM users WHERE user_tg_id = %s"""
+GET_USER_INTAKES = """SELECT medicine_name, taken_at, status FROM intakes WHERE user_id = %s ORDER BY taken_at"""
 
-GET_JOB_IDS = """SELECT jobs.job_id FROM jobs WHERE medicine_name = %s AND user_id = %s;"""
-GET_INTERVAL_JOB_ID = """SELECT interval_jobs.job_id FROM interval_jobs WHERE medicine_name = %s AND user_id = %s;"""
-GET_TIMEZONE = """SELECT users.timezone FROM users WHERE user_tg_id = %s::TEXT"""
-GET_USER_INTAKES = """SELECT medicine_name, date, status FROM intakes WHERE user_id = %s::TEXT"""
+LIST_ALL_SCHEDULES = """SELECT id, medicine_id, user_id, chat_id, medicine_name, timezone, local_minute
+FROM schedules;"""
+LIST_ALL_MEDICINE = """SELECT medicine_name, schedule FROM medicines where user_id = %s;"""
 
-LIST_ALL_MEDICINE = """SELECT medicine_name, schedule FROM medicines where user_id = %s::TEXT;"""
+# schedules and pending_reminders rows go with it (ON DELETE CASCADE)
+DELETE_MEDICINE = """DELETE FROM medicines WHERE medicine_name = %s AND user_id = %s"""
 
-DELETE_MEDICINE = """DELETE FROM medicines WHERE medicine_name = %s AND user_id = %s::TEXT"""
-DELETE_MEDICINE_JOBS = """DELETE FROM jobs WHERE medicine_name = %s AND user_id = %s::TEXT"""
-DELETE_INTERVAL_JOB = """DELETE FROM interval_jobs WHERE medicine_name = %s AND user_id = %s::TEXT"""
+ACKNOWLEDGE_REMINDER = """UPDATE pending_reminders SET acknowledged_at = now()
+WHERE medicine_name = %s AND user_id = %s AND acknowledged_at IS NULL;"""
 
 CHECK_USER = "SELECT EXISTS (SELECT 1 FROM users WHERE user_tg_id = %s);"
 
@@ -67,102 +39,75 @@ def get_cursor(connection):
             yield cursor
 
 
-def create_tables(connection):
-    with get_cursor(connection) as cursor:
-        cursor.execute(CREATE_USERS_TABLE)
-        cursor.execute(CREATE_MEDICINES_TABLE)
-        cursor.execute(CREATE_JOBS_TABLE)
-        cursor.execute(CREATE_INTERVAL_JOBS_TABLE)
-        cursor.execute(CREATE_INTAKES_TABLE)
-
-
-def add_user(connection, user_id: str,  timezone: str = 'NA'):
+def add_user(connection, user_id: int,  timezone: str = 'NA'):
     with get_cursor(connection) as cursor:
         cursor.execute(ADD_USER, (user_id, timezone))
 
 
-def check_user_exists(connection, user_id: str) -> bool:
+def check_user_exists(connection, user_id: int) -> bool:
     with get_cursor(connection) as cursor:
-        try:
-            cursor.execute(CHECK_USER, (user_id,))
-            return True
-        except:
-            return False
-
-
+        cursor.execute(CHECK_USER, (user_id,))
+        return cursor.fetchone()[0]
 
 
-def add_medicine(connection, medicine_name: str, user_id: str, schedule: str) -> str:
+def add_medicine(connection, medicine_name: str, user_id: int, schedule: str) -> Optional[int]:
     with get_cursor(connection) as cursor:
         cursor.execute(ADD_MEDICINE, (medicine_name, user_id, schedule))
         result = cursor.fetchone()
         if result is not None:
             return result[0]
         else:
-            return ''
+            return None
 
 
-def add_medicine_job(connection, medicine_name: str, user_id: str, job_id: str):
+def add_medicine_schedule(connection, medicine_id: int, medicine_name: str, user_id: int,
+                          chat_id: int, timezone: str, local_minute: int) -> int:
     with get_cursor(connection) as cursor:
-        cursor.execute(ADD_JOB, (medicine_name, user_id, job_id))
+        cursor.execute(ADD_SCHEDULE, (medicine_id, medicine_name, user_id, chat_id, timezone, local_minute))
+        return cursor.fetchone()[0]
 
 
-def add_interval_job(connection, medicine_name: str, user_id: str, job_id: str):
+def add_pending_reminder(connection, medicine_id: int, medicine_name: str, user_id: int, chat_id: int,
+                         next_nag_at: datetime):
     with get_cursor(connection) as cursor:
-        cursor.execute(ADD_INTERVAL_JOB, (medicine_name, user_id, job_id))
+        cursor.execute(ADD_PENDING_REMINDER, (medicine_id, medicine_name, user_id, chat_id, next_nag_at))
 
 
-def add_intake(connection, medicine_name: str, user_id: str, date: str, status: str):
+def add_intake(connection, medicine_name: str, user_id: int, taken_at: datetime, status: str):
     with get_cursor(connection) as cursor:
-        cursor.execute(ADD_INTAKE, (medicine_name, user_id, date, status))
+        cursor.execute(ADD_INTAKE, (medicine_name, user_id, taken_at, status))
 
 
-def list_all_medicines(connection, user_id: str) -> List[Tuple[str, str]]:
+def list_all_medicines(connection, user_id: int) -> List[Tuple[str, str]]:
     with get_cursor(connection) as cursor:
         cursor.execute(LIST_ALL_MEDICINE, (user_id,))
         return [(medicine[0], medicine[1]) for medicine in cursor.fetchall()]
 
 
-def delete_medicine(connection, medicine_name: str, user_id: str):
+def delete_medicine(connection, medicine_name: str, user_id: int):
     with get_cursor(connection) as cursor:
         cursor.execute(DELETE_MEDICINE, (medicine_name, user_id))
-        cursor.execute(DELETE_MEDICINE_JOBS, (medicine_name, user_id))
 
 
-def delete_tables(connection):
-    with get_cursor(connection) as cursor:
-        cursor.execute('DROP TABLE medicines;')
-        cursor.execute('DROP TABLE users;')
-        cursor.execute('DROP TABLE jobs;')
-        cursor.execute('DROP TABLE intakes;')
-        cursor.execute('DROP TABLE interval_jobs;')
-
-
-def get_user_timezone(connection, user_id) -> str:
+def get_user_timezone(connection, user_id: int) -> Optional[str]:
     with get_cursor(connection) as cursor:
         cursor.execute(GET_TIMEZONE, (user_id,))
-        return [row[0] for row in cursor.fetchall()][0]
+        row = cursor.fetchone()
+        return row[0] if row is not None else None
 
 
-def get_medicine_jobs(connection, medicine_name: str, user_id: str) -> List[str]:
+def list_all_schedules(connection):
     with get_cursor(connection) as cursor:
-        cursor.execute(GET_JOB_IDS, (medicine_name, user_id))
-        return [row[0] for row in cursor.fetchall()]
-
-
-def get_interval_job(connection, medicine_name: str, user_id: str) -> str:
-    with get_cursor(connection) as cursor:
-        cursor.execute(GET_INTERVAL_JOB_ID, (medicine_name, user_id))
-        job_id = cursor.fetchall()
-        return job_id[0]
+        cursor.execute(LIST_ALL_SCHEDULES)
+        return cursor.fetchall()
 
 
-def delete_interval_job(connection, medicine_name: str, user_id: str):
+def acknowledge_reminder(connection, medicine_name: str, user_id: int):
     with get_cursor(connection) as cursor:
-        cursor.execute(DELETE_INTERVAL_JOB, (medicine_name, user_id))
+        cursor.execute(ACKNOWLEDGE_REMINDER, (medicine_name, user_id))
 
 
-def get_user_intakes(connection, user_id: str):
+def get_user_intakes(connection, user_id: int):
     with get_cursor(connection) as cursor:
         cursor.execute(GET_USER_INTAKES, (user_id,))
         return cursor.fetchall()
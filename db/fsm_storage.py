@@ -0,0 +1,250 @@
+import asyncio
+import copy
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Dict, Optional, Set, Tuple, Union
+
+from aiogram.dispatcher.storage import BaseStorage
+from dotenv import load_dotenv
+
+from db.async_connection_pool import get_connection, unit_of_work
+from db.async_database import get_fsm_state, save_fsm_states, delete_fsm_states, purge_fsm_states
+
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# seconds a conversation read from Postgres is served from memory; 0 when several copies receive updates
+FSM_CACHE_TTL = float(os.getenv('FSM_CACHE_TTL') or 5)
+# seconds between batched writes of changed conversations; must be above 0
+FSM_FLUSH_INTERVAL = float(os.getenv('FSM_FLUSH_INTERVAL') or 0.05)
+
+Key = Tuple[int, int]
+
+
+class FSMRecord:
+    __slots__ = ('state', 'data', 'bucket', 'loaded_at')
+
+    def __init__(self, state: Optional[str] = None, data: Optional[dict] = None, bucket: Optional[dict] = None):
+        self.state = state
+        self.data = data or {}
+        self.bucket = bucket or {}
+        self.loaded_at = time.monotonic()
+
+    def is_empty(self) -> bool:
+        return self.state is None and not self.data and not self.bucket
+
+
+class PostgresStorage(BaseStorage):
+    """aiogram FSM storage that keeps conversations in the fsm_states table.
+
+    Writes land in a local cache and are persisted by a background task
+    every flush_interval seconds as one batched upsert, so the several
+    set_state/set_data calls of a single handler cost one row write.
+    Reads are served locally for cache_ttl seconds; with several worker
+    processes serving the same users, set cache_ttl (FSM_CACHE_TTL) to 0
+    (always read from Postgres) unless each user is routed to a single
+    worker.
+    Conversations untouched for state_ttl are treated as abandoned.
+    """
+
+    def __init__(self,
+                 state_ttl: timedelta = timedelta(days=1),
+                 cache_ttl: float = FSM_CACHE_TTL,
+                 cache_size: int = 10000,
+                 flush_interval: float = FSM_FLUSH_INTERVAL,
+                 purge_interval: float = 600):
+        self.state_ttl = state_ttl
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self.purge_interval = purge_interval
+        self.records: 'OrderedDict[Key, FSMRecord]' = OrderedDict()
+        self.dirty: Set[Key] = set()
+        self.flushing: Set[Key] = set()
+        self.task: Optional[asyncio.Task] = None
+        self.last_purge = time.monotonic()
+        self.cache_reads = 0
+        self.db_reads = 0
+        self.rows_flushed = 0
+        self.flushes = 0
+
+    # --- local cache
+
+    def _key(self, chat, user) -> Key:
+        chat, user = self.check_address(chat=chat, user=user)
+        return int(chat), int(user)
+
+    def _is_fresh(self, key: Key, record: FSMRecord) -> bool:
+        return (key in self.dirty or key in self.flushing
+                or time.monotonic() - record.loaded_at < self.cache_ttl)
+
+    def _remember(self, key: Key, record: FSMRecord):
+        self.records[key] = record
+        self.records.move_to_end(key)
+        if len(self.records) > self.cache_size:
+            for old_key in list(self.records):
+                if len(self.records) <= self.cache_size:
+                    break
+                if old_key not in self.dirty and old_key not in self.flushing:
+                    del self.records[old_key]
+
+    async def _get(self, chat, user) -> Tuple[Key, FSMRecord]:
+        key = self._key(chat, user)
+        record = self.records.get(key)
+        if record is not None and self._is_fresh(key, record):
+            self.records.move_to_end(key)
+            self.cache_reads += 1
+            return key, record
+        async with get_connection() as connection:
+            row = await get_fsm_state(connection, key[0], key[1], self.state_ttl)
+        self.db_reads += 1
+        cached = self.records.get(key)
+        if cached is not None and self._is_fresh(key, cached):
+            # a concurrent handler loaded or changed it while we were waiting
+            return key, cached
+        if row is None:
+            record = FSMRecord()
+        else:
+            record = FSMRecord(row['state'], json.loads(row['data']), json.loads(row['bucket']))
+        self._remember(key, record)
+        return key, record
+
+    def _mark_dirty(self, key: Key):
+        self.dirty.add(key)
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    # --- persistence
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if time.monotonic() - self.last_purge > self.purge_interval:
+                    await self.purge()
+            except Exception as error:
+                logger.error(f"FSM storage flush failed: {error!r}")
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        keys, self.dirty = self.dirty, set()
+        self.flushing |= keys
+        upserts, deletes = [], []
+        for key in keys:
+            record = self.records[key]
+            if record.is_empty():
+                deletes.append(key)
+            else:
+                upserts.append((key[0], key[1], record.state, json.dumps(record.data), json.dumps(record.bucket)))
+        try:
+            async with unit_of_work() as connection:
+                if upserts:
+                    await save_fsm_states(connection, upserts)
+                if deletes:
+                    await delete_fsm_states(connection, deletes)
+        except Exception:
+            # newer writes may have re-dirtied some keys meanwhile; either way retry them all
+            self.dirty |= keys
+            raise
+        finally:
+            self.flushing -= keys
+        now = time.monotonic()
+        for key in keys:
+            self.records[key].loaded_at = now
+        self.flushes += 1
+        self.rows_flushed += len(keys)
+
+    async def purge(self):
+        self.last_purge = time.monotonic()
+        async with get_connection() as connection:
+            await purge_fsm_states(connection, self.state_ttl)
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        await self.flush()
+
+    async def wait_closed(self):
+        pass
+
+    def stats(self) -> dict:
+        return {'cached': len(self.records), 'dirty': len(self.dirty),
+                'cache_reads': self.cache_reads, 'db_reads': self.db_reads,
+                'flushes': self.flushes, 'rows_flushed': self.rows_flushed}
+
+    # --- aiogram storage API
+
+    async def get_state(self, *,
+                        chat: Union[str, int, None] = None,
+                        user: Union[str, int, None] = None,
+                        default: Optional[str] = None) -> Optional[str]:
+        _, record = await self._get(chat, user)
+        return record.state if record.state is not None else self.resolve_state(default)
+
+    async def get_data(self, *,
+                       chat: Union[str, int, None] = None,
+                       user: Union[str, int, None] = None,
+                       default: Optional[Dict] = None) -> Dict:
+        _, record = await self._get(chat, user)
+        return copy.deepcopy(record.data)
+
+    async def set_state(self, *,
+                        chat: Union[str, int, None] = None,
+                        user: Union[str, int, None] = None,
+                        state: Optional[str] = None):
+        key, record = await self._get(chat, user)
+        record.state = self.resolve_state(state)
+        self._mark_dirty(key)
+
+    async def set_data(self, *,
+                       chat: Union[str, int, None] = None,
+                       user: Union[str, int, None] = None,
+                       data: Dict = None):
+        key, record = await self._get(chat, user)
+        record.data = copy.deepcopy(data or {})
+        self._mark_dirty(key)
+
+    async def update_data(self, *,
+                          chat: Union[str, int, None] = None,
+                          user: Union[str, int, None] = None,
+                          data: Dict = None,
+                          **kwargs):
+        key, record = await self._get(chat, user)
+        record.data.update(data or {}, **kwargs)
+        self._mark_dirty(key)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *,
+                         chat: Union[str, int, None] = None,
+                         user: Union[str, int, None] = None,
+                         default: Optional[dict] = None) -> Dict:
+        _, record = await self._get(chat, user)
+        return copy.deepcopy(record.bucket)
+
+    async def set_bucket(self, *,
+                         chat: Union[str, int, None] = None,
+                         user: Union[str, int, None] = None,
+                         bucket: Dict = None):
+        key, record = await self._get(chat, user)
+        record.bucket = copy.deepcopy(bucket or {})
+        self._mark_dirty(key)
+
+    async def update_bucket(self, *,
+                            chat: Union[str, int, None] = None,
+                            user: Union[str, int, None] = None,
+                            bucket: Dict = None,
+                            **kwargs):
+        key, record = await self._get(chat, user)
+        record.bucket.update(bucket or {}, **kwargs)
+        self._mark_dirty(key)
@@ -0,0 +1,179 @@
+"""Monthly intakes archives: gzipped CSV files next to a small seek index.
+
+db.intake_partitions writes one intakes_YYYY-MM.csv.gz per archived month,
+sorted by user_id and taken_at. The rows are compressed in blocks of
+BLOCK_ROWS, each a gzip member of its own, and intakes_YYYY-MM.index.json
+lists the first user_id and byte offset of every block, so one user's
+month is read by decompressing a block or two instead of the whole file.
+A month counts as archived once its index exists.
+"""
+import csv
+import gzip
+import io
+import json
+import os
+import re
+from bisect import bisect_left
+from datetime import date, datetime, timezone
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+
+from dotenv import load_dotenv
+
+
+load_dotenv()
+# where archived months go; without it old partitions are never archived
+INTAKE_ARCHIVE_DIR = os.getenv('INTAKE_ARCHIVE_DIR') or None
+# /history reads the archives too unless this is 0
+INTAKE_HISTORY_ARCHIVES = os.getenv('INTAKE_HISTORY_ARCHIVES', '1').lower() not in ('0', 'false', 'no')
+
+ARCHIVE_FILE = re.compile(r'^intakes_(\d{4})-(\d{2})\.index\.json$')
+UNPUBLISHED_FILE = re.compile(r'^intakes_(\d{4})-(\d{2})\.index\.json\.tmp$')
+BLOCK_ROWS = 1000
+TEMPORARY_SUFFIX = '.tmp'
+
+# id, user_id, medicine_name, taken_at, status
+ArchivedIntake = Tuple[int, int, str, datetime, str]
+# medicine_name, taken_at, status, as iterate_user_intakes yields them
+HistoryRow = Tuple[str, datetime, str]
+
+
+class Archive(NamedTuple):
+    month: date
+    path: str
+
+    @property
+    def index_path(self) -> str:
+        return get_index_path(self.path)
+
+    def covers(self, since: Optional[datetime], until: Optional[datetime]) -> bool:
+        """Whether the month overlaps [since, until)."""
+        start = datetime(self.month.year, self.month.month, 1, tzinfo=timezone.utc)
+        end = datetime(self.month.year + self.month.month // 12, self.month.month % 12 + 1, 1, tzinfo=timezone.utc)
+        return (since is None or since < end) and (until is None or until > start)
+
+
+def get_archive_path(archive_dir: str, month: date) -> str:
+    return os.path.join(archive_dir, f'intakes_{month:%Y-%m}.csv.gz')
+
+
+def get_index_path(path: str) -> str:
+    return path[:-len('.csv.gz')] + '.index.json'
+
+
+def _list_months(archive_dir: str, pattern) -> List[Archive]:
+    if not os.path.isdir(archive_dir):
+        return []
+    archives = []
+    for file_name in sorted(os.listdir(archive_dir)):
+        match = pattern.match(file_name)
+        if match:
+            month = date(int(match.group(1)), int(match.group(2)), 1)
+            archives.append(Archive(month, get_archive_path(archive_dir, month)))
+    return archives
+
+
+def list_archives(archive_dir: str) -> List[Archive]:
+    """The archived months in archive_dir, oldest first."""
+    return _list_months(archive_dir, ARCHIVE_FILE)
+
+
+def list_unpublished(archive_dir: str) -> List[Archive]:
+    """Months write_archive() finished but nobody published, oldest first."""
+    # the temporary index is written last, so its data file is complete
+    return _list_months(archive_dir, UNPUBLISHED_FILE)
+
+
+def _write_block(file, rows: List[ArchivedIntake]):
+    text = io.StringIO()
+    writer = csv.writer(text)
+    for intake_id, user_id, medicine_name, taken_at, status in rows:
+        writer.writerow((intake_id, user_id, medicine_name, taken_at.astimezone(timezone.utc).isoformat(), status))
+    file.write(gzip.compress(text.getvalue().encode('utf-8'), compresslevel=6))
+
+
+def _write_durably(path: str, write):
+    with open(path, 'wb') as file:
+        write(file)
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def write_archive(path: str, chunks: Iterable[List[ArchivedIntake]]) -> int:
+    """Writes the rows, sorted by user_id and taken_at, next to path as temporary files.
+
+    Nothing reads them until publish_archive(). Returns the number of rows.
+    """
+    index = []
+    written = 0
+
+    def write(file):
+        nonlocal written
+        block = []
+        for rows in chunks:
+            for row in rows:
+                block.append(row)
+                if len(block) == BLOCK_ROWS:
+                    index.append((block[0][1], file.tell()))
+                    _write_block(file, block)
+                    written += len(block)
+                    block = []
+        if block:
+            index.append((block[0][1], file.tell()))
+            _write_block(file, block)
+            written += len(block)
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    _write_durably(path + TEMPORARY_SUFFIX, write)
+    _write_durably(get_index_path(path) + TEMPORARY_SUFFIX,
+                   lambda file: file.write(json.dumps({'rows': written, 'blocks': index}).encode('utf-8')))
+    return written
+
+
+def publish_archive(path: str):
+    # the index goes last: until it is in place the month is not archived
+    os.replace(path + TEMPORARY_SUFFIX, path)
+    os.replace(get_index_path(path) + TEMPORARY_SUFFIX, get_index_path(path))
+
+
+def discard_archive(path: str):
+    for leftover in (path + TEMPORARY_SUFFIX, get_index_path(path) + TEMPORARY_SUFFIX):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+
+
+def remove_archive(archive: Archive):
+    # the index first, so a half-removed month is no longer listed
+    for path in (archive.index_path, archive.path):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def read_archive_index(archive: Archive) -> dict:
+    with open(archive.index_path, encoding='utf-8') as file:
+        return json.load(file)
+
+
+def read_user_intakes(archive: Archive, user_id: int, since: Optional[datetime] = None,
+                      until: Optional[datetime] = None) -> List[HistoryRow]:
+    """The user's intakes in the archived month within [since, until), in taken_at order."""
+    blocks = read_archive_index(archive)['blocks']
+    if not blocks:
+        return []
+    # the user's rows may start in the block before the first one that begins with them
+    first = max(bisect_left([first_user_id for first_user_id, _ in blocks], user_id) - 1, 0)
+    rows = []
+    with open(archive.path, 'rb') as file:
+        file.seek(blocks[first][1])
+        # GzipFile reads on through the following blocks' members
+        with gzip.GzipFile(fileobj=file) as compressed:
+            text = io.TextIOWrapper(compressed, encoding='utf-8', newline='')
+            for _, row_user_id, medicine_name, taken_at, status in csv.reader(text):
+                row_user_id = int(row_user_id)
+                if row_user_id < user_id:
+                    continue
+                if row_user_id > user_id:
+                    break
+                taken_at = datetime.fromisoformat(taken_at)
+                if (since is None or taken_at >= since) and (until is None or taken_at < until):
+                    rows.append((medicine_name, taken_at, status))
+    return rows
@@ -0,0 +1,119 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+import asyncpg
+
+from db.async_connection_pool import get_connection
+from db.async_database import add_intake, add_intakes
+
+
+logger = logging.getLogger(__name__)
+
+IntakeRow = Tuple[str, int, datetime, str]
+
+
+def is_data_error(error: Exception) -> bool:
+    """Whether the database refused the rows, as opposed to going away mid-write."""
+    if isinstance(error, (asyncpg.PostgresConnectionError, asyncpg.exceptions.OperatorInterventionError)):
+        return False
+    # asyncpg's client-side encoding errors are InterfaceErrors, but also ValueErrors
+    return isinstance(error, (asyncpg.PostgresError, ValueError))
+
+
+class IntakeBuffer:
+    """Write-behind buffer for Done/Skip presses.
+
+    Rows are collected in memory and written with a single COPY once
+    max_rows have piled up or every flush_interval seconds, whichever comes
+    first. If the COPY is refused, the batch is retried row by row so that
+    one bad row does not lose the others. If the connection is lost or the
+    server shuts down, what is left of the batch stays buffered for the
+    next flush.
+    """
+
+    def __init__(self, max_rows: int = 500, flush_interval: float = 0.2):
+        self.max_rows = max_rows
+        self.flush_interval = flush_interval
+        self.rows: List[IntakeRow] = []
+        self.lock = asyncio.Lock()
+        self.task: Optional[asyncio.Task] = None
+        self.flushes = set()
+        self.flushed = 0
+        self.fallbacks = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.rows)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        await asyncio.gather(*self.flushes, return_exceptions=True)
+        await self.flush()
+
+    def add(self, medicine_name: str, user_id: int, taken_at: datetime, status: str):
+        self.rows.append((medicine_name, int(user_id), taken_at, status))
+        if len(self.rows) >= self.max_rows and self.task is not None:
+            flush = asyncio.create_task(self.flush())
+            self.flushes.add(flush)
+            flush.add_done_callback(self.flushes.discard)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as error:
+                logger.error(f"Intake flush failed: {error!r}")
+
+    async def flush(self):
+        if not self.rows:
+            return
+        async with self.lock:
+            rows, self.rows = self.rows, []
+            if not rows:
+                return
+            try:
+                async with get_connection() as connection:
+                    try:
+                        await add_intakes(connection, rows)
+                    except Exception as error:
+                        if not is_data_error(error):
+                            raise
+                        logger.warning(f"Batch insert of {len(rows)} intakes failed, writing row by row: {error!r}")
+                        self.fallbacks += 1
+                        await self._write_rows(connection, rows)
+                    else:
+                        self.flushed += len(rows)
+                        rows = []
+            except Exception as error:
+                # no connection, or it went away: keep the unwritten rows for the next flush
+                logger.error(f"Could not write {len(rows)} intakes, keeping them buffered: {error!r}")
+                self.rows[:0] = rows
+
+    async def _write_rows(self, connection, rows: List[IntakeRow]):
+        """Writes the rows one by one, taking each off the list once it is written or dropped."""
+        while rows:
+            medicine_name, user_id, taken_at, status = rows[0]
+            try:
+                await add_intake(connection, medicine_name, user_id, taken_at, status)
+            except Exception as error:
+                if not is_data_error(error):
+                    raise
+                self.dropped += 1
+                logger.error(f"Dropping intake {(medicine_name, user_id, status)}: {error!r}")
+            else:
+                self.flushed += 1
+            del rows[0]
+
+    def stats(self) -> dict:
+        return {'buffered': len(self.rows), 'flushed': self.flushed,
+                'fallbacks': self.fallbacks, 'dropped': self.dropped}
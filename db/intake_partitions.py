@@ -0,0 +1,251 @@
+"""Monthly intakes partitions: created ahead of time, archived once old.
+
+maintain() runs daily from the bot and once at its start. It creates the
+partitions of the current month and the next INTAKE_PARTITIONS_AHEAD ones,
+plus any month whose rows ended up in intakes_default. With
+INTAKE_LIVE_MONTHS set, months before the last INTAKE_LIVE_MONTHS (the
+current one included) are written to INTAKE_ARCHIVE_DIR (db.intake_archive)
+and their partitions dropped; /stats keeps counting them from the rollups.
+Archives older than INTAKE_ARCHIVE_MONTHS are deleted.
+
+Run once by hand: python -m db.intake_partitions [--live-months 12]
+"""
+import argparse
+import logging
+import os
+import re
+from datetime import date, datetime, timezone
+from typing import List, NamedTuple, Optional, Tuple
+
+from dotenv import load_dotenv
+from psycopg2 import sql
+
+from db.connection_pool import get_connection
+from db.database import get_cursor
+from db.intake_archive import (INTAKE_ARCHIVE_DIR,
+                               get_archive_path,
+                               list_archives,
+                               list_unpublished,
+                               write_archive,
+                               publish_archive,
+                               discard_archive,
+                               remove_archive)
+
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+INTAKE_PARTITIONS_AHEAD = int(os.getenv('INTAKE_PARTITIONS_AHEAD') or 2)
+# months kept in the database, the current one included; 0 keeps them all
+INTAKE_LIVE_MONTHS = int(os.getenv('INTAKE_LIVE_MONTHS') or 0)
+# months archives are kept for, counted like INTAKE_LIVE_MONTHS; 0 keeps them forever
+INTAKE_ARCHIVE_MONTHS = int(os.getenv('INTAKE_ARCHIVE_MONTHS') or 0)
+
+# any constant works as long as every process maintaining this db uses it
+INTAKE_PARTITIONS_LOCK_ID = 7_152_002
+PARTITION_NAME = re.compile(r'^intakes_y(\d{4})m(\d{2})$')
+
+TRY_LOCK_PARTITIONS = """SELECT pg_try_advisory_lock(%s);"""
+UNLOCK_PARTITIONS = """SELECT pg_advisory_unlock(%s);"""
+ENSURE_PARTITIONS = """SELECT ensure_intake_partitions(%s, %s);"""
+LIST_DEFAULT_MONTHS = """SELECT DISTINCT date_trunc('month', taken_at AT TIME ZONE 'UTC')::DATE
+FROM intakes_default;"""
+LIST_PARTITIONS = """SELECT child.relname
+FROM pg_inherits
+JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid
+WHERE pg_inherits.inhparent = 'intakes'::regclass;"""
+# the detach waits for readers of intakes; give up rather than queue every writer behind it
+SET_DETACH_TIMEOUT = """SET LOCAL lock_timeout = '5s';"""
+ARCHIVE_ROWS = sql.SQL("""SELECT id, user_id, medicine_name, taken_at, status FROM {}
+ORDER BY user_id, taken_at, id;""")
+DETACH_PARTITION = sql.SQL("""ALTER TABLE intakes DETACH PARTITION {};""")
+COUNT_ROWS = sql.SQL("""SELECT count(*) FROM {};""")
+DROP_PARTITION = sql.SQL("""DROP TABLE {};""")
+
+
+class ArchiveMismatch(Exception):
+    pass
+
+
+class Maintenance(NamedTuple):
+    created: int
+    archived: List[date]
+    pruned: List[date]
+
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def get_current_month(today: Optional[date] = None) -> date:
+    today = today or datetime.now(timezone.utc).date()
+    return today.replace(day=1)
+
+
+def ensure_partitions(connection, today: Optional[date] = None, ahead: int = INTAKE_PARTITIONS_AHEAD,
+                      live_months: int = INTAKE_LIVE_MONTHS) -> int:
+    """Creates the missing partitions up to ahead months from now. Returns how many."""
+    month = get_current_month(today)
+    with get_cursor(connection) as cursor:
+        cursor.execute(ENSURE_PARTITIONS, (month, add_months(month, ahead)))
+        created = cursor.fetchone()[0]
+        cursor.execute(LIST_DEFAULT_MONTHS)
+        stray_months = [row[0] for row in cursor.fetchall()]
+        for stray_month in stray_months:
+            # a partition for a month already archived would be archived over it
+            if live_months and stray_month < add_months(month, 1 - live_months):
+                logger.warning(f"Intakes of {stray_month:%Y-%m} are past INTAKE_LIVE_MONTHS, left in intakes_default.")
+                continue
+            cursor.execute(ENSURE_PARTITIONS, (stray_month, stray_month))
+            created += cursor.fetchone()[0]
+    return created
+
+
+def list_partitions(connection) -> List[Tuple[date, str]]:
+    """The monthly partitions of intakes, oldest first."""
+    with get_cursor(connection) as cursor:
+        cursor.execute(LIST_PARTITIONS)
+        names = [row[0] for row in cursor.fetchall()]
+    partitions = []
+    for name in names:
+        match = PARTITION_NAME.match(name)
+        if match:
+            partitions.append((date(int(match.group(1)), int(match.group(2)), 1), name))
+    return sorted(partitions)
+
+
+def archive_partition(connection, month: date, partition: str, archive_dir: str, chunk_size: int = 10000) -> int:
+    """Writes the month to archive_dir, then detaches and drops its partition. Returns the rows archived.
+
+    The file is published only once the drop has committed, so /history
+    never reads a month from both the archive and the table. If the drop
+    fails, the written files are discarded and the next run writes them
+    again. If publishing fails after the drop, they are left in place for
+    publish_leftover_archives() to finish.
+    """
+    path = get_archive_path(archive_dir, month)
+    table = sql.Identifier(partition)
+    dropped = False
+    try:
+        # a named cursor streams the month instead of fetching it whole
+        with connection:
+            with connection.cursor(name='archive_intakes') as cursor:
+                cursor.execute(ARCHIVE_ROWS.format(table))
+                archived = write_archive(path, iter(lambda: cursor.fetchmany(chunk_size), []))
+        with get_cursor(connection) as cursor:
+            cursor.execute(SET_DETACH_TIMEOUT)
+            cursor.execute(DETACH_PARTITION.format(table))
+            cursor.execute(COUNT_ROWS.format(table))
+            rows = cursor.fetchone()[0]
+            if rows != archived:
+                raise ArchiveMismatch(f"{partition} got {rows - archived} rows while it was archived")
+            cursor.execute(DROP_PARTITION.format(table))
+        dropped = True
+        publish_archive(path)
+    finally:
+        if not dropped:
+            discard_archive(path)
+    return archived
+
+
+def publish_leftover_archives(connection, archive_dir: str) -> List[date]:
+    """Publishes the archives of months whose partition was dropped but whose files were not published."""
+    partitions = {month for month, _ in list_partitions(connection)}
+    published = []
+    for archive in list_unpublished(archive_dir):
+        if archive.month in partitions:
+            # the drop did not commit: archive_partition() writes the month again
+            discard_archive(archive.path)
+            continue
+        publish_archive(archive.path)
+        logger.warning(f"Published the leftover archive of {archive.month:%Y-%m}, its partition was already dropped.")
+        published.append(archive.month)
+    return published
+
+
+def archive_old_partitions(connection, archive_dir: str, live_months: int = INTAKE_LIVE_MONTHS,
+                           today: Optional[date] = None) -> List[date]:
+    """Archives the partitions of the months before the last live_months."""
+    oldest_live = add_months(get_current_month(today), 1 - live_months)
+    archived = publish_leftover_archives(connection, archive_dir)
+    for month, partition in list_partitions(connection):
+        if month >= oldest_live:
+            break
+        rows = archive_partition(connection, month, partition, archive_dir)
+        logger.info(f"Archived {rows} intakes of {month:%Y-%m} to {get_archive_path(archive_dir, month)}.")
+        archived.append(month)
+    return archived
+
+
+def prune_archives(archive_dir: str, archive_months: int = INTAKE_ARCHIVE_MONTHS,
+                   today: Optional[date] = None) -> List[date]:
+    """Deletes the archives of the months before the last archive_months."""
+    oldest_kept = add_months(get_current_month(today), 1 - archive_months)
+    pruned = []
+    for archive in list_archives(archive_dir):
+        if archive.month >= oldest_kept:
+            break
+        remove_archive(archive)
+        logger.info(f"Deleted the intakes archive of {archive.month:%Y-%m}.")
+        pruned.append(archive.month)
+    return pruned
+
+
+def maintain(connection, today: Optional[date] = None, ahead: int = INTAKE_PARTITIONS_AHEAD,
+             live_months: int = INTAKE_LIVE_MONTHS, archive_dir: Optional[str] = INTAKE_ARCHIVE_DIR,
+             archive_months: int = INTAKE_ARCHIVE_MONTHS) -> Optional[Maintenance]:
+    """One maintenance pass, or None if another process is running one."""
+    with get_cursor(connection) as cursor:
+        cursor.execute(TRY_LOCK_PARTITIONS, (INTAKE_PARTITIONS_LOCK_ID,))
+        if not cursor.fetchone()[0]:
+            return None
+    try:
+        created = ensure_partitions(connection, today, ahead, live_months)
+        archived, pruned = [], []
+        if live_months and archive_dir:
+            archived = archive_old_partitions(connection, archive_dir, live_months, today)
+        elif live_months:
+            logger.warning("INTAKE_LIVE_MONTHS is set without INTAKE_ARCHIVE_DIR, old intakes are kept.")
+        if archive_months and archive_dir:
+            pruned = prune_archives(archive_dir, archive_months, today)
+        return Maintenance(created, archived, pruned)
+    finally:
+        with get_cursor(connection) as cursor:
+            cursor.execute(UNLOCK_PARTITIONS, (INTAKE_PARTITIONS_LOCK_ID,))
+
+
+def run_maintenance():
+    """maintain() on a pooled connection, for the scheduler: errors are logged, not raised."""
+    try:
+        with get_connection() as connection:
+            result = maintain(connection)
+    except Exception:
+        logger.exception("Intake partition maintenance failed.")
+        return
+    if result is not None and (result.created or result.archived or result.pruned):
+        logger.info(f"Intake partitions: created {result.created}, "
+                    f"archived {len(result.archived)} month(s), deleted {len(result.pruned)} archive(s).")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(prog='python -m db.intake_partitions', description=__doc__.splitlines()[0])
+    parser.add_argument('--ahead', type=int, default=INTAKE_PARTITIONS_AHEAD, help='months to create ahead')
+    parser.add_argument('--live-months', type=int, default=INTAKE_LIVE_MONTHS, help='months to keep in the database')
+    parser.add_argument('--archive-dir', default=INTAKE_ARCHIVE_DIR, help='where archived months are written')
+    parser.add_argument('--archive-months', type=int, default=INTAKE_ARCHIVE_MONTHS, help='months to keep archives for')
+    args = parser.parse_args()
+
+    with get_connection() as connection:
+        result = maintain(connection, ahead=args.ahead, live_months=args.live_months,
+                          archive_dir=args.archive_dir, archive_months=args.archive_months)
+    if result is None:
+        logger.info("Another process is maintaining the intake partitions.")
+        return
+    logger.info(f"Created {result.created} partition(s), archived {len(result.archived)} month(s), "
+                f"deleted {len(result.pruned)} archive(s).")
+
+
+if __name__ == '__main__':
+    main()
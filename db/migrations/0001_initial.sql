@@ -0,0 +1,53 @@
+-- Schema as it was created by db.database.create_tables before migrations.
+-- IF NOT EXISTS lets databases created that way adopt version 1 as is.
+
+CREATE TABLE IF NOT EXISTS users
+(
+id SERIAL PRIMARY KEY,
+user_tg_id TEXT UNIQUE,
+timezone TEXT
+);
+
+CREATE TABLE IF NOT EXISTS medicines
+(
+id SERIAL PRIMARY KEY,
+medicine_name TEXT,
+user_id TEXT,
+schedule TEXT,
+FOREIGN KEY(user_id) REFERENCES users(user_tg_id),
+UNIQUE(medicine_name, user_id)
+);
+
+CREATE TABLE IF NOT EXISTS schedules
+(
+id SERIAL PRIMARY KEY,
+medicine_name TEXT,
+user_id TEXT,
+chat_id BIGINT,
+utc_minute SMALLINT
+);
+CREATE INDEX IF NOT EXISTS schedules_utc_minute_idx ON schedules (utc_minute);
+CREATE INDEX IF NOT EXISTS schedules_user_medicine_idx ON schedules (user_id, medicine_name);
+
+CREATE TABLE IF NOT EXISTS pending_reminders
+(
+id SERIAL PRIMARY KEY,
+medicine_name TEXT,
+user_id TEXT,
+chat_id BIGINT,
+next_nag_at TIMESTAMPTZ,
+acknowledged_at TIMESTAMPTZ
+);
+CREATE INDEX IF NOT EXISTS pending_reminders_next_nag_at_idx
+ON pending_reminders (next_nag_at) WHERE acknowledged_at IS NULL;
+CREATE INDEX IF NOT EXISTS pending_reminders_user_medicine_idx
+ON pending_reminders (user_id, medicine_name) WHERE acknowledged_at IS NULL;
+
+CREATE TABLE IF NOT EXISTS intakes
+(
+id SERIAL PRIMARY KEY,
+user_id TEXT,
+medicine_name TEXT,
+date TEXT,
+status TEXT
+);
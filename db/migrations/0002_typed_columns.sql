@@ -0,0 +1,61 @@
+-- Telegram ids become BIGINT, intake dates become timestamptz, child rows
+-- reference their medicine by id (so deleting a medicine cascades) and the
+-- per-user lookups get composite indexes.
+
+-- leftovers of the one-APScheduler-job-per-reminder design
+DROP TABLE IF EXISTS jobs;
+DROP TABLE IF EXISTS interval_jobs;
+
+-- users / medicines
+ALTER TABLE medicines DROP CONSTRAINT IF EXISTS medicines_user_id_fkey;
+ALTER TABLE users ALTER COLUMN user_tg_id TYPE BIGINT USING user_tg_id::BIGINT;
+ALTER TABLE users ALTER COLUMN user_tg_id SET NOT NULL;
+ALTER TABLE medicines ALTER COLUMN user_id TYPE BIGINT USING user_id::BIGINT;
+ALTER TABLE medicines ALTER COLUMN user_id SET NOT NULL;
+ALTER TABLE medicines ALTER COLUMN medicine_name SET NOT NULL;
+ALTER TABLE medicines ADD CONSTRAINT medicines_user_id_fkey
+    FOREIGN KEY (user_id) REFERENCES users (user_tg_id) ON DELETE CASCADE;
+-- UNIQUE(medicine_name, user_id) cannot serve "all medicines of a user"
+CREATE INDEX medicines_user_id_idx ON medicines (user_id);
+
+-- schedules
+ALTER TABLE schedules ALTER COLUMN user_id TYPE BIGINT USING user_id::BIGINT;
+ALTER TABLE schedules ADD COLUMN medicine_id INTEGER;
+UPDATE schedules SET medicine_id = medicines.id
+FROM medicines
+WHERE medicines.user_id = schedules.user_id AND medicines.medicine_name = schedules.medicine_name;
+DELETE FROM schedules WHERE medicine_id IS NULL;
+ALTER TABLE schedules ALTER COLUMN medicine_id SET NOT NULL;
+ALTER TABLE schedules ADD CONSTRAINT schedules_medicine_id_fkey
+    FOREIGN KEY (medicine_id) REFERENCES medicines (id) ON DELETE CASCADE;
+DROP INDEX IF EXISTS schedules_user_medicine_idx;
+CREATE INDEX schedules_medicine_id_idx ON schedules (medicine_id);
+
+-- pending_reminders
+ALTER TABLE pending_reminders ALTER COLUMN user_id TYPE BIGINT USING user_id::BIGINT;
+ALTER TABLE pending_reminders ADD COLUMN medicine_id INTEGER;
+UPDATE pending_reminders SET medicine_id = medicines.id
+FROM medicines
+WHERE medicines.user_id = pending_reminders.user_id
+  AND medicines.medicine_name = pending_reminders.medicine_name;
+DELETE FROM pending_reminders WHERE medicine_id IS NULL;
+ALTER TABLE pending_reminders ALTER COLUMN medicine_id SET NOT NULL;
+ALTER TABLE pending_reminders ADD CONSTRAINT pending_reminders_medicine_id_fkey
+    FOREIGN KEY (medicine_id) REFERENCES medicines (id) ON DELETE CASCADE;
+CREATE INDEX pending_reminders_medicine_id_idx ON pending_reminders (medicine_id);
+
+-- intakes: the synchronous add_intake used to write medicine_name and
+-- user_id into each other's columns, put those rows right first
+UPDATE intakes SET user_id = medicine_name, medicine_name = user_id
+WHERE user_id !~ '^[0-9]+$' AND medicine_name ~ '^[0-9]+$';
+DELETE FROM intakes WHERE user_id IS NULL OR user_id !~ '^[0-9]+$';
+ALTER TABLE intakes ALTER COLUMN user_id TYPE BIGINT USING user_id::BIGINT;
+ALTER TABLE intakes ALTER COLUMN user_id SET NOT NULL;
+DELETE FROM intakes WHERE NOT EXISTS (SELECT 1 FROM users WHERE users.user_tg_id = intakes.user_id);
+ALTER TABLE intakes ADD CONSTRAINT intakes_user_id_fkey
+    FOREIGN KEY (user_id) REFERENCES users (user_tg_id) ON DELETE CASCADE;
+ALTER TABLE intakes ALTER COLUMN date TYPE TIMESTAMPTZ USING to_timestamp(date, 'HH24:MI YYYY-MM-DD');
+ALTER TABLE intakes RENAME COLUMN date TO taken_at;
+ALTER TABLE intakes ALTER COLUMN id TYPE BIGINT;
+ALTER SEQUENCE intakes_id_seq AS BIGINT;
+CREATE INDEX intakes_user_medicine_taken_at_idx ON intakes (user_id, medicine_name, taken_at);
@@ -0,0 +1,4 @@
+-- History export streams a user's intakes in taken_at order; with this
+-- index it is a range scan instead of a sort over all of the user's rows.
+
+CREATE INDEX intakes_user_taken_at_idx ON intakes (user_id, taken_at);
@@ -0,0 +1,36 @@
+-- Done/skipped counts per user, medicine and UTC day, kept up to date by a
+-- statement-level trigger so a COPY of a whole intake batch costs a single
+-- grouped upsert. Rows written before this migration are filled in by
+-- python -m db.rollups.
+
+CREATE TABLE intake_daily_rollups
+(
+user_id BIGINT NOT NULL REFERENCES users (user_tg_id) ON DELETE CASCADE,
+day DATE NOT NULL,
+medicine_name TEXT NOT NULL,
+done_count INTEGER NOT NULL DEFAULT 0,
+skipped_count INTEGER NOT NULL DEFAULT 0,
+PRIMARY KEY (user_id, day, medicine_name)
+);
+
+CREATE FUNCTION roll_up_intakes() RETURNS TRIGGER LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO intake_daily_rollups AS rollups (user_id, day, medicine_name, done_count, skipped_count)
+    SELECT user_id,
+           (taken_at AT TIME ZONE 'UTC')::DATE,
+           medicine_name,
+           count(*) FILTER (WHERE status = 'done'),
+           count(*) FILTER (WHERE status = 'skipped')
+    FROM new_intakes
+    WHERE taken_at IS NOT NULL AND medicine_name IS NOT NULL
+    GROUP BY 1, 2, 3
+    ON CONFLICT (user_id, day, medicine_name) DO UPDATE
+    SET done_count = rollups.done_count + EXCLUDED.done_count,
+        skipped_count = rollups.skipped_count + EXCLUDED.skipped_count;
+    RETURN NULL;
+END
+$$;
+
+CREATE TRIGGER intakes_roll_up AFTER INSERT ON intakes
+REFERENCING NEW TABLE AS new_intakes
+FOR EACH STATEMENT EXECUTE FUNCTION roll_up_intakes();
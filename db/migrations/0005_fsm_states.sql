@@ -0,0 +1,13 @@
+-- aiogram FSM state and data of unfinished conversations (db.fsm_storage).
+
+CREATE TABLE fsm_states
+(
+chat_id BIGINT NOT NULL,
+user_id BIGINT NOT NULL,
+state TEXT,
+data JSONB NOT NULL DEFAULT '{}',
+bucket JSONB NOT NULL DEFAULT '{}',
+updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+PRIMARY KEY (chat_id, user_id)
+);
+CREATE INDEX fsm_states_updated_at_idx ON fsm_states (updated_at);
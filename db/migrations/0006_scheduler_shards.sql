@@ -0,0 +1,21 @@
+-- Reminder ownership (bot_logic.shard_leases): users are split into shards
+-- by user_id % shard count and every shard is leased to one live worker,
+-- which alone fires the doses of its users. fired_until is the moment of
+-- the owner's last tick, so a new owner knows where to resume after failover.
+
+CREATE TABLE scheduler_workers
+(
+worker_id TEXT PRIMARY KEY,
+seen_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE TABLE scheduler_shards
+(
+shard INTEGER PRIMARY KEY,
+owner TEXT,
+lease_until TIMESTAMPTZ NOT NULL DEFAULT '-infinity',
+fired_until TIMESTAMPTZ
+);
+
+-- a worker reloads one user's doses on every schedules_changed notification
+CREATE INDEX schedules_user_id_idx ON schedules (user_id);
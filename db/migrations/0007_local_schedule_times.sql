@@ -0,0 +1,42 @@
+-- Doses are kept as the local time the user typed plus their IANA zone
+-- (bot_logic.timezone_calendar) instead of a UTC minute fixed with the
+-- offset of the day they were added, which went an hour off at every DST
+-- transition. The UTC minute is now derived in memory by the dispatcher.
+
+ALTER TABLE schedules ADD COLUMN timezone TEXT;
+ALTER TABLE schedules ADD COLUMN local_minute SMALLINT;
+
+-- users who never shared a location ('NA', 'Not Found') are reminded in UTC
+UPDATE schedules SET timezone = COALESCE(zones.name, 'UTC')
+FROM users
+LEFT JOIN pg_timezone_names AS zones ON zones.name = users.timezone
+WHERE users.user_tg_id = schedules.user_id;
+UPDATE schedules SET timezone = 'UTC' WHERE timezone IS NULL;
+
+-- medicines.schedule holds the typed times, comma separated, in the order
+-- their schedules rows were inserted; take the local time from there when
+-- the counts line up
+WITH typed AS (
+    SELECT schedules.id,
+           split_part(medicines.schedule, ',',
+                      row_number() OVER (PARTITION BY schedules.medicine_id ORDER BY schedules.id)::INTEGER) AS local_time,
+           count(*) OVER (PARTITION BY schedules.medicine_id) AS doses,
+           array_length(string_to_array(medicines.schedule, ','), 1) AS times
+    FROM schedules
+    JOIN medicines ON medicines.id = schedules.medicine_id
+)
+UPDATE schedules
+SET local_minute = split_part(typed.local_time, ':', 1)::INTEGER * 60 + split_part(typed.local_time, ':', 2)::INTEGER
+FROM typed
+WHERE typed.id = schedules.id AND typed.doses = typed.times AND typed.local_time ~ '^([01][0-9]|2[0-3]):[0-5][0-9]$';
+
+-- otherwise keep firing at the same moment it does today
+UPDATE schedules
+SET local_minute = ((schedules.utc_minute + extract(EPOCH FROM zones.utc_offset)::INTEGER / 60) % 1440 + 1440) % 1440
+FROM pg_timezone_names AS zones
+WHERE schedules.local_minute IS NULL AND zones.name = schedules.timezone;
+
+ALTER TABLE schedules ALTER COLUMN timezone SET NOT NULL;
+ALTER TABLE schedules ALTER COLUMN local_minute SET NOT NULL;
+DROP INDEX IF EXISTS schedules_utc_minute_idx;
+ALTER TABLE schedules DROP COLUMN utc_minute;
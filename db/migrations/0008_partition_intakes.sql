@@ -0,0 +1,78 @@
+-- intakes only ever grows, so it is range partitioned by the UTC month of
+-- taken_at: a history query reads just the months it asks for, VACUUM
+-- works on one month at a time, and whole months can be detached and
+-- archived (db.intake_partitions). Partitions are created ahead of time by
+-- ensure_intake_partitions(); rows outside every partition land in
+-- intakes_default until one is created for their month.
+-- The rows are copied over in this migration, which rewrites the table.
+
+ALTER TABLE intakes RENAME TO intakes_unpartitioned;
+DROP TRIGGER intakes_roll_up ON intakes_unpartitioned;
+ALTER INDEX intakes_user_medicine_taken_at_idx RENAME TO intakes_unpartitioned_user_medicine_taken_at_idx;
+ALTER INDEX intakes_user_taken_at_idx RENAME TO intakes_unpartitioned_user_taken_at_idx;
+
+CREATE TABLE intakes
+(
+id BIGINT NOT NULL DEFAULT nextval('intakes_id_seq'),
+user_id BIGINT NOT NULL REFERENCES users (user_tg_id) ON DELETE CASCADE,
+medicine_name TEXT,
+taken_at TIMESTAMPTZ NOT NULL,
+status TEXT,
+PRIMARY KEY (id, taken_at)
+) PARTITION BY RANGE (taken_at);
+-- keeps the sequence alive when the old table is dropped below
+ALTER SEQUENCE intakes_id_seq OWNED BY intakes.id;
+
+CREATE INDEX intakes_user_medicine_taken_at_idx ON intakes (user_id, medicine_name, taken_at);
+CREATE INDEX intakes_user_taken_at_idx ON intakes (user_id, taken_at);
+
+CREATE TABLE intakes_default PARTITION OF intakes DEFAULT;
+
+-- Creates the monthly partitions intakes_yYYYYmMM from first_month to
+-- last_month that do not exist yet, moving their rows out of
+-- intakes_default. Returns how many it created.
+CREATE FUNCTION ensure_intake_partitions(first_month DATE, last_month DATE) RETURNS INTEGER LANGUAGE plpgsql AS $$
+DECLARE
+    month DATE := date_trunc('month', first_month)::DATE;
+    partition_name TEXT;
+    lower_bound TIMESTAMPTZ;
+    upper_bound TIMESTAMPTZ;
+    created INTEGER := 0;
+BEGIN
+    WHILE month <= last_month LOOP
+        partition_name := 'intakes_y' || to_char(month, 'YYYY') || 'm' || to_char(month, 'MM');
+        lower_bound := month::TIMESTAMP AT TIME ZONE 'UTC';
+        upper_bound := (month + INTERVAL '1 month') AT TIME ZONE 'UTC';
+        IF to_regclass(partition_name) IS NULL THEN
+            -- built detached and attached once filled: attaching validates the
+            -- rows in one pass, and intakes_default no longer holds the month
+            EXECUTE format('CREATE TABLE %I (LIKE intakes INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', partition_name);
+            EXECUTE format('WITH moved AS (DELETE FROM intakes_default WHERE taken_at >= $1 AND taken_at < $2 RETURNING *)
+                            INSERT INTO %I SELECT * FROM moved', partition_name)
+            USING lower_bound, upper_bound;
+            EXECUTE format('ALTER TABLE intakes ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                           partition_name, lower_bound, upper_bound);
+            created := created + 1;
+        END IF;
+        month := (month + INTERVAL '1 month')::DATE;
+    END LOOP;
+    RETURN created;
+END
+$$;
+
+SELECT ensure_intake_partitions(COALESCE((SELECT (min(taken_at) AT TIME ZONE 'UTC')::DATE FROM intakes_unpartitioned),
+                                         (now() AT TIME ZONE 'UTC')::DATE),
+                                ((now() AT TIME ZONE 'UTC') + INTERVAL '2 months')::DATE);
+
+-- rows without taken_at never showed up in the history or the rollups
+INSERT INTO intakes (id, user_id, medicine_name, taken_at, status)
+SELECT id, user_id, medicine_name, taken_at, status
+FROM intakes_unpartitioned
+WHERE taken_at IS NOT NULL;
+
+DROP TABLE intakes_unpartitioned;
+
+-- created after the copy: the copied rows are already in the rollups
+CREATE TRIGGER intakes_roll_up AFTER INSERT ON intakes
+REFERENCING NEW TABLE AS new_intakes
+FOR EACH STATEMENT EXECUTE FUNCTION roll_up_intakes();
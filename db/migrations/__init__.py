@@ -0,0 +1,81 @@
+import os
+import re
+import logging
+from typing import List, NamedTuple, Optional, Set
+
+from db.database import get_cursor
+
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = os.path.dirname(os.path.abspath(__file__))
+MIGRATION_FILE = re.compile(r'^(\d{4})_(\w+)\.sql$')
+# any constant works as long as every process migrating this db uses it
+MIGRATIONS_LOCK_ID = 7_152_001
+
+CREATE_MIGRATIONS_TABLE = """CREATE TABLE IF NOT EXISTS schema_migrations
+(
+version INTEGER PRIMARY KEY,
+name TEXT NOT NULL,
+applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);"""
+GET_APPLIED_VERSIONS = """SELECT version FROM schema_migrations;"""
+ADD_APPLIED_VERSION = """INSERT INTO schema_migrations (version, name) VALUES(%s, %s);"""
+LOCK_MIGRATIONS = """SELECT pg_advisory_lock(%s);"""
+UNLOCK_MIGRATIONS = """SELECT pg_advisory_unlock(%s);"""
+LIST_TABLES = """SELECT tablename FROM pg_tables WHERE schemaname = current_schema();"""
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    path: str
+
+    def read(self) -> str:
+        with open(self.path, encoding='utf-8') as file:
+            return file.read()
+
+
+def list_migrations() -> List[Migration]:
+    migrations = []
+    for file_name in sorted(os.listdir(MIGRATIONS_DIR)):
+        match = MIGRATION_FILE.match(file_name)
+        if match:
+            migrations.append(Migration(int(match.group(1)), match.group(2), os.path.join(MIGRATIONS_DIR, file_name)))
+    return migrations
+
+
+def get_applied_versions(connection) -> Set[int]:
+    with get_cursor(connection) as cursor:
+        cursor.execute(CREATE_MIGRATIONS_TABLE)
+        cursor.execute(GET_APPLIED_VERSIONS)
+        return {row[0] for row in cursor.fetchall()}
+
+
+def migrate(connection, target: Optional[int] = None) -> List[Migration]:
+    """Applies every pending migration up to target, each in its own transaction."""
+    applied = []
+    with get_cursor(connection) as cursor:
+        cursor.execute(LOCK_MIGRATIONS, (MIGRATIONS_LOCK_ID,))
+    try:
+        done = get_applied_versions(connection)
+        for migration in list_migrations():
+            if migration.version in done or (target is not None and migration.version > target):
+                continue
+            logger.info(f"Applying migration {migration.version:04d}_{migration.name}...")
+            with get_cursor(connection) as cursor:
+                cursor.execute(migration.read())
+                cursor.execute(ADD_APPLIED_VERSION, (migration.version, migration.name))
+            applied.append(migration)
+    finally:
+        with get_cursor(connection) as cursor:
+            cursor.execute(UNLOCK_MIGRATIONS, (MIGRATIONS_LOCK_ID,))
+    return applied
+
+
+def reset(connection):
+    """Drops every table in the current schema. Development only."""
+    with get_cursor(connection) as cursor:
+        cursor.execute(LIST_TABLES)
+        for (table,) in cursor.fetchall():
+            cursor.execute(f'DROP TABLE IF EXISTS "{table}" CASCADE;')
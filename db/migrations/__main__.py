@@ -0,0 +1,34 @@
+import argparse
+import logging
+
+from db.connection_pool import get_connection
+from db.migrations import list_migrations, get_applied_versions, migrate, reset
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m db.migrations', description='Apply schema migrations.')
+    parser.add_argument('--target', type=int, default=None, help='stop after this version')
+    parser.add_argument('--list', action='store_true', help='show migrations and whether they are applied')
+    parser.add_argument('--reset', action='store_true', help='drop every table first (development only)')
+    args = parser.parse_args()
+
+    with get_connection() as connection:
+        if args.list:
+            applied = get_applied_versions(connection)
+            for migration in list_migrations():
+                mark = 'x' if migration.version in applied else ' '
+                print(f"[{mark}] {migration.version:04d}_{migration.name}")
+            return
+        if args.reset:
+            logger.info("Dropping all tables!")
+            reset(connection)
+        applied = migrate(connection, target=args.target)
+        logger.info(f"Applied {len(applied)} migration(s).")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Backfill of intake_daily_rollups from the raw intakes table.
+
+Run once after migration 0004 on a database that already has intakes:
+python -m db.rollups [--batch-users 1000]
+"""
+import argparse
+import logging
+
+from db.connection_pool import get_connection
+from db.database import get_cursor
+
+
+logger = logging.getLogger(__name__)
+
+GET_USER_BATCH_END = """SELECT max(user_tg_id) FROM
+(SELECT user_tg_id FROM users WHERE user_tg_id > %s ORDER BY user_tg_id LIMIT %s) AS batch;"""
+# SHARE mode blocks inserts for the duration of one batch, so the trigger
+# cannot count a row that the recomputation below also sees (or misses).
+LOCK_INTAKES = """LOCK TABLE intakes IN SHARE MODE;"""
+BACKFILL_ROLLUPS = """INSERT INTO intake_daily_rollups AS rollups (user_id, day, medicine_name, done_count, skipped_count)
+SELECT user_id,
+       (taken_at AT TIME ZONE 'UTC')::DATE,
+       medicine_name,
+       count(*) FILTER (WHERE status = 'done'),
+       count(*) FILTER (WHERE status = 'skipped')
+FROM intakes
+WHERE user_id > %s AND user_id <= %s AND taken_at IS NOT NULL AND medicine_name IS NOT NULL
+GROUP BY 1, 2, 3
+ON CONFLICT (user_id, day, medicine_name) DO UPDATE
+SET done_count = EXCLUDED.done_count,
+    skipped_count = EXCLUDED.skipped_count;"""
+
+
+def backfill_rollups(connection, batch_users: int = 1000) -> int:
+    """Recomputes the rollups from intakes, one batch of users per transaction. Idempotent."""
+    upserted = 0
+    batch_start = -1
+    while True:
+        with get_cursor(connection) as cursor:
+            cursor.execute(GET_USER_BATCH_END, (batch_start, batch_users))
+            batch_end = cursor.fetchone()[0]
+            if batch_end is None:
+                return upserted
+            cursor.execute(LOCK_INTAKES)
+            cursor.execute(BACKFILL_ROLLUPS, (batch_start, batch_end))
+            upserted += cursor.rowcount
+        batch_start = batch_end
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(prog='python -m db.rollups', description=__doc__.splitlines()[0])
+    parser.add_argument('--batch-users', type=int, default=1000, help='user ids per transaction')
+    args = parser.parse_args()
+
+    with get_connection() as connection:
+        upserted = backfill_rollups(connection, args.batch_users)
+    logger.info(f"Backfilled {upserted} rollup rows.")
+
+
+if __name__ == '__main__':
+    main()
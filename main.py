@@ -1,30 +1,69 @@
 import logging
+import os
+import time
 
 from aiogram.utils import executor
 
-from bot_logic.reminder_bot import dp
+from bot_logic.reminder_bot import dp, start_reminders, stop_reminders
+from bot_logic.utils import warm_timezone_finder
+from bot_logic.webhook import start_webhook
+from bot_logic.update_pipeline import UPDATE_CONCURRENCY, concurrency_for_pool
 from db.connection_pool import get_connection
-import db.database as database
+from metrics.server import start_metrics_server, stop_metrics_server
+import db.async_connection_pool as async_connection_pool
+import db.migrations as migrations
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# kept off the public webhook port; an empty METRICS_PORT turns the endpoint off
+METRICS_HOST = os.getenv('METRICS_HOST') or '127.0.0.1'
+METRICS_PORT = os.getenv('METRICS_PORT', '9100')
+
+
+async def on_startup(dispatcher):
+    started = time.perf_counter()
+    warm_timezone_finder()
+    logger.info("Opening async db pool...")
+    pool = await async_connection_pool.create_pool()
+    logger.info("Loading reminder schedule...")
+    await start_reminders()
+    dispatcher.pipeline.start(UPDATE_CONCURRENCY or concurrency_for_pool(pool.get_max_size()))
+    if METRICS_PORT:
+        try:
+            await start_metrics_server(METRICS_HOST, int(METRICS_PORT))
+        except OSError as error:
+            # most likely another copy on this host holds the port; the bot itself is fine without metrics
+            logger.error(f"Could not serve metrics on {METRICS_HOST}:{METRICS_PORT}, running without them: {error!r}")
+    logger.info(f"Started in {time.perf_counter() - started:.2f}s.")
+
+
+async def on_shutdown(dispatcher):
+    await stop_metrics_server()
+    # handle what is already queued while reminders and the pool are still up
+    await dispatcher.pipeline.stop()
+    await stop_reminders()
+    # flush pending conversation state while the pool is still open
+    await dispatcher.storage.close()
+    logger.info("Closing async db pool...")
+    await async_connection_pool.close_pool()
+
 
 def main():
     try:
         logger.info("Connecting to the db...")
         with get_connection() as connection:
             logger.info("No errors while connecting to the db!")
-            database.create_tables(connection)
-        logger.info("Starting Vladking bot...")
-        executor.start_polling(dp, skip_updates=True)
+            applied = migrations.migrate(connection)
+            logger.info(f"Applied {len(applied)} migration(s).")
+        if os.getenv('BOT_MODE', 'polling') == 'webhook':
+            logger.info("Starting Vladking bot with a webhook...")
+            start_webhook(dp, on_startup=on_startup, on_shutdown=on_shutdown)
+        else:
+            logger.info("Starting Vladking bot...")
+            executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
     finally:
-        # debug mode ==========================
-        with get_connection() as connection:
-            logger.info("Deleting tables!")
-            database.delete_tables(connection)
-        # =====================================
         logger.info("Stopping Vladkins bot...")
 
 
@@ -0,0 +1,168 @@
+"""In-process metrics rendered in the Prometheus text format.
+
+Counters and histograms are plain dicts keyed by label values, updated
+from the event loop thread only. Components that already keep a stats()
+dict (send queue, update pipeline, caches, intake buffer, FSM storage, shard leases) are
+exposed as gauges through register_stats() instead of counting twice.
+"""
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PREFIX = 'vladkins_'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_labels(names: Sequence[str], values: Sequence, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> Tuple:
+        return tuple(labels[name] for name in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self.values.get(self._key(labels), 0)
+
+    def render(self) -> List[str]:
+        return self.header() + [f'{self.name}{_format_labels(self.labelnames, key)} {_format_number(value)}'
+                                for key, value in self.values.items()]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts..., +Inf count], sum
+        self.values: Dict[Tuple, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+        counts, total = series
+        counts[bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels) -> int:
+        series = self.values.get(self._key(labels))
+        return sum(series[0]) if series else 0
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for key, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_number(bound)}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_number(total[0])}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class StatsGauges(Metric):
+    """Every numeric value of a stats() dict as a gauge named <name>_<key>."""
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, stats: Callable[[], dict]):
+        super().__init__(name, documentation)
+        self.stats = stats
+
+    def render(self) -> List[str]:
+        lines = []
+        for key, value in self.stats().items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            name = f'{self.name}_{key}'
+            lines += [f'# HELP {name} {self.documentation}: {key}', f'# TYPE {name} gauge',
+                      f'{name} {_format_number(value)}']
+        return lines
+
+
+REGISTRY: List[Metric] = []
+
+
+def register_stats(name: str, documentation: str, stats: Callable[[], dict]) -> StatsGauges:
+    for metric in REGISTRY:
+        if isinstance(metric, StatsGauges) and metric.name == PREFIX + name:
+            REGISTRY.remove(metric)
+            break
+    return StatsGauges(name, documentation, stats)
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+
+HANDLER_LATENCY = Histogram('handler_seconds', 'Time spent in an update handler', ['handler'])
+HANDLER_ERRORS = Counter('handler_errors_total', 'Update handlers that raised', ['handler'])
+UPDATES = Counter('updates_total', 'Incoming updates by outcome', ['outcome'])
+UPDATE_WAIT = Histogram('update_wait_seconds', 'Time from receiving an update to its handler starting',
+                        buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+DB_CHECKOUT = Histogram('db_checkout_seconds', 'Time spent waiting for a pool connection')
+DB_QUERY = Histogram('db_query_seconds', 'Statement execution time', ['query'])
+DB_QUERY_ERRORS = Counter('db_query_errors_total', 'Statements that failed', ['query'])
+TICK_LAG = Histogram('reminder_tick_lag_seconds', 'How long after the start of its minute the reminder tick ran',
+                     buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+REMINDERS_FIRED = Counter('reminders_fired_total', 'Reminders handed to the send queue', ['kind'])
+MESSAGES = Counter('messages_total', 'Outgoing reminder messages by outcome', ['outcome'])
+SEND_LATENCY = Histogram('send_seconds', 'Time from queueing a reminder to Telegram accepting it',
+                         buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300))
@@ -0,0 +1,39 @@
+import sys
+import time
+
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+import metrics
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Records how long each message and callback handler takes, and whether it raised."""
+
+    def _start(self, data: dict):
+        handler = current_handler.get()
+        data['metrics_handler'] = getattr(handler, '__name__', 'unknown')
+        data['metrics_started'] = time.perf_counter()
+
+    def _finish(self, data: dict):
+        handler = data.pop('metrics_handler', None)
+        started = data.pop('metrics_started', None)
+        if handler is None:
+            # no handler matched the update
+            return
+        metrics.HANDLER_LATENCY.observe(time.perf_counter() - started, handler=handler)
+        # post_process runs in the dispatcher's finally block, so a failing handler's error is still current
+        if sys.exc_info()[0] is not None:
+            metrics.HANDLER_ERRORS.inc(handler=handler)
+
+    async def on_process_message(self, message, data: dict):
+        self._start(data)
+
+    async def on_post_process_message(self, message, results, data: dict):
+        self._finish(data)
+
+    async def on_process_callback_query(self, query, data: dict):
+        self._start(data)
+
+    async def on_post_process_callback_query(self, query, results, data: dict):
+        self._finish(data)
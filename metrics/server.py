@@ -0,0 +1,42 @@
+import logging
+from typing import Optional
+
+from aiohttp import web
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+runner: Optional[web.AppRunner] = None
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=metrics.render(), headers={'Content-Type': CONTENT_TYPE})
+
+
+async def start_metrics_server(host: str, port: int):
+    """Serves /metrics on its own port, apart from the public webhook."""
+    global runner
+    if runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError:
+        await runner.cleanup()
+        runner = None
+        raise
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+
+async def stop_metrics_server():
+    global runner
+    if runner is not None:
+        await runner.cleanup()
+        runner = None
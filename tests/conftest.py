@@ -0,0 +1,6 @@
+import os
+
+# bot_logic.reminder_bot reads these at import; the tests never reach Telegram or the database
+os.environ.setdefault('TOKEN', '123456:TEST')
+os.environ.setdefault('DATABASE_URI', 'postgresql://localhost/test')
+os.environ.setdefault('SYSTEM_TIMEZONE', 'UTC')
@@ -0,0 +1,58 @@
+import asyncio
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import bot_logic.reminder_bot as reminder_bot
+import bot_logic.utils as utils
+from db.async_database import ACKNOWLEDGE_REMINDER
+
+
+class PendingReminders:
+    """Stands in for a connection, answering ACKNOWLEDGE_REMINDER from a list of unanswered reminders."""
+
+    def __init__(self, *reminders):
+        self.unanswered = list(reminders)
+
+    async def fetchval(self, query, medicine_name, user_id):
+        assert query == ACKNOWLEDGE_REMINDER
+        if (medicine_name, user_id) not in self.unanswered:
+            return None
+        self.unanswered.remove((medicine_name, user_id))
+        return medicine_name
+
+
+class Query:
+    def __init__(self, data: str, user_id: int):
+        self.data = data
+        self.from_user = SimpleNamespace(id=user_id)
+        self.message = SimpleNamespace(chat=SimpleNamespace(id=user_id), message_id=1)
+        self.answers = []
+
+    async def answer(self, text=None):
+        self.answers.append(text)
+
+
+async def edited(**kwargs):
+    pass
+
+
+def test_second_press_on_legacy_button_is_already_answered(monkeypatch):
+    connection = PendingReminders(('aspirin', 42))
+
+    @asynccontextmanager
+    async def get_connection():
+        yield connection
+
+    monkeypatch.setattr(reminder_bot, 'get_connection', get_connection)
+    monkeypatch.setattr(reminder_bot.reminder_bot, 'edit_message_reply_markup', edited)
+    monkeypatch.setattr(reminder_bot.reminder_bot, 'edit_message_text', edited)
+    buffered = []
+    monkeypatch.setattr(reminder_bot.intake_buffer, 'add', lambda *row, **kwargs: buffered.append(row))
+
+    first, second = Query('button_done_42_aspirin', 42), Query('button_done_42_aspirin', 42)
+    asyncio.run(reminder_bot.process_legacy_reminder_callback_buttons(first))
+    asyncio.run(reminder_bot.process_legacy_reminder_callback_buttons(second))
+
+    assert len(buffered) == 1
+    assert first.answers == [utils.CALLBACK_RESPONSE_DONE]
+    assert second.answers == [utils.CALLBACK_RESPONSE_ALREADY_ANSWERED]
@@ -0,0 +1,53 @@
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+
+import bot_logic.reminder_dispatcher as reminder_dispatcher
+from bot_logic.reminder_dispatcher import ReminderDispatcher
+from bot_logic.shard_leases import ShardLeases
+
+
+class Shards(ShardLeases):
+    """Leases that stay valid without a database."""
+
+    def is_valid(self) -> bool:
+        return True
+
+
+def test_tick_leaves_loading_shard_fired_until_alone(monkeypatch):
+    load_started, finish_load = asyncio.Event(), asyncio.Event()
+    fired_until = {}
+
+    @asynccontextmanager
+    async def connection():
+        yield None
+
+    async def iterate_schedules(connection, shard_count, shards, chunk_size):
+        load_started.set()
+        await finish_load.wait()
+        yield []
+
+    async def mark_shards_fired(connection, worker_id, shards, now):
+        fired_until.update(dict.fromkeys(shards, now))
+
+    monkeypatch.setattr(reminder_dispatcher, 'get_connection', connection)
+    monkeypatch.setattr(reminder_dispatcher, 'unit_of_work', connection)
+    monkeypatch.setattr(reminder_dispatcher, 'iterate_schedules', iterate_schedules)
+    monkeypatch.setattr(reminder_dispatcher, 'mark_shards_fired', mark_shards_fired)
+
+    async def run():
+        now = datetime(2026, 1, 1, 8, 0, tzinfo=timezone.utc)
+        shards = Shards(shard_count=4, worker_id='test')
+        shards.owned = {0, 1}
+        dispatcher = ReminderDispatcher(send_queue=None, shards=shards)
+        dispatcher.shard_minutes[0] = None
+        # shard 1 was taken over from a worker that fired it through 07:50
+        load = asyncio.create_task(dispatcher.load_shards({1: now - timedelta(minutes=10)}, now))
+        await load_started.wait()
+        await dispatcher.tick(now)
+        finish_load.set()
+        await load
+        return now
+
+    now = asyncio.run(run())
+    assert fired_until == {0: now}
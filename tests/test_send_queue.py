@@ -0,0 +1,79 @@
+import asyncio
+import time
+
+from aiogram.utils.exceptions import NetworkError
+
+from bot_logic.send_queue import SendQueue
+
+
+class StubBot:
+    """Records when each message went out, failing the first failures sends."""
+
+    def __init__(self, failures: int = 0):
+        self.failures = failures
+        self.sent = []
+        self.attempts = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.attempts.append(time.monotonic())
+        if self.failures:
+            self.failures -= 1
+            raise NetworkError('connection reset')
+        self.sent.append((chat_id, text, time.monotonic()))
+
+
+def test_busy_chat_does_not_hold_up_the_others():
+    async def run():
+        bot = StubBot()
+        queue = SendQueue(bot, global_rate=30, per_chat_rate=1)
+        queue.start()
+        start = time.monotonic()
+        for number in range(40):
+            queue.submit(1, f'busy {number}')
+        for chat_id in range(100, 160):
+            queue.submit(chat_id, 'other')
+        while sum(1 for chat_id, _, _ in bot.sent if chat_id != 1) < 60 and time.monotonic() - start < 10:
+            await asyncio.sleep(0.05)
+        await queue.stop(timeout=0)
+        return bot, start
+
+    bot, start = asyncio.run(run())
+    others = [sent_at - start for chat_id, _, sent_at in bot.sent if chat_id != 1]
+    assert len(others) == 60
+    # 30 from the full bucket, then 30 a second, with the busy chat's first message among them
+    assert max(others) < 1.5
+    busy = [text for chat_id, text, _ in bot.sent if chat_id == 1]
+    assert busy == [f'busy {number}' for number in range(len(busy))]
+
+
+def test_waiting_chat_keeps_its_order():
+    async def run():
+        bot = StubBot()
+        queue = SendQueue(bot, global_rate=1000, per_chat_rate=20)
+        queue.start()
+        for number in range(10):
+            queue.submit(1, str(number))
+            queue.submit(2, str(number))
+        await queue.stop(timeout=5)
+        return bot, queue
+
+    bot, queue = asyncio.run(run())
+    for chat in (1, 2):
+        assert [text for chat_id, text, _ in bot.sent if chat_id == chat] == [str(number) for number in range(10)]
+    assert queue.depth == 0
+
+
+def test_network_errors_back_off():
+    async def run():
+        bot = StubBot(failures=3)
+        queue = SendQueue(bot, per_chat_rate=1000, retry_backoff=0.05)
+        queue.start()
+        queue.submit(1, 'dose')
+        await queue.stop(timeout=5)
+        return bot, queue
+
+    bot, queue = asyncio.run(run())
+    gaps = [later - earlier for earlier, later in zip(bot.attempts, bot.attempts[1:])]
+    assert len(bot.sent) == 1 and queue.retried == 3
+    for gap, backoff in zip(gaps, (0.05, 0.1, 0.2)):
+        assert backoff * 0.9 <= gap < backoff * 2